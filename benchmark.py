@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""Benchmarks config parsing, serialization, modification and validation on synthetic realm configs.
+
+Each size gets a generated config with that many endpoints, a random number
+of extra_remotes each and balance weights on some of them. Every case is
+timed (best of --repeat runs) and run once more under tracemalloc for its
+peak memory. --save-baseline writes the results to a JSON file;
+--baseline compares against one and exits 1 if any case got slower or
+larger by more than --tolerance. Pass --sizes 10,1000,100000 to include
+the largest configs; a 100k-endpoint run takes several minutes.
+"""
+import sys
+import os
+import re
+import gc
+import asyncio
+import copy
+import json
+import time
+import random
+import zlib
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout, redirect_stderr
+from collections import OrderedDict
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_SIZES = "10,100,1000,10000"
+MODIFY_OPERATIONS = 50
+
+def generate_config(endpoints, max_extra_remotes=3, weighted_ratio=0.3, seed=1):
+    """Returns (toml_text, [remote addresses]) for a config with `endpoints` endpoints."""
+    rng = random.Random(seed)
+    lines = ['[log]', '  level = "warn"', '  output = "/var/log/realm.log"', '',
+             '[network]', '  no_tcp = false', '  use_udp = true', '']
+    remotes_seen = []
+    for i in range(endpoints):
+        remotes = []
+        for _ in range(1 + rng.randint(0, max_extra_remotes)):
+            n = len(remotes_seen)
+            remotes.append(f"172.{16 + (n >> 16) % 16}.{(n >> 8) & 255}.{n & 255}:{8000 + n % 1000}")
+            remotes_seen.append(remotes[-1])
+        lines.append('[[endpoints]]')
+        lines.append(f'  listen = "10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}:{10000 + i % 50000}"')
+        lines.append(f'  remote = "{remotes[0]}"')
+        if len(remotes) > 1:
+            lines.append('  extra_remotes = [{}]'.format(", ".join(f'"{r}"' for r in remotes[1:])))
+            if rng.random() < weighted_ratio:
+                lines.append('  balance = "roundrobin: {}"'.format(", ".join(str(rng.randint(1, 10)) for _ in remotes)))
+        lines.append('')
+    return "\n".join(lines), remotes_seen
+
+def load_modules(workdir):
+    """Imports the daemon and validator with their files pointed into `workdir`."""
+    os.environ["REALM_CONFIG_FILE"] = os.path.join(workdir, "config.toml")
+    os.environ["HEALTH_CHECKS_FILE"] = os.path.join(workdir, "health_checks.conf")
+    os.environ["STATE_BACKUP_FILE"] = os.path.join(workdir, "state.backup.json")
+    os.environ["HEALTH_STATE_FILE"] = os.path.join(workdir, "health_state.json")
+    os.environ["HEALTH_HISTORY_FILE"] = os.path.join(workdir, "health_history.bin")
+    os.environ["HEALTH_CHECK_LOG_FILE"] = "-"
+    os.environ["CONTROL_SOCKET_PATH"] = os.path.join(workdir, "control.sock")
+    # Every cycle applies its decisions right away, and "restarting realm" is a no-op.
+    os.environ["RESTART_BATCH_WINDOW"] = "0"
+    os.environ["RESTART_MIN_INTERVAL"] = "0"
+    os.environ["REALM_RESTART_COMMAND"] = "true"
+    sys.path.insert(0, SCRIPT_DIR)
+    import health_checker_daemon
+    import validator
+    return health_checker_daemon, validator
+
+def baseline_modify(config_data, state_data, action, address):
+    """The pre-ConfigModel single-pass disable/enable, kept here only as a reference point.
+
+    Rescans the whole endpoint list for every operation; the daemon itself
+    uses ConfigModel.
+    """
+    if action == "enable":
+        if address not in state_data:
+            return config_data, state_data, False
+        infos = state_data.pop(address)
+        listens = {info['listen'] for info in infos}
+        config_data['endpoints'] = [ep for ep in config_data.get('endpoints', []) if ep.get('listen') not in listens]
+        for info in infos:
+            config_data['endpoints'].append(json.loads(info['original_block'], object_pairs_hook=OrderedDict))
+        return config_data, state_data, True
+
+    changed = False
+    endpoints = config_data.get('endpoints', [])
+    indices = [i for i, ep in enumerate(endpoints)
+               if address in ([ep['remote']] if 'remote' in ep else []) + ep.get('extra_remotes', [])]
+    for i in reversed(indices):
+        endpoint = endpoints[i]
+        listen = endpoint.get('listen')
+        if not listen:
+            continue
+        backups = state_data.setdefault(address, [])
+        if not any(item['listen'] == listen for item in backups):
+            backups.append({"listen": listen, "original_block": json.dumps(endpoint)})
+        remotes = ([endpoint['remote']] if endpoint.get('remote') else []) + endpoint.get('extra_remotes', [])
+        weights, strategy = [], "roundrobin"
+        match = re.search(r'"?([^:]+):\s*([^"]+)"?', endpoint.get('balance', ''))
+        if match:
+            strategy, weights = match.group(1).strip(), [w.strip() for w in match.group(2).split(',')]
+        if weights and len(weights) != len(remotes):
+            continue
+        if len(remotes) <= 1:
+            endpoints.pop(i)
+        else:
+            failed = remotes.index(address)
+            remotes.pop(failed)
+            if weights:
+                weights.pop(failed)
+            endpoint['remote'] = remotes.pop(0)
+            if remotes:
+                endpoint['extra_remotes'] = remotes
+            else:
+                endpoint.pop('extra_remotes', None)
+            if remotes and weights:
+                endpoint['balance'] = f"{strategy}: {', '.join(weights)}"
+            else:
+                endpoint.pop('balance', None)
+        changed = True
+    return config_data, state_data, changed
+
+class SimulatedDaemon:
+    """Drives the daemon's real run_cycle (probe, decide, modify, validate, write) against a fake probe backend.
+
+    Every check line uses `builtin:bench`, which answers instantly. Each
+    address fails for two cycles in a row with probability `fail_ratio`, so
+    cycles keep disabling and re-enabling upstreams and rewriting the config.
+    Check lines use the cycle period as their interval and start out due
+    without staggering, and the event loop clock jumps one period ahead before
+    each cycle, so back-to-back cycles each probe every line like cron ticks on
+    a daemon without `interval=` overrides.
+    """
+
+    CYCLE_SECONDS = 300
+
+    def __init__(self, daemon, fail_ratio=0.05):
+        self.daemon = daemon
+        self.fail_ratio = fail_ratio
+        self.cycle = 0
+        self.elapsed = 0
+        self.ctx = None
+
+        @daemon.probe_plugin("bench")
+        async def bench_probe(host, port):
+            bucket = zlib.crc32(f"{host}:{port}/{self.cycle // 2}".encode()) % 10000
+            if bucket < self.fail_ratio * 10000:
+                return daemon.ProbeResult(1, [None], "bench failure")
+            return daemon.ProbeResult(0, [0.001 + bucket / 1e7], "")
+
+    def prepare(self, config_text, remotes):
+        daemon = self.daemon
+        self.close()
+        for path in (daemon.HEALTH_STATE_FILE, daemon.HEALTH_HISTORY_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        daemon.write_file_atomic(daemon.REALM_CONFIG_FILE, config_text)
+        daemon.write_file_atomic(daemon.STATE_BACKUP_FILE, "{}")
+        daemon.write_file_atomic(daemon.HEALTH_CHECKS_FILE, "".join(f"{r}=builtin:bench\n" for r in remotes))
+        daemon.CONFIG_CACHE.invalidate()
+        daemon.STATE_CACHE.invalidate()
+
+        async def new_context():
+            ctx = daemon.DaemonContext(self.CYCLE_SECONDS, 5, 0)
+            ctx.scheduler.sync(ctx.checks.get().tasks, asyncio.get_event_loop().time(), stagger=False)
+            return ctx
+        self.ctx = daemon.run_async(new_context())
+        self.cycle = 0
+        self.elapsed = 0
+
+    def run_cycles(self, cycles):
+        daemon = self.daemon
+
+        async def run():
+            loop = asyncio.get_event_loop()
+            clock = loop.time
+            loop.time = lambda: clock() + self.elapsed
+            for _ in range(cycles):
+                self.cycle += 1
+                self.elapsed += self.CYCLE_SECONDS
+                await daemon.run_cycle(self.ctx)
+        daemon.run_async(run())
+
+    def close(self):
+        if self.ctx is None:
+            return
+        self.ctx.executor.shutdown(wait=False)
+        if self.ctx.history is not None:
+            self.ctx.history.close()
+        self.ctx = None
+
+def build_cases(daemon, validator, sim, size, args, workdir):
+    """Returns [(name, items, setup, func)] for one config size; setup() runs untimed before each func()."""
+    config_text, remotes = generate_config(size, args.extra_remotes, args.weighted_ratio, args.seed)
+    config_path = os.path.join(workdir, f"bench_{size}.toml")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.write(config_text)
+    config_lines = config_text.splitlines(True)
+    parsed = daemon.parse_toml(config_path)
+    targets = random.Random(args.seed).sample(remotes, min(MODIFY_OPERATIONS, len(remotes)))
+
+    apply_config_path = os.path.join(workdir, f"bench_{size}_apply.toml")
+    apply_state_path = os.path.join(workdir, f"bench_{size}_apply.state.json")
+    disables = [("disable", address) for address in targets]
+    fixture = {}
+
+    def fresh_config():
+        fixture['config'] = copy.deepcopy(parsed)
+
+    def fresh_model():
+        fixture['model'] = daemon.ConfigModel(copy.deepcopy(parsed))
+
+    def fresh_files():
+        with open(apply_config_path, 'w', encoding='utf-8') as f:
+            f.write(config_text)
+        with open(apply_state_path, 'w', encoding='utf-8') as f:
+            f.write("{}")
+
+    def disabled_model():
+        fresh_model()
+        fixture['state'] = {}
+        for address in targets[:len(targets) // 2]:
+            fixture['model'].disable(address, fixture['state'])
+
+    def modify_baseline():
+        config_data, state_data = fixture['config'], {}
+        for address in targets:
+            config_data, state_data, _ = baseline_modify(config_data, state_data, "disable", address)
+        for address in targets:
+            config_data, state_data, _ = baseline_modify(config_data, state_data, "enable", address)
+
+    def modify_model():
+        model, state_data = fixture['model'], {}
+        for address in targets:
+            model.disable(address, state_data)
+        for address in targets:
+            model.enable(address, state_data)
+
+    return [
+        ("daemon.parse_toml", size, None, lambda: daemon.parse_toml(config_path)),
+        ("daemon.serialize_to_toml", size, None, lambda: daemon.serialize_to_toml(parsed)),
+        ("baseline.single_pass_modify", 2 * len(targets), fresh_config, modify_baseline),
+        ("daemon.ConfigModel.disable/enable", 2 * len(targets), fresh_model, modify_model),
+        ("daemon.perform_batch_modification", len(targets), fresh_files,
+         lambda: daemon.perform_batch_modification(apply_config_path, disables, apply_state_path)),
+        ("daemon.commit_config", size, disabled_model, lambda: daemon.commit_config(fixture['model'], fixture['state'])),
+        ("validator.parse_toml", size, None, lambda: validator.parse_toml(config_lines)),
+        ("validator.validate_config", size, None, lambda: validator.validate_config(config_path)),
+        ("daemon_cycle", len(remotes) * args.cycles, lambda: sim.prepare(config_text, remotes),
+         lambda: sim.run_cycles(args.cycles)),
+    ]
+
+def measure(setup, func, repeat):
+    """Returns (best seconds over `repeat` runs, peak traced bytes of one more run)."""
+    best = None
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        for _ in range(repeat):
+            if setup:
+                setup()
+            gc.collect()
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        if setup:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+def compare(results, baseline, tolerance, min_delta):
+    """Returns [(key, metric, old, new)] for every case that regressed beyond the tolerance."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if current['seconds'] > previous['seconds'] * (1 + tolerance) and current['seconds'] - previous['seconds'] >= min_delta:
+            regressions.append((key, 'seconds', previous['seconds'], current['seconds']))
+        if current['peak_bytes'] > previous['peak_bytes'] * (1 + tolerance) and current['peak_bytes'] - previous['peak_bytes'] >= 64 * 1024:
+            regressions.append((key, 'peak_bytes', previous['peak_bytes'], current['peak_bytes']))
+    return regressions
+
+def format_ratio(current, previous):
+    return f"{current / previous:.2f}x" if previous else "-"
+
+def main():
+    parser = argparse.ArgumentParser(description="对配置解析、序列化、修改与校验以及完整的守护进程检测周期进行性能基准测试。")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"逗号分隔的 endpoint 数量 (默认 {DEFAULT_SIZES})。")
+    parser.add_argument("--extra-remotes", type=int, default=3, help="每个 endpoint 随机生成的 extra_remotes 上限 (默认 3)。")
+    parser.add_argument("--weighted-ratio", type=float, default=0.3, help="带 balance 权重的 endpoint 比例 (默认 0.3)。")
+    parser.add_argument("--fail-ratio", type=float, default=0.05, help="模拟周期中探测失败的上游比例 (默认 0.05)。")
+    parser.add_argument("--cycles", type=int, default=4, help="每次模拟运行的检测周期数 (默认 4)。")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数，取最快一次 (默认 3)。")
+    parser.add_argument("--seed", type=int, default=1, help="生成配置所用的随机种子。")
+    parser.add_argument("--only", action="append", metavar="NAME", help="只运行名称包含 NAME 的测试项 (可重复)。")
+    parser.add_argument("--baseline", help="与之比较的基准结果 JSON 文件；出现性能退化时以退出码 1 结束。")
+    parser.add_argument("--save-baseline", metavar="FILE", help="将本次结果保存为基准 JSON 文件。")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的相对退化幅度 (默认 0.25，即 25%%)。")
+    parser.add_argument("--min-delta", type=float, default=0.002, help="耗时增加小于此秒数时不视为退化 (默认 0.002)。")
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    except ValueError:
+        print(f"错误: 无效的 --sizes 参数 '{args.sizes}'。", file=sys.stderr)
+        sys.exit(2)
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"错误: 无法读取基准文件 '{args.baseline}': {e}", file=sys.stderr)
+            sys.exit(2)
+
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory(prefix="realm-bench-") as workdir:
+        daemon, validator = load_modules(workdir)
+        sim = SimulatedDaemon(daemon, args.fail_ratio)
+        print(f"{'case':<36}{'endpoints':>10}{'time':>14}{'items/s':>18}{'peak mem':>15}{'vs base':>10}")
+        for size in sizes:
+            for name, items, setup, func in build_cases(daemon, validator, sim, size, args, workdir):
+                if args.only and not any(pattern in name for pattern in args.only):
+                    continue
+                seconds, peak = measure(setup, func, args.repeat)
+                key = f"{name}@{size}"
+                results[key] = {'seconds': seconds, 'items': items, 'peak_bytes': peak}
+                previous = baseline.get(key) if baseline else None
+                ratio = format_ratio(seconds, previous['seconds']) if previous else ""
+                print(f"{name:<36}{size:>10}{seconds * 1000:>12.2f}ms{items / seconds if seconds else 0:>18,.0f}"
+                      f"{peak / 1048576:>13.2f}MB{ratio:>10}", flush=True)
+        sim.close()
+
+    if args.save_baseline:
+        meta = {'python': platform.python_version(), 'platform': platform.platform(),
+                'created_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'args': vars(args)}
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f"基准结果已保存到 {args.save_baseline}。")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项性能退化 (容差 {args.tolerance:.0%}):", file=sys.stderr)
+            for key, metric, previous, current in regressions:
+                print(f"  REGRESSION {key} {metric}: {previous:.6g} -> {current:.6g} ({format_ratio(current, previous)})", file=sys.stderr)
+            sys.exit(1)
+        print(f"与基准相比未发现超过 {args.tolerance:.0%} 的性能退化。")
+
+if __name__ == "__main__":
+    main()
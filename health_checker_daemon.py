@@ -5,10 +5,38 @@ import json
 import os
 import time
 import subprocess
+import tempfile
+import threading
+import queue
+import gzip
+import shutil
+import stat
+import atexit
+import signal
+import hmac
+import hashlib
 import argparse
-from collections import OrderedDict
+import cProfile
+import pstats
+import asyncio
+import inspect
+import ssl
+import ctypes
+import ctypes.util
+import socket
+import struct
+import weakref
+import heapq
+import random
+import itertools
+import shlex
+import mmap
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+
+from validator import validate_data
 
 try:
     from croniter import croniter
@@ -20,38 +48,263 @@ REALM_CONFIG_DIR = os.environ.get("REALM_CONFIG_DIR", "/etc/realm")
 REALM_CONFIG_FILE = os.environ.get("REALM_CONFIG_FILE", os.path.join(REALM_CONFIG_DIR, "config.toml"))
 HEALTH_CHECKS_FILE = os.environ.get("HEALTH_CHECKS_FILE", os.path.join(REALM_CONFIG_DIR, "health_checks.conf"))
 STATE_BACKUP_FILE = os.environ.get("STATE_BACKUP_FILE", os.path.join(os.path.dirname(os.path.realpath(__file__)), "state.backup.json"))
-VALIDATOR_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "validator.py")
+HEALTH_STATE_FILE = os.environ.get("HEALTH_STATE_FILE", os.path.join(os.path.dirname(os.path.realpath(__file__)), "health_state.json"))
+HEALTH_HISTORY_FILE = os.environ.get("HEALTH_HISTORY_FILE", os.path.join(os.path.dirname(os.path.realpath(__file__)), "health_history.bin"))
+HISTORY_SLOTS = int(os.environ.get("HISTORY_SLOTS", 1024))
+HISTORY_ENTRIES = int(os.environ.get("HISTORY_ENTRIES", 576))
+HEALTH_SNAPSHOT_INTERVAL = float(os.environ.get("HEALTH_SNAPSHOT_INTERVAL", 60))
+HEALTH_SNAPSHOT_MAX_AGE = float(os.environ.get("HEALTH_SNAPSHOT_MAX_AGE", 3600))
 HEALTH_CHECK_CRON = os.environ.get("HEALTH_CHECK_CRON", "*/5 * * * *")
 FAILURES_TO_DISABLE = int(os.environ.get("FAILURES_TO_DISABLE", 2))
+SUCCESSES_TO_ENABLE = max(1, int(os.environ.get("SUCCESSES_TO_ENABLE", 2)))
+FLAP_HALF_LIFE = float(os.environ.get("FLAP_HALF_LIFE", 900))
+FLAP_SUPPRESS_LIMIT = float(os.environ.get("FLAP_SUPPRESS_LIMIT", 1500))
+FLAP_REUSE_LIMIT = float(os.environ.get("FLAP_REUSE_LIMIT", 750))
+FLAP_PENALTY = 1000
+FLAP_PENALTY_CEILING = 8000
+PROBE_BACKOFF_MAX = float(os.environ.get("PROBE_BACKOFF_MAX", 3600))
 CONCURRENT_CHECKS = int(os.environ.get("CONCURRENT_CHECKS", 5))
+MAX_CONCURRENT_CHECKS = max(CONCURRENT_CHECKS, int(os.environ.get("MAX_CONCURRENT_CHECKS", 64)))
+CYCLE_DEADLINE_RATIO = 0.9
 MIN_CYCLE_SECONDS = 5
-VENV_PYTHON = os.environ.get("VENV_PYTHON", os.path.join(os.path.dirname(os.path.realpath(__file__)), '.venv', 'bin', 'python3'))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(os.path.realpath(__file__)), "profiles"))
+PROFILE_SLOW_CYCLE_SECONDS = os.environ.get("PROFILE_SLOW_CYCLE_SECONDS")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 20))
 HEALTH_CHECK_LOG_FILE = os.environ.get("HEALTH_CHECK_LOG_FILE", "/var/log/realm_health_check.log")
-MAX_LOG_SIZE_MB = 5
+MANUAL_CHECK_TIMEOUT = 10
+MANUAL_CHECK_CONCURRENCY = int(os.environ.get("MANUAL_CHECK_CONCURRENCY", 32))
+CONTROL_SOCKET_PATH = os.environ.get("CONTROL_SOCKET_PATH", "/run/realm_health_check.sock")
+CONTROL_TIMEOUT = 30
+MAX_LOG_SIZE_MB = float(os.environ.get("MAX_LOG_SIZE_MB", 5))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+LOG_ROTATE_HOURS = float(os.environ.get("LOG_ROTATE_HOURS", 0))
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+LOG_LEVEL = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "info").upper(), LOG_LEVELS["INFO"])
+LOG_QUEUE_SIZE = 10000
+RESTART_BATCH_WINDOW = float(os.environ.get("RESTART_BATCH_WINDOW", 0))
+RESTART_MIN_INTERVAL = float(os.environ.get("RESTART_MIN_INTERVAL", 60))
+RESTART_BURST = int(os.environ.get("RESTART_BURST", 1))
+REALM_RESTART_COMMAND = shlex.split(os.environ.get("REALM_RESTART_COMMAND", "systemctl restart realm"))
+REALM_RESTART_TIMEOUT = 60
+RESTART_RETRY_SECONDS = float(os.environ.get("RESTART_RETRY_SECONDS", 30))
+
+BUILTIN_PROBE_PREFIX = "builtin:"
+BUILTIN_PROBE_CONCURRENCY = int(os.environ.get("BUILTIN_PROBE_CONCURRENCY", 1000))
+PROBE_ATTEMPTS = 5
+PROBE_SUCCESS_THRESHOLD = 2
+TCP_ATTEMPT_TIMEOUT = 1
+TCP_ATTEMPT_INTERVAL = 0.5
+ICMP_ECHO_INTERVAL = 0.3
+ICMP_REPLY_TIMEOUT = 1
+UDP_REPLY_TIMEOUT = 1
+UDP_ECHO_INTERVAL = 0.3
+HTTP_POOL_IDLE_SECONDS = 300
+HTTP_POOL_PER_KEY = 2
+HTTP_MAX_BODY = 65536
+PROBE_TIMEOUT_EXIT_CODE = 124
+PROBE_SPREAD_SECONDS = os.environ.get("PROBE_SPREAD_SECONDS")
+PROBE_JITTER = 0.5
+WATCH_POLL_INTERVAL = 2
+WATCH_DEBOUNCE = 0.2
+HOST_ONLY_PROBE_SCRIPTS = {name.strip() for name in os.environ.get("HOST_ONLY_PROBE_SCRIPTS", "ping_check.sh").split(",") if name.strip()}
+BALANCE_WEIGHTING = os.environ.get("BALANCE_WEIGHTING", "off")
+BALANCE_EWMA_ALPHA = float(os.environ.get("BALANCE_EWMA_ALPHA", 0.3))
+BALANCE_CHANGE_THRESHOLD = float(os.environ.get("BALANCE_CHANGE_THRESHOLD", 0.25))
+BALANCE_HOLD_CYCLES = int(os.environ.get("BALANCE_HOLD_CYCLES", 3))
+BALANCE_WEIGHT_SCALE = 10
+BALANCE_MIN_SAMPLES = 3
+BALANCE_RTT_FLOOR = 0.001
+PEERS = [peer.strip() for peer in os.environ.get("PEERS", "").split(",") if peer.strip()]
+PEER_LISTEN = os.environ.get("PEER_LISTEN", "0.0.0.0:9470")
+PEER_SECRET = os.environ.get("PEER_SECRET", "")
+PEER_QUORUM = int(os.environ.get("PEER_QUORUM", 0))
+PEER_VERDICT_TTL = float(os.environ.get("PEER_VERDICT_TTL", 0))
+NODE_ID = os.environ.get("NODE_ID", "")
+PEER_ADDRESSES_PER_DATAGRAM = 100
+DNS_MIN_TTL = float(os.environ.get("DNS_MIN_TTL", 0))
+DNS_MAX_TTL = float(os.environ.get("DNS_MAX_TTL", 3600))
+DNS_QUERY_TIMEOUT = 2
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+RESOLV_CONF = "/etc/resolv.conf"
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "")
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE", "")
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+BALANCE_PATTERN = re.compile(r'"?([^:]+):\s*([^"]+)"?')
+HEALTH_CHECK_OPTION_PATTERN = re.compile(r'^(interval|timeout)=(\d+(?:\.\d+)?)$')
+
+ProbeTask = namedtuple('ProbeTask', ['address', 'probe', 'kind', 'host', 'port', 'options', 'interval', 'timeout'])
+TaskTable = namedtuple('TaskTable', ['tasks', 'addresses', 'hosts'])
+
 
+def format_log_record(timestamp, level, message, fields, fmt="text"):
+    if fmt == "json":
+        record = OrderedDict((
+            ('ts', datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')),
+            ('level', level), ('msg', message)))
+        record.update(fields)
+        return json.dumps(record, ensure_ascii=False, default=str)
+    return f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}] [{level}] {message}"
 
-def log(message, level="INFO"):
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [{level.upper()}] {message}", flush=True)
+def log(message, level="INFO", **fields):
+    """Logs a line; extra keyword fields are added as keys in LOG_FORMAT=json and ignored in text.
 
-def handle_log_rotation():
-    """Checks log file size and rotates if it exceeds the limit."""
-    if not os.path.exists(HEALTH_CHECK_LOG_FILE):
+    Records below LOG_LEVEL (default info; set LOG_LEVEL=debug for DEBUG records) are dropped.
+
+    In the daemon, records are handed to the background logger and this never
+    blocks on I/O; CLI actions print synchronously to stderr, so their stdout
+    only carries results (JSON lines, TSV rows, upstream lists).
+    """
+    if LOG_LEVELS.get(level.upper(), LOG_LEVELS["INFO"]) < LOG_LEVEL:
         return
-    
-    try:
-        file_size_mb = os.path.getsize(HEALTH_CHECK_LOG_FILE) / (1024 * 1024)
-        
-        if file_size_mb > MAX_LOG_SIZE_MB:
-            log(f"Log file size ({file_size_mb:.2f} MB) exceeds limit of {MAX_LOG_SIZE_MB} MB. Rotating log.", "WARN")
-            backup_path = HEALTH_CHECK_LOG_FILE + ".bak"
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
-            os.rename(HEALTH_CHECK_LOG_FILE, backup_path)
-            log("Log file rotated. New log file created.", "INFO")
-    except Exception as e:
-        log(f"Error during log rotation: {e}", "ERROR")
+    timestamp = time.time()
+    if _LOGGER is not None:
+        _LOGGER.submit((timestamp, level.upper(), message, fields))
+        return
+    print(format_log_record(timestamp, level.upper(), message, fields), file=sys.stderr, flush=True)
+
+_LOG_STOP = object()
+
+class BackgroundLogger:
+    """Writes queued log records from a dedicated thread and rotates the file it owns.
+
+    Rotation happens by size (`max_bytes`) and optionally by age
+    (`rotate_seconds`); the live file is renamed and gzip-compressed into
+    `path.1.gz`, older generations shift up and the oldest beyond
+    `backup_count` is dropped. If the file is moved away by someone else
+    (logrotate, an operator), it is reopened. With `path` None, records go
+    to stdout. When the queue is full, records are dropped and counted
+    rather than stalling the caller.
+    """
+
+    def __init__(self, path, fmt, max_bytes, backup_count, rotate_seconds):
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_seconds = rotate_seconds
+        self._queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._stream = None
+        self._size = 0
+        self._inode = None
+        self._opened_at = 0.0
+        self._last_inode_check = 0.0
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
 
+    def close(self, timeout=5):
+        try:
+            self._queue.put(_LOG_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _open(self):
+        if self.path is None:
+            self._stream = sys.stdout
+            return
+        self._stream = open(self.path, 'a', encoding='utf-8')
+        st = os.fstat(self._stream.fileno())
+        self._size, self._inode = st.st_size, st.st_ino
+        self._opened_at = time.time()
+
+    def _reopen_if_moved(self, now):
+        if self.path is None or now - self._last_inode_check < 1:
+            return
+        self._last_inode_check = now
+        try:
+            moved = os.stat(self.path).st_ino != self._inode
+        except OSError:
+            moved = True
+        if moved:
+            self._stream.close()
+            self._open()
+
+    def _rotation_due(self, now):
+        if self.path is None:
+            return False
+        if self.max_bytes and self._size >= self.max_bytes:
+            return True
+        return bool(self.rotate_seconds) and now - self._opened_at >= self.rotate_seconds
+
+    def _rotate(self):
+        self._stream.close()
+        try:
+            for index in range(self.backup_count - 1, 0, -1):
+                older = f"{self.path}.{index}.gz"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}.gz")
+            if self.backup_count > 0:
+                rotated = f"{self.path}.1"
+                os.replace(self.path, rotated)
+                with open(rotated, 'rb') as src, gzip.open(rotated + ".gz", 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+            else:
+                os.remove(self.path)
+        finally:
+            # Even a failed rotation must leave a writable stream behind.
+            self._open()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _LOG_STOP:
+                stopping = True
+            records = [record for record in batch if record is not _LOG_STOP]
+            with self._dropped_lock:
+                dropped, self._dropped = self._dropped, 0
+            lines = [format_log_record(*record, fmt=self.fmt) for record in records]
+            if dropped:
+                lines.append(format_log_record(time.time(), "WARN", f"Log queue full; {dropped} record(s) dropped.", {}, self.fmt))
+            try:
+                now = time.time()
+                if self._stream.closed:
+                    self._open()
+                self._reopen_if_moved(now)
+                text = "".join(line + "\n" for line in lines)
+                self._stream.write(text)
+                self._stream.flush()
+                self._size += len(text.encode('utf-8'))
+                if self._rotation_due(now):
+                    self._rotate()
+            except Exception as e:
+                # The writer thread must survive any error, or every later record is lost.
+                sys.stderr.write(f"log writer error: {e}\n")
+
+_LOGGER = None
+
+def start_background_logging():
+    """Moves daemon logging onto a background thread that owns HEALTH_CHECK_LOG_FILE ('-' for stdout)."""
+    global _LOGGER
+    if _LOGGER is not None:
+        return
+    path = None if HEALTH_CHECK_LOG_FILE in ("", "-") else HEALTH_CHECK_LOG_FILE
+    try:
+        _LOGGER = BackgroundLogger(path, LOG_FORMAT, int(MAX_LOG_SIZE_MB * 1024 * 1024),
+                                   LOG_BACKUP_COUNT, LOG_ROTATE_HOURS * 3600)
+    except (IOError, OSError) as e:
+        log(f"Cannot open log file {path}: {e}. Logging to stdout.", "WARN")
+        _LOGGER = BackgroundLogger(None, LOG_FORMAT, 0, 0, 0)
+    atexit.register(_LOGGER.close)
 
 def load_json_file(file_path, default=None):
     if default is None:
@@ -65,12 +318,61 @@ def load_json_file(file_path, default=None):
     except (json.JSONDecodeError, FileNotFoundError):
         return default
 
+def write_file_atomic(file_path, content):
+    """Writes `content` to a temp file beside `file_path`, then renames it into place."""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(file_path) + ".", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            mode = os.stat(file_path).st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
 def save_json_file(data, file_path):
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except IOError as e:
+        write_file_atomic(file_path, json.dumps(data, indent=2, ensure_ascii=False))
+        return True
+    except (IOError, OSError) as e:
         log(f"Error saving state file to {file_path}: {e}", "ERROR")
+        return False
+
+def write_config_and_state(config_file, toml_content, state_file, state_data):
+    """Writes the state backup first, then the config; returns True if both landed.
+
+    Each file is replaced atomically. If the config write fails, the previous
+    backup is put back so the two files never disagree about a removed upstream.
+    """
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            previous_state = f.read()
+    except (IOError, OSError):
+        previous_state = None
+
+    if not save_json_file(state_data, state_file):
+        return False
+    try:
+        write_file_atomic(config_file, toml_content)
+    except (IOError, OSError) as e:
+        log(f"Error writing config file {config_file}: {e}", "ERROR")
+        if previous_state is not None:
+            try:
+                write_file_atomic(state_file, previous_state)
+            except (IOError, OSError):
+                log(f"Could not restore previous state file {state_file}.", "ERROR")
+        return False
+    return True
 
 def parse_toml(filepath):
     try:
@@ -162,303 +464,3179 @@ def serialize_to_toml(data):
 
     return "\n".join(output_lines)
 
-def run_check(script_path, host, port, timeout):
-    """Executes a single health check script."""
+class ProbeResult(namedtuple('ProbeResult', ['exit_code', 'latencies', 'detail'])):
+    """Outcome of one probe: exit code (0 is healthy), per-attempt RTTs (None when lost) and a short detail."""
+    __slots__ = ()
+
+    def __new__(cls, exit_code, latencies, detail=""):
+        return super().__new__(cls, exit_code, latencies, detail)
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+def run_script_probe(script_path, host, port, timeout):
+    """Subprocess adapter for script lines: runs the script and reports its exit code and last output line."""
     try:
         process = subprocess.run(
-            ["timeout", str(timeout), script_path, host, str(port)],
+            ["timeout", f"{timeout:g}", script_path, host, str(port)],
             capture_output=True, text=True, check=False
         )
-        return process.returncode
     except Exception as e:
         log(f"Failed to execute check script {script_path}: {e}", "ERROR")
-        return 1
+        return ProbeResult(1, [], str(e))
+    output = (process.stderr.strip() or process.stdout.strip()).splitlines()
+    return ProbeResult(process.returncode, [], output[-1][:200] if output else "")
 
-def modify_config_logic(config_data, state_data, action, address):
-    config_changed = False
-    
-    if action == "enable":
-        if address not in state_data:
-            return config_data, state_data, False
+def split_host_port(upstream_addr):
+    """Splits 'host:port' or '[v6]:port' into (host, port); port is '' if absent."""
+    match = re.match(r'^\[(.+)\]:(.+)$', upstream_addr) or re.match(r'^([^:]+):([^:]+)$', upstream_addr)
+    if match:
+        return match.groups()
+    return upstream_addr, ""
 
-        log(f"Restoring configuration for recovered upstream: '{address}'", "INFO")
-        
-        blocks_to_restore_info = state_data[address]
-        listen_addrs_to_process = {info['listen'] for info in blocks_to_restore_info}
-        
-        config_data['endpoints'] = [ep for ep in config_data.get('endpoints', []) if ep.get('listen') not in listen_addrs_to_process]
-        
-        for info in blocks_to_restore_info:
-            restored_endpoint = json.loads(info['original_block'], object_pairs_hook=OrderedDict)
-            config_data['endpoints'].append(restored_endpoint)
-        
-        del state_data[address]
-        config_changed = True
-
-    elif action == "disable":
-        indices_to_process = []
-        for i, endpoint in enumerate(config_data.get('endpoints', [])):
-            remotes = ([endpoint.get('remote')] if 'remote' in endpoint else []) + endpoint.get('extra_remotes', [])
-            if address in remotes:
-                indices_to_process.append(i)
-        
-        if not indices_to_process:
-            return config_data, state_data, False
+def format_latencies(latencies):
+    return "[" + ", ".join("-" if l is None else f"{l * 1000:.1f}ms" for l in latencies) + "]"
 
-        for i in sorted(indices_to_process, reverse=True):
-            target_endpoint = config_data['endpoints'][i]
-            listen_addr = target_endpoint.get("listen")
+PROBE_PLUGINS = {}
 
-            if not listen_addr: continue
-            
-            backup_list = state_data.get(address, [])
-            if not any(item['listen'] == listen_addr for item in backup_list):
-                 backup_list.append({
-                    "listen": listen_addr,
-                    "original_block": json.dumps(target_endpoint)
-                })
-            state_data[address] = backup_list
-            
-            original_remote = target_endpoint.get('remote', "")
-            extra_remotes = target_endpoint.get('extra_remotes', [])
-            full_remotes_list = ([original_remote] if original_remote else []) + extra_remotes
-            
-            weights, strategy = [], "roundrobin"
-            if 'balance' in target_endpoint:
-                balance_match = re.search(r'"?([^:]+):\s*([^"]+)"?', target_endpoint['balance'])
-                if balance_match:
-                    strategy = balance_match.group(1).strip()
-                    weights = [w.strip() for w in balance_match.group(2).split(',')]
+def probe_plugin(name, needs_port=True):
+    """Registers an async probe as `builtin:<name>`.
 
-            if weights and len(weights) != len(full_remotes_list):
-                log(f"Error: 权重数量({len(weights)})与节点数量({len(full_remotes_list)})不匹配，跳过此块。", "ERROR")
-                continue
+    The probe is awaited as probe(host, port, **options) and returns a
+    ProbeResult. Its keyword parameters are the `key=value` options a health
+    check line may give after the probe; values are converted to the type of
+    the parameter's default. A `server_name` parameter defaults to the line's
+    hostname, before DNS caching replaces it with an address.
+    """
+    def register(func):
+        func.needs_port = needs_port
+        PROBE_PLUGINS[name] = func
+        return func
+    return register
 
-            if len(full_remotes_list) <= 1:
-                log(f"规则 '{listen_addr}' 中唯一的上游 '{address}' 失效，将移除整个规则。", "WARN")
-                config_data['endpoints'].pop(i)
-            else:
-                failed_index = full_remotes_list.index(address)
-                full_remotes_list.pop(failed_index)
-                if weights and failed_index < len(weights):
-                    weights.pop(failed_index)
-                
-                target_endpoint['remote'] = full_remotes_list.pop(0)
-                if full_remotes_list:
-                    target_endpoint['extra_remotes'] = full_remotes_list
-                elif 'extra_remotes' in target_endpoint:
-                    del target_endpoint['extra_remotes']
+@probe_plugin("tcp")
+async def tcp_probe(host, port, attempts=PROBE_ATTEMPTS, threshold=PROBE_SUCCESS_THRESHOLD,
+                    attempt_timeout=TCP_ATTEMPT_TIMEOUT, interval=TCP_ATTEMPT_INTERVAL):
+    """In-process equivalent of tcp_ping_check.sh, recording each attempt's connect latency."""
+    loop = asyncio.get_event_loop()
+    try:
+        addr_info = await asyncio.wait_for(
+            loop.getaddrinfo(host, int(port), type=socket.SOCK_STREAM), attempt_timeout)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        return ProbeResult(1, [None] * attempts, "cannot resolve")
+    family, sock_type, proto, _, sock_addr = addr_info[0]
 
-                if full_remotes_list and weights:
-                    target_endpoint['balance'] = f"{strategy}: {', '.join(weights)}"
-                elif 'balance' in target_endpoint:
-                    del target_endpoint['balance']
-            
-            config_changed = True
+    latencies = []
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(interval)
+        sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+        start = loop.time()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, sock_addr), attempt_timeout)
+            latencies.append(loop.time() - start)
+        except (OSError, asyncio.TimeoutError):
+            latencies.append(None)
+        finally:
+            sock.close()
 
-    return config_data, state_data, config_changed
+    success_count = sum(1 for l in latencies if l is not None)
+    return ProbeResult(0 if success_count >= threshold else 1, latencies, f"{success_count}/{attempts} connects")
 
-def perform_modification(config_file, action, address, state_file):
-    config_data = parse_toml(config_file)
-    if not config_data:
-        log(f"无法解析配置文件: {config_file}", "ERROR")
-        return False
-    
-    state_data = load_json_file(state_file)
-    
-    config_data, state_data, modified = modify_config_logic(config_data, state_data, action, address)
+def latency_stats(latencies):
+    """Returns sent/received/loss and min/avg/max RTT (seconds) for a probe's attempts."""
+    rtts = [l for l in latencies if l is not None]
+    sent = len(latencies)
+    stats = {'sent': sent, 'received': len(rtts), 'loss': (sent - len(rtts)) / sent if sent else 1.0,
+             'rtt_min': None, 'rtt_avg': None, 'rtt_max': None}
+    if rtts:
+        stats.update(rtt_min=min(rtts), rtt_avg=sum(rtts) / len(rtts), rtt_max=max(rtts))
+    return stats
 
-    if modified:
-        log(f"配置已更新 (操作: {action}, 地址: {address})。正在写回文件...")
-        new_toml_content = serialize_to_toml(config_data)
-        with open(config_file, 'w', encoding='utf-8') as f:
-            f.write(new_toml_content)
-        save_json_file(state_data, state_file)
-        return True
-    else:
-        return False
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
 
-def parse_and_print_upstreams(config_file):
-    config_data = parse_toml(config_file)
-    if not config_data:
-        sys.exit(1)
-    
-    upstreams = set()
-    for endpoint in config_data.get('endpoints', []):
-        if endpoint.get('remote'):
-            upstreams.add(endpoint['remote'])
-        upstreams.update(endpoint.get('extra_remotes', []))
+class IcmpPinger:
+    """Pings many hosts over one shared ICMP socket per address family.
 
-    for upstream in sorted(list(upstreams)):
-        print(upstream)
+    Unprivileged SOCK_DGRAM/IPPROTO_ICMP sockets are preferred (the kernel owns
+    the echo identifier); when those are not permitted and we run as root, a
+    raw socket is used instead. Replies are matched by identifier/sequence.
+    """
+    _instances = weakref.WeakKeyDictionary()
 
-def health_check_daemon():
-    """Main daemon loop for concurrent health checks."""
-    effective_cron = HEALTH_CHECK_CRON
-    log(f"Health check daemon starting with schedule: '{effective_cron}'")
-    
+    def __init__(self, loop):
+        self._loop = loop
+        self._sockets = {}
+        self._pending = {}
+        self._seq = 0
+
+    @classmethod
+    def for_loop(cls, loop):
+        pinger = cls._instances.get(loop)
+        if pinger is None:
+            pinger = cls._instances[loop] = cls(loop)
+        return pinger
+
+    @classmethod
+    def close_for_loop(cls, loop):
+        pinger = cls._instances.pop(loop, None)
+        if pinger is not None:
+            pinger.close()
+
+    def close(self):
+        for sock, _, _ in self._sockets.values():
+            self._loop.remove_reader(sock.fileno())
+            sock.close()
+        self._sockets.clear()
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+
+    def _get_socket(self, family):
+        if family in self._sockets:
+            return self._sockets[family]
+        proto = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+            ident = None
+        except OSError:
+            if os.geteuid() != 0:
+                raise
+            sock = socket.socket(family, socket.SOCK_RAW, proto)
+            ident = os.getpid() & 0xFFFF
+        sock.setblocking(False)
+        self._loop.add_reader(sock.fileno(), self._on_readable, family)
+        self._sockets[family] = (sock, ident is not None, ident)
+        return self._sockets[family]
+
+    def _next_seq(self, family):
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xFFFF
+            if (family, self._seq) not in self._pending:
+                return self._seq
+        raise RuntimeError("ICMP sequence space exhausted")
+
+    def _on_readable(self, family):
+        sock, raw, ident = self._sockets[family]
+        while True:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            offset = (data[0] & 0x0F) * 4 if raw and family == socket.AF_INET else 0
+            if len(data) < offset + 8:
+                continue
+            icmp_type, _, _, reply_ident, seq = struct.unpack_from('!BBHHH', data, offset)
+            if icmp_type != (0 if family == socket.AF_INET else 129):
+                continue
+            if raw and reply_ident != ident:
+                continue
+            future = self._pending.get((family, seq))
+            if future is not None and not future.done() and future.dest == addr[0]:
+                future.set_result(self._loop.time())
+
+    async def _echo(self, family, sock_addr, timeout):
+        sock, raw, ident = self._get_socket(family)
+        seq = self._next_seq(family)
+        echo_type = 8 if family == socket.AF_INET else 128
+        payload = struct.pack('!d', time.time())
+        header = struct.pack('!BBHHH', echo_type, 0, 0, ident or 0, seq)
+        if family == socket.AF_INET:
+            header = struct.pack('!BBHHH', echo_type, 0, _icmp_checksum(header + payload), ident or 0, seq)
+
+        future = self._loop.create_future()
+        future.dest = sock_addr[0]
+        self._pending[(family, seq)] = future
+        try:
+            sent_at = self._loop.time()
+            sock.sendto(header + payload, sock_addr)
+            received_at = await asyncio.wait_for(future, timeout)
+            return received_at - sent_at
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            self._pending.pop((family, seq), None)
+
+    async def ping(self, host, count=PROBE_ATTEMPTS, interval=ICMP_ECHO_INTERVAL, timeout=ICMP_REPLY_TIMEOUT):
+        """Sends `count` echo requests `interval` seconds apart; returns per-request RTTs."""
+        addr_info = await self._loop.getaddrinfo(host, None, type=socket.SOCK_DGRAM)
+        family, _, _, _, sock_addr = addr_info[0]
+        echoes = []
+        for attempt in range(count):
+            if attempt:
+                await asyncio.sleep(interval)
+            echoes.append(self._loop.create_task(self._echo(family, sock_addr, timeout)))
+        return list(await asyncio.gather(*echoes))
+
+@probe_plugin("icmp", needs_port=False)
+async def icmp_probe(host, port, attempts=PROBE_ATTEMPTS, threshold=PROBE_SUCCESS_THRESHOLD):
+    """In-process equivalent of ping_check.sh; the port is ignored."""
+    pinger = IcmpPinger.for_loop(asyncio.get_event_loop())
     try:
-        base_iter = croniter(effective_cron, datetime.now())
-    except ValueError as e:
-        log(f"Invalid cron format '{effective_cron}': {e}. Exiting.", "ERROR")
-        sys.exit(1)
+        latencies = await pinger.ping(host, attempts)
+    except OSError as e:
+        log(f"ICMP probe for '{host}' failed: {e}", "ERROR")
+        return ProbeResult(1, [None] * attempts, str(e))
+    received = sum(1 for l in latencies if l is not None)
+    return ProbeResult(0 if received >= threshold else 1, latencies, f"{received}/{attempts} replies")
 
-    first_run_time = base_iter.get_next(datetime)
-    second_run_time = base_iter.get_next(datetime)
-    
-    total_cycle_seconds = (second_run_time - first_run_time).total_seconds()
-    
-    if total_cycle_seconds < MIN_CYCLE_SECONDS:
-        log(f"Cron schedule '{effective_cron}' results in a period shorter than {MIN_CYCLE_SECONDS}s.", "WARN")
-        total_cycle_seconds = MIN_CYCLE_SECONDS
-        log(f"Period has been automatically adjusted to {MIN_CYCLE_SECONDS} seconds.", "WARN")
+_SSL_CONTEXTS = {}
 
-    dynamic_timeout = max(1, int(total_cycle_seconds / 2))
-    log(f"Cycle interval set to {total_cycle_seconds}s. Health check timeout set to {dynamic_timeout}s.")
+def _ssl_context(verify):
+    if verify not in _SSL_CONTEXTS:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        _SSL_CONTEXTS[verify] = context
+    return _SSL_CONTEXTS[verify]
 
-    failure_counts = {}
-    cron = croniter(effective_cron, datetime.now())
+def _describe_error(e):
+    return f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+class HttpConnectionPool:
+    """Idle keep-alive connections of the HTTP(S) probes, reused from one cycle to the next.
+
+    One pool per event loop, keyed by target and TLS settings. Connections
+    idle for more than HTTP_POOL_IDLE_SECONDS, or already closed by the
+    server, are dropped instead of reused.
+    """
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, idle_seconds=HTTP_POOL_IDLE_SECONDS, per_key=HTTP_POOL_PER_KEY):
+        self.idle_seconds = idle_seconds
+        self.per_key = per_key
+        self._idle = {}
+
+    @classmethod
+    def for_loop(cls, loop):
+        pool = cls._instances.get(loop)
+        if pool is None:
+            pool = cls._instances[loop] = cls()
+        return pool
+
+    def acquire(self, key):
+        connections = self._idle.get(key)
+        now = time.monotonic()
+        while connections:
+            reader, writer, idle_since = connections.pop()
+            if now - idle_since <= self.idle_seconds and not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def release(self, key, reader, writer):
+        connections = self._idle.setdefault(key, [])
+        if len(connections) >= self.per_key:
+            writer.close()
+            return
+        connections.append((reader, writer, time.monotonic()))
+
+def _status_matches(code, expected):
+    """True if `code` matches a comma-separated list of codes, ranges (200-204) and classes (2xx)."""
+    for part in expected.lower().split(','):
+        part = part.strip()
+        low, _, high = part.partition('-')
+        if len(part) == 3 and part.endswith('xx'):
+            if str(code)[0] == part[0]:
+                return True
+        elif low.isdigit() and (high or low).isdigit() and int(low) <= code <= int(high or low):
+            return True
+    return False
+
+async def _http_exchange(reader, writer, request):
+    """Sends one request and reads the response; returns (status, connection_reusable)."""
+    writer.write(request)
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by server")
+    parts = status_line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+        raise ValueError(f"bad status line {status_line[:40]!r}")
+    code = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    reusable = parts[0] == 'HTTP/1.1' and 'close' not in headers.get('connection', '').lower()
+    if code in (204, 304) or 100 <= code < 200:
+        return code, reusable
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        total = 0
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return code, reusable
+            total += size
+            if total > HTTP_MAX_BODY:
+                return code, False
+            await reader.readexactly(size + 2)
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        if length > HTTP_MAX_BODY:
+            return code, False
+        await reader.readexactly(length)
+        return code, reusable
+    return code, False
 
+async def _http_probe(host, port, path, status, server_name, tls, verify):
+    loop = asyncio.get_event_loop()
+    pool = HttpConnectionPool.for_loop(loop)
+    name = server_name or host
+    key = (host, port, tls, name, verify)
+    host_header = f"[{name}]" if ':' in name else name
+    request = (f"GET {path} HTTP/1.1\r\nHost: {host_header}\r\nUser-Agent: realm-health-check\r\n"
+               f"Accept: */*\r\nConnection: keep-alive\r\n\r\n").encode('utf-8')
+    connection = pool.acquire(key)
     while True:
+        reused = connection is not None
+        started = loop.time()
         try:
-            handle_log_rotation()
-            
-            next_run_time = cron.get_next(datetime)
-            
-            sleep_duration = (next_run_time - datetime.now()).total_seconds()
-            if sleep_duration > 0:
-                log(f"Sleeping for {int(sleep_duration)} seconds until next cycle at {next_run_time.strftime('%H:%M:%S')}.")
-                time.sleep(sleep_duration)
-            
-            log(f"--- New Check Cycle --- (Concurrency: {CONCURRENT_CHECKS}, Timeout: {dynamic_timeout}s)")
-            
-            if not os.path.exists(HEALTH_CHECKS_FILE):
-                log("Health checks file not found. Skipping cycle.", "WARN")
+            if connection is None:
+                connection = await asyncio.open_connection(host, int(port), ssl=_ssl_context(verify) if tls else None,
+                                                           server_hostname=name if tls else None)
+            code, reusable = await _http_exchange(connection[0], connection[1], request)
+        except (OSError, ValueError, EOFError) as e:
+            if connection is not None:
+                connection[1].close()
+            if reused:
+                # The server dropped the idle keep-alive connection; retry on a fresh one.
+                connection = None
                 continue
+            return ProbeResult(1, [None], _describe_error(e))
+        except BaseException:
+            if connection is not None:
+                connection[1].close()
+            raise
+        rtt = loop.time() - started
+        if reusable:
+            pool.release(key, *connection)
+        else:
+            connection[1].close()
+        detail = f"HTTP {code}" + (" (reused connection)" if reused else "")
+        if _status_matches(code, status):
+            return ProbeResult(0, [rtt], detail)
+        return ProbeResult(1, [rtt], f"{detail}, expected {status}")
 
-            with open(HEALTH_CHECKS_FILE, 'r', encoding='utf-8') as f:
-                tasks_to_run = [line.strip() for line in f if line.strip() and not line.startswith('#')]
-            
-            if not tasks_to_run:
-                log("No health checks configured. Skipping cycle.")
-                continue
+@probe_plugin("http")
+async def http_probe(host, port, path="/", status="2xx,3xx", server_name=None):
+    """GETs `path` over a pooled keep-alive connection and checks the response status."""
+    return await _http_probe(host, port, path, status, server_name, False, False)
 
-            check_results = []
-            with ThreadPoolExecutor(max_workers=CONCURRENT_CHECKS) as executor:
-                future_to_task = {}
-                for task_line in tasks_to_run:
-                    upstream_addr, script_path = task_line.split('=', 1)
-                    host, port = "", ""
-                    match = re.match(r'^\[(.+)\]:(.+)$', upstream_addr) or re.match(r'^([^:]+):([^:]+)$', upstream_addr)
-                    if match: host, port = match.groups()
-                    else: host = upstream_addr
-                    
-                    future = executor.submit(run_check, script_path, host, str(port), dynamic_timeout)
-                    future_to_task[future] = upstream_addr
-
-                for future in as_completed(future_to_task):
-                    upstream_addr = future_to_task[future]
-                    try:
-                        exit_code = future.result()
-                        check_results.append({'address': upstream_addr, 'exit_code': exit_code})
-                    except Exception as exc:
-                        log(f"Task for '{upstream_addr}' generated an exception: {exc}", "ERROR")
-                        check_results.append({'address': upstream_addr, 'exit_code': 1})
-            
-            success_count = sum(1 for r in check_results if r['exit_code'] == 0)
-            fail_count = len(check_results) - success_count
-            log(f"Check cycle summary: {len(check_results)} total, {success_count} successful, {fail_count} failed.")
+@probe_plugin("https")
+async def https_probe(host, port, path="/", status="2xx,3xx", server_name=None, verify=True):
+    """HTTPS variant of http_probe; `verify=0` accepts any certificate."""
+    return await _http_probe(host, port, path, status, server_name, True, verify)
 
-            upstreams_to_disable = set()
-            upstreams_to_enable = set()
-            state_data = load_json_file(STATE_BACKUP_FILE)
-            
-            current_config_data = parse_toml(REALM_CONFIG_FILE)
-            if not current_config_data:
-                log("Could not parse main config, skipping result processing.", "ERROR")
-                continue
-                
-            active_upstreams = {ep.get('remote') for ep in current_config_data.get('endpoints', []) if ep.get('remote')}
-            for ep in current_config_data.get('endpoints', []):
-                active_upstreams.update(ep.get('extra_remotes', []))
-
-            for result in check_results:
-                address = result['address']
-                exit_code = result['exit_code']
-
-                if exit_code == 0:
-                    if failure_counts.get(address, 0) > 0:
-                        log(f"Upstream '{address}' has RECOVERED.", "INFO")
-                    failure_counts[address] = 0
-                    if address in state_data:
-                        upstreams_to_enable.add(address)
-                else:
-                    failure_counts[address] = failure_counts.get(address, 0) + 1
-                    log(f"Upstream '{address}' FAILED check (Exit code: {exit_code}, Failures: {failure_counts[address]}).", "WARN")
-                    if failure_counts[address] >= FAILURES_TO_DISABLE and address in active_upstreams:
-                        upstreams_to_disable.add(address)
-
-            if upstreams_to_disable or upstreams_to_enable:
-                log("Applying configuration changes...", "INFO")
-                config_data = parse_toml(REALM_CONFIG_FILE)
-                if not config_data:
-                    log("Failed to read config file for modification. Aborting update.", "ERROR")
+@probe_plugin("tls")
+async def tls_probe(host, port, server_name=None, verify=True, min_days=0):
+    """Times a TCP connect plus TLS handshake; with `min_days`, a certificate expiring sooner fails."""
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    try:
+        _, writer = await asyncio.open_connection(host, int(port), ssl=_ssl_context(verify),
+                                                  server_hostname=server_name or host)
+    except (OSError, ValueError) as e:
+        return ProbeResult(1, [None], _describe_error(e))
+    rtt = loop.time() - started
+    try:
+        ssl_object = writer.get_extra_info('ssl_object')
+        detail = ssl_object.version() if ssl_object else "TLS"
+        cert = ssl_object.getpeercert() if ssl_object else None
+        if cert and 'notAfter' in cert:
+            days = (ssl.cert_time_to_seconds(cert['notAfter']) - time.time()) / 86400
+            detail += f", certificate expires in {days:.0f} days"
+            if days < min_days:
+                return ProbeResult(1, [rtt], detail)
+        return ProbeResult(0, [rtt], detail)
+    finally:
+        writer.close()
+
+class _UdpEchoProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self._future = None
+        self._expected = None
+
+    def expect(self, message):
+        self._future = asyncio.get_event_loop().create_future()
+        self._expected = message
+        return self._future
+
+    def datagram_received(self, data, addr):
+        if self._future is not None and not self._future.done() and self._expected in (None, data):
+            self._future.set_result(data)
+
+    def error_received(self, exc):
+        if self._future is not None and not self._future.done():
+            self._future.set_exception(exc)
+
+@probe_plugin("udp")
+async def udp_probe(host, port, payload="realm-health-check", match=True,
+                    attempts=PROBE_ATTEMPTS, threshold=PROBE_SUCCESS_THRESHOLD):
+    """Sends numbered datagrams to a UDP echo service; with `match=0`, any reply counts."""
+    loop = asyncio.get_event_loop()
+    protocol = _UdpEchoProtocol()
+    try:
+        transport, _ = await loop.create_datagram_endpoint(lambda: protocol, remote_addr=(host, int(port)))
+    except (OSError, ValueError) as e:
+        return ProbeResult(1, [None] * attempts, _describe_error(e))
+    latencies = []
+    try:
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(UDP_ECHO_INTERVAL)
+            message = f"{payload} {attempt}".encode('utf-8')
+            reply = protocol.expect(message if match else None)
+            started = loop.time()
+            try:
+                transport.sendto(message)
+                await asyncio.wait_for(reply, UDP_REPLY_TIMEOUT)
+                latencies.append(loop.time() - started)
+            except (OSError, asyncio.TimeoutError):
+                latencies.append(None)
+    finally:
+        transport.close()
+    received = sum(1 for l in latencies if l is not None)
+    return ProbeResult(0 if received >= threshold else 1, latencies, f"{received}/{attempts} echoes")
+
+def _convert_option(value, default):
+    if isinstance(default, bool):
+        if value.lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if value.lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError(value)
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    return value
+
+def parse_probe_options(kind, tokens, host):
+    """Turns a built-in probe's `key=value` tokens into a sorted options tuple, or None if one is invalid."""
+    parameters = inspect.signature(PROBE_PLUGINS[kind]).parameters
+    options = {}
+    for token in tokens:
+        key, sep, value = token.partition('=')
+        parameter = parameters.get(key)
+        if not sep or parameter is None or parameter.default is inspect.Parameter.empty:
+            log(f"Unknown option '{token}' for {BUILTIN_PROBE_PREFIX}{kind}.", "WARN")
+            return None
+        try:
+            options[key] = _convert_option(value, parameter.default)
+        except ValueError:
+            log(f"Invalid value in '{token}' for {BUILTIN_PROBE_PREFIX}{kind}.", "WARN")
+            return None
+    if 'server_name' in parameters and 'server_name' not in options and not is_ip_address(host):
+        options['server_name'] = host
+    return tuple(sorted(options.items()))
+
+async def run_builtin_probe(kind, host, port, timeout, options=()):
+    probe = PROBE_PLUGINS.get(kind)
+    if probe is None:
+        log(f"Unknown built-in probe '{BUILTIN_PROBE_PREFIX}{kind}'.", "ERROR")
+        return ProbeResult(1, [], "unknown probe")
+    if probe.needs_port and not port:
+        log(f"Built-in {kind.upper()} probe requires a port, got host '{host}'.", "ERROR")
+        return ProbeResult(1, [], "no port")
+    try:
+        return await asyncio.wait_for(probe(host, port, **dict(options)), timeout)
+    except asyncio.TimeoutError:
+        return ProbeResult(PROBE_TIMEOUT_EXIT_CODE, [], f"timed out after {timeout:g}s")
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Only touched from the event loop thread, so no locking. Series are keyed by
+    a sorted tuple of label pairs.
+    """
+
+    def __init__(self):
+        self._meta = OrderedDict()
+        self._values = {}
+        self.phase_listener = None
+
+    def define(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+        self._values[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        series = self._values[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = tuple(sorted(labels.items()))
+        state = self._values[name].get(key)
+        if state is None:
+            state = self._values[name][key] = [[0] * len(buckets), 0, 0.0]
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                state[0][index] += 1
+        state[1] += 1
+        state[2] += value
+
+    def retain(self, label, keep):
+        """Drops series whose `label` value is no longer in `keep` (e.g. removed upstreams)."""
+        for series in self._values.values():
+            for key in list(series):
+                labels = dict(key)
+                if label in labels and labels[label] not in keep:
+                    del series[key]
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.observe('realm_health_phase_duration_seconds', elapsed, phase=name)
+            self.set('realm_health_phase_last_duration_seconds', elapsed, phase=name)
+            if self.phase_listener is not None:
+                self.phase_listener(name, elapsed)
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(self._values[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
                     continue
-                
-                state_data = load_json_file(STATE_BACKUP_FILE)
-                config_modified = False
-
-                for addr in upstreams_to_enable:
-                    config_data, state_data, changed = modify_config_logic(config_data, state_data, 'enable', addr)
-                    if changed: config_modified = True
-
-                for addr in upstreams_to_disable:
-                    config_data, state_data, changed = modify_config_logic(config_data, state_data, 'disable', addr)
-                    if changed: config_modified = True
-                
-                if config_modified:
-                    log("Saving modified configuration and state files...")
-                    new_toml_content = serialize_to_toml(config_data)
-                    with open(REALM_CONFIG_FILE, 'w', encoding='utf-8') as f:
-                        f.write(new_toml_content)
-                    save_json_file(state_data, STATE_BACKUP_FILE)
-                    
-                    log("Validating new configuration...")
-                    validation_process = subprocess.run([VENV_PYTHON, VALIDATOR_SCRIPT_PATH, "--file", REALM_CONFIG_FILE])
-                    if validation_process.returncode == 0:
-                        log("Validation successful. Restarting realm service...", "INFO")
-                        subprocess.run(["systemctl", "restart", "realm"])
-                    else:
-                        log("Validation FAILED! Realm service not restarted. Please check config manually.", "ERROR")
-                else:
-                    log("No effective configuration changes were made after processing results.")
+                counts, total, value_sum = value
+                for bound, count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {total}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(value_sum)}")
+                lines.append(f"{name}_count{_format_labels(key)} {total}")
+        return "\n".join(lines) + "\n"
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in key)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(key, escaped)) + "}"
+
+METRICS = MetricsRegistry()
+METRICS.define('realm_health_probe_rtt_seconds', 'histogram', "Round-trip time of successful built-in probe attempts.", RTT_BUCKETS)
+METRICS.define('realm_health_probe_results_total', 'counter', "Health check results by upstream and outcome.")
+METRICS.define('realm_health_consecutive_failures', 'gauge', "Consecutive failed checks per upstream.")
+METRICS.define('realm_health_flap_penalty', 'gauge', "Decaying flap penalty per upstream.")
+METRICS.define('realm_health_flap_suppressed', 'gauge', "1 while an upstream is kept disabled for flapping.")
+METRICS.define('realm_health_probe_backoff_seconds', 'gauge', "Current probe interval of a backed-off disabled upstream (0 when not backed off).")
+METRICS.define('realm_health_phase_duration_seconds', 'histogram', "Time spent in each daemon phase.", PHASE_BUCKETS)
+METRICS.define('realm_health_phase_last_duration_seconds', 'gauge', "Duration of the most recent run of each daemon phase.")
+METRICS.define('realm_health_cycle_duration_seconds', 'histogram', "Wall time of a full check cycle.", PHASE_BUCKETS)
+METRICS.define('realm_health_cycles_total', 'counter', "Check cycles run since the daemon started.")
+METRICS.define('realm_health_last_cycle_timestamp_seconds', 'gauge', "Unix time the last check cycle finished.")
+METRICS.define('realm_health_pool_workers', 'gauge', "Script probes allowed to run at once this cycle (adaptive, CONCURRENT_CHECKS..MAX_CONCURRENT_CHECKS).")
+METRICS.define('realm_health_cycle_overruns_total', 'counter', "Cycles that took longer than their cron period.")
+METRICS.define('realm_health_cycle_overrun_seconds', 'gauge', "How far the last overrunning cycle exceeded its period.")
+METRICS.define('realm_health_pool_busy_workers', 'gauge', "Script probe workers busy right now.")
+METRICS.define('realm_health_pool_peak_busy_workers', 'gauge', "Most script probe workers busy at once during the last cycle.")
+METRICS.define('realm_health_pool_queue_wait_seconds', 'histogram', "Time script probes waited for a free worker.", PHASE_BUCKETS)
+METRICS.define('realm_health_upstream_rtt_ewma_seconds', 'gauge', "Smoothed probe round-trip time per upstream.")
+METRICS.define('realm_health_upstream_loss_ewma_ratio', 'gauge', "Smoothed probe loss ratio per upstream.")
+METRICS.define('realm_health_balance_updates_total', 'counter', "Endpoint balance weight rewrites.")
+METRICS.define('realm_health_probes_deduplicated_total', 'counter', "Probes skipped because another line shared the same target.")
+METRICS.define('realm_health_peer_last_seen_timestamp_seconds', 'gauge', "Unix time the last verdict from each peer arrived.")
+METRICS.define('realm_health_quorum_held_total', 'counter', "Disables held back because the peer quorum did not agree.")
+METRICS.define('realm_health_dns_addresses', 'gauge', "Addresses a probed hostname currently resolves to.")
+METRICS.define('realm_health_dns_ttl_seconds', 'gauge', "Cache lifetime of a hostname's current answer, after clamping.")
+METRICS.define('realm_health_dns_changes_total', 'counter', "Times a probed hostname's resolved address set changed.")
+METRICS.define('realm_health_dns_failures_total', 'counter', "Failed resolutions of a probed hostname.")
+METRICS.define('realm_health_reloads_total', 'counter', "Reloads of watched files after an external change.")
+METRICS.define('realm_health_restarts_total', 'counter', "realm service restarts issued by the daemon.")
+METRICS.define('realm_health_restart_failures_total', 'counter', "realm service restarts that failed and will be retried.")
+METRICS.define('realm_health_restarts_avoided_total', 'counter', "Restarts saved by coalescing decisions.")
+
+class PoolGauge:
+    """Tracks busy/peak workers and queue wait for the script probe thread pool.
+
+    Updated from worker threads under a lock; export() copies the numbers into
+    METRICS from the event loop thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.peak = 0
+        self._waits = []
+
+    def run(self, submitted_at, func, *args):
+        with self._lock:
+            self._waits.append(time.monotonic() - submitted_at)
+            self.busy += 1
+            self.peak = max(self.peak, self.busy)
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+    def export(self, end_of_cycle=False):
+        with self._lock:
+            waits, self._waits = self._waits, []
+            busy, peak = self.busy, self.peak
+            if end_of_cycle:
+                self.peak = self.busy
+        for wait in waits:
+            METRICS.observe('realm_health_pool_queue_wait_seconds', wait)
+        METRICS.set('realm_health_pool_busy_workers', busy)
+        if end_of_cycle:
+            METRICS.set('realm_health_pool_peak_busy_workers', peak)
+
+POOL_GAUGE = PoolGauge()
+
+def record_probe_metrics(check_results, health):
+    for result in check_results:
+        address = result['address']
+        outcome = 'success' if result['exit_code'] == 0 else ('timeout' if result.get('status') == 'timeout' else 'failure')
+        METRICS.inc('realm_health_probe_results_total', address=address, result=outcome)
+        for rtt in result['latencies']:
+            if rtt is not None:
+                METRICS.observe('realm_health_probe_rtt_seconds', rtt, address=address)
+        METRICS.set('realm_health_consecutive_failures', health[address].failures if address in health else 0, address=address)
+
+def write_metrics_textfile():
+    if not METRICS_TEXTFILE:
+        return
+    POOL_GAUGE.export()
+    try:
+        write_file_atomic(METRICS_TEXTFILE, METRICS.render())
+    except (IOError, OSError) as e:
+        log(f"Could not write metrics textfile {METRICS_TEXTFILE}: {e}", "WARN")
+
+async def start_metrics_server():
+    """Serves METRICS.render() at http://METRICS_LISTEN/metrics."""
+    if not METRICS_LISTEN:
+        return None
+
+    async def on_client(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?')[0] in ("/metrics", "/"):
+                POOL_GAUGE.export()
+                status, body = "200 OK", METRICS.render().encode('utf-8')
             else:
-                 log("All checks passed or no action required.")
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
 
+    host, port = split_host_port(METRICS_LISTEN)
+    try:
+        server = await asyncio.start_server(on_client, host or None, int(port))
+    except (OSError, ValueError) as e:
+        log(f"Metrics listener unavailable on {METRICS_LISTEN}: {e}", "WARN")
+        return None
+    log(f"Serving metrics on http://{METRICS_LISTEN}/metrics.")
+    return server
 
-        except Exception as e:
-            log(f"An unexpected error occurred in the daemon loop: {e}", "ERROR")
-            time.sleep(60)
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
 
-def main():
-    parser = argparse.ArgumentParser(description="Realm Health Checker and Tools.")
-    parser.add_argument("--action", required=True, choices=["start_daemon", "disable", "enable", "parse_upstreams", "validate"], help="Action to perform.")
-    parser.add_argument("--file", help="Path to the realm config file.")
-    parser.add_argument("--address", help="The upstream address to act upon for disable/enable actions.")
-    parser.add_argument("--state-file", help="Path to the state backup JSON file.")
-    
-    args = parser.parse_args()
+def read_nameservers(path=RESOLV_CONF):
+    nameservers = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver" and is_ip_address(fields[1]):
+                    nameservers.append(fields[1])
+    except OSError:
+        pass
+    return nameservers
 
-    if args.action == "start_daemon":
-        health_check_daemon()
-    elif args.action in ["disable", "enable"]:
-        if not all([args.file, args.address, args.state_file]):
-            sys.exit(1)
-        perform_modification(args.file, args.action, args.address, args.state_file)
-    elif args.action == "parse_upstreams":
-        if not args.file:
+def build_dns_query(query_id, hostname, qtype):
+    name = b''.join(bytes([len(label)]) + label for label in hostname.rstrip('.').encode('idna').split(b'.'))
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + name + b'\x00' + struct.pack('!HH', qtype, 1)
+
+def _skip_dns_name(data, offset):
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+def parse_dns_response(data):
+    """Returns (query_id, rcode, truncated, [(address, ttl)]) for the A/AAAA answers in a response."""
+    query_id, flags, question_count, answer_count = struct.unpack_from('!HHHH', data)
+    offset = 12
+    for _ in range(question_count):
+        offset = _skip_dns_name(data, offset) + 4
+    answers = []
+    for _ in range(answer_count):
+        offset = _skip_dns_name(data, offset)
+        record_type, _, ttl, length = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        rdata = data[offset:offset + length]
+        offset += length
+        if record_type == DNS_TYPE_A and length == 4:
+            answers.append((socket.inet_ntop(socket.AF_INET, rdata), ttl))
+        elif record_type == DNS_TYPE_AAAA and length == 16:
+            answers.append((socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    return query_id, flags & 0x000F, bool(flags & 0x0200), answers
+
+class DnsClient(asyncio.DatagramProtocol):
+    """Minimal stub resolver that keeps record TTLs, which getaddrinfo() hides.
+
+    Queries go over one UDP socket per address family to the nameservers from
+    /etc/resolv.conf, tried in order; replies are matched by query id and
+    source address.
+    """
+
+    def __init__(self, nameservers, timeout=DNS_QUERY_TIMEOUT):
+        self.nameservers = nameservers
+        self.timeout = timeout
+        self._transports = {}
+        self._pending = {}
+
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        for nameserver in self.nameservers:
+            family = socket.AF_INET6 if ':' in nameserver else socket.AF_INET
+            if family not in self._transports:
+                self._transports[family], _ = await loop.create_datagram_endpoint(lambda: self, family=family)
+
+    def close(self):
+        for transport in self._transports.values():
+            transport.close()
+        self._transports.clear()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def datagram_received(self, data, addr):
+        try:
+            query_id, rcode, truncated, answers = parse_dns_response(data)
+        except (IndexError, struct.error, ValueError):
+            return
+        future = self._pending.get(query_id)
+        if future is not None and not future.done() and future.nameserver == addr[0]:
+            future.set_result((rcode, truncated, answers))
+
+    async def query(self, hostname, qtype):
+        """Returns [(address, ttl)] ([] for NXDOMAIN or no data), or None if no nameserver gave a usable answer."""
+        loop = asyncio.get_event_loop()
+        for nameserver in self.nameservers:
+            transport = self._transports.get(socket.AF_INET6 if ':' in nameserver else socket.AF_INET)
+            if transport is None:
+                continue
+            query_id = random.randrange(0x10000)
+            while query_id in self._pending:
+                query_id = random.randrange(0x10000)
+            future = loop.create_future()
+            future.nameserver = nameserver
+            self._pending[query_id] = future
+            try:
+                transport.sendto(build_dns_query(query_id, hostname, qtype), (nameserver, 53))
+                rcode, truncated, answers = await asyncio.wait_for(future, self.timeout)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                continue
+            finally:
+                self._pending.pop(query_id, None)
+            if rcode == 3:
+                return []
+            if rcode == 0 and not truncated:
+                return answers
+        return None
+
+class DnsCache:
+    """Resolves the hostnames probed in a cycle and caches them for their TTL.
+
+    refresh() resolves every expired hostname concurrently, A and AAAA in
+    parallel, and keeps the answer for its smallest record TTL clamped to
+    [min_ttl, max_ttl] (realm's own `[dns]` settings when present). Names the
+    DNS client cannot answer, such as hosts-file entries, fall back to
+    getaddrinfo() and are kept for min_ttl. A failed lookup keeps serving the
+    previous answer.
+    """
+
+    def __init__(self, min_ttl=DNS_MIN_TTL, max_ttl=DNS_MAX_TTL, clock=time.monotonic):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._clock = clock
+        self._entries = {}
+
+    def configure(self, dns_section):
+        self.min_ttl = float(dns_section.get('min_ttl', DNS_MIN_TTL))
+        self.max_ttl = max(self.min_ttl, float(dns_section.get('max_ttl', DNS_MAX_TTL)))
+
+    def lookup(self, host):
+        """The address to probe for `host`: its first cached address, or `host` itself."""
+        entry = self._entries.get(host)
+        return entry[0][0] if entry else host
+
+    def retain(self, hosts):
+        for host in [h for h in self._entries if h not in hosts]:
+            del self._entries[host]
+
+    async def _resolve(self, client, host):
+        if client is not None:
+            answers = [a for result in await asyncio.gather(client.query(host, DNS_TYPE_A), client.query(host, DNS_TYPE_AAAA))
+                       for a in result or []]
+            if answers:
+                return list(OrderedDict.fromkeys(address for address, _ in answers)), min(ttl for _, ttl in answers)
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError):
+            return None, None
+        return list(OrderedDict.fromkeys(info[4][0] for info in infos)), self.min_ttl
+
+    async def refresh(self, hosts):
+        now = self._clock()
+        due = sorted(h for h in set(hosts) if not is_ip_address(h) and (h not in self._entries or self._entries[h][1] <= now))
+        if not due:
+            return
+        nameservers = read_nameservers()
+        client = DnsClient(nameservers) if nameservers else None
+        try:
+            if client is not None:
+                await client.open()
+            resolved = await asyncio.gather(*(self._resolve(client, host) for host in due))
+        except OSError as e:
+            log(f"DNS client unavailable: {e}", "WARN")
+            resolved = await asyncio.gather(*(self._resolve(None, host) for host in due))
+        finally:
+            if client is not None:
+                client.close()
+
+        now = self._clock()
+        for host, (addresses, ttl) in zip(due, resolved):
+            previous = self._entries.get(host)
+            if not addresses:
+                METRICS.inc('realm_health_dns_failures_total', host=host)
+                if previous:
+                    log(f"Could not resolve '{host}'; keeping its previous answer {', '.join(previous[0])}.", "WARN")
+                    self._entries[host] = (previous[0], now + self.min_ttl)
+                else:
+                    log(f"Could not resolve '{host}'.", "WARN")
+                continue
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+            self._entries[host] = (tuple(addresses), now + ttl)
+            if previous and set(previous[0]) != set(addresses):
+                log(f"'{host}' now resolves to {', '.join(addresses)} (was {', '.join(previous[0])}).",
+                    event="dns_changed", host=host, addresses=addresses, previous=list(previous[0]))
+                METRICS.inc('realm_health_dns_changes_total', host=host)
+            METRICS.set('realm_health_dns_addresses', len(addresses), host=host)
+            METRICS.set('realm_health_dns_ttl_seconds', ttl, host=host)
+
+    def status(self):
+        now = self._clock()
+        return {host: {'addresses': list(addresses), 'expires_in': round(max(0.0, expires - now), 1)}
+                for host, (addresses, expires) in self._entries.items()}
+
+def probe_key(task):
+    """Canonical identity of what a task actually probes.
+
+    ICMP and scripts listed in HOST_ONLY_PROBE_SCRIPTS (ping_check.sh) ignore
+    the port, so lines that differ only in port share one probe.
+    """
+    if task.kind == "script":
+        host_only = os.path.basename(task.probe) in HOST_ONLY_PROBE_SCRIPTS
+    else:
+        host_only = not PROBE_PLUGINS[task.kind].needs_port
+    return (task.probe, task.options, task.host.lower(), "" if host_only else str(task.port))
+
+def group_probe_tasks(scheduled_tasks):
+    """Collapses (delay, ProbeTask) pairs into [(delay, representative, members)], one per probe_key().
+
+    The shared probe starts at the earliest member's delay and gets the
+    longest member timeout, so no line is checked more strictly than it asked.
+    """
+    groups = OrderedDict()
+    for delay, task in scheduled_tasks:
+        groups.setdefault(probe_key(task), []).append((delay, task))
+    collapsed = []
+    for members in groups.values():
+        delay = min(d for d, _ in members)
+        representative = members[0][1]._replace(timeout=max(t.timeout for _, t in members))
+        collapsed.append((delay, representative, [t for _, t in members]))
+    return collapsed
+
+async def run_probe_tasks(scheduled_tasks, executor, on_result=None, deadline=None, script_limit=None):
+    """Runs (launch_delay, ProbeTask) pairs on the current event loop.
+
+    Tasks with the same probe_key() are probed once and the result is fanned
+    out to every address (copies are marked 'shared'). Built-in probes run as
+    coroutines; script probes are handed to `executor`, at most `script_limit`
+    at a time when given. `on_result`, if given, is a coroutine function
+    awaited with each result as soon as it completes. Probes still running at
+    `deadline` (event loop time) are abandoned and reported with status
+    'timeout' instead of holding up the cycle.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(BUILTIN_PROBE_CONCURRENCY)
+    script_semaphore = asyncio.Semaphore(script_limit) if script_limit else None
+    groups = group_probe_tasks(scheduled_tasks)
+    saved = len(scheduled_tasks) - len(groups)
+    if saved:
+        METRICS.inc('realm_health_probes_deduplicated_total', saved)
+        log(f"{len(scheduled_tasks)} checks share {len(groups)} unique probes; {saved} duplicate probe(s) skipped.", "DEBUG")
+
+    async def fan_out(members, result, status, duration):
+        check_results = [{'address': task.address, 'probe': task.probe, 'exit_code': result.exit_code,
+                          'latencies': result.latencies, 'detail': result.detail, 'status': status,
+                          'duration': duration, 'shared': index > 0}
+                         for index, task in enumerate(members)]
+        if on_result is not None:
+            for check_result in check_results:
+                await on_result(check_result)
+        return check_results
+
+    async def run_script(task):
+        return await loop.run_in_executor(executor, POOL_GAUGE.run, time.monotonic(),
+                                          run_script_probe, task.probe, task.host, str(task.port), task.timeout)
+
+    async def run_one(delay, task, members):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        started = loop.time()
+        try:
+            if task.kind != "script":
+                async with semaphore:
+                    result = await run_builtin_probe(task.kind, task.host, task.port, task.timeout, task.options)
+            elif script_semaphore is not None:
+                async with script_semaphore:
+                    started = loop.time()
+                    result = await run_script(task)
+            else:
+                result = await run_script(task)
+        except Exception as exc:
+            log(f"Task for '{task.address}' generated an exception: {exc}", "ERROR")
+            result = ProbeResult(1, [], str(exc))
+        return await fan_out(members, result, 'ok' if result.exit_code == 0 else 'failed', loop.time() - started)
+
+    launched_at = loop.time()
+    futures = [asyncio.ensure_future(run_one(delay, task, members)) for delay, task, members in groups]
+    try:
+        if deadline is None:
+            return [r for group_results in await asyncio.gather(*futures) for r in group_results]
+        _, pending = await asyncio.wait(futures, timeout=max(0.0, deadline - loop.time())) if futures else (set(), set())
+        results = []
+        for future, (delay, task, members) in zip(futures, groups):
+            if future in pending:
+                future.cancel()
+                # The duration is a lower bound: the probe had been running (or queued) this long.
+                elapsed = max(0.0, loop.time() - launched_at - delay)
+                results.extend(await fan_out(members, ProbeResult(PROBE_TIMEOUT_EXIT_CODE, [], "still running at the cycle deadline"),
+                                             'timeout', elapsed))
+            else:
+                results.extend(future.result())
+        return results
+    finally:
+        for future in futures:
+            future.cancel()
+
+class ConcurrencyController:
+    """Sizes the script probe concurrency for each cycle from its deadline.
+
+    Keeps an EWMA of how long script probes actually take and picks enough
+    parallel slots for this cycle's script tasks to finish within the budget,
+    between `floor` (CONCURRENT_CHECKS) and `ceiling` (the pool size).
+    """
+
+    def __init__(self, floor, ceiling, alpha=0.2):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.alpha = alpha
+        self.estimate = None
+        self.limit = self.floor
+
+    def observe(self, check_results):
+        for result in check_results:
+            if result['probe'].startswith(BUILTIN_PROBE_PREFIX) or result['duration'] is None or result['shared']:
+                continue
+            duration = result['duration']
+            self.estimate = duration if self.estimate is None else self.estimate + self.alpha * (duration - self.estimate)
+
+    def size(self, tasks, budget_seconds):
+        script_tasks = [task for task in tasks if task.kind == "script"]
+        if not script_tasks:
+            self.limit = self.floor
+            return self.limit
+        # Until a probe has been timed, assume the worst case: every script runs to its timeout.
+        per_task = self.estimate if self.estimate is not None else max(task.timeout for task in script_tasks)
+        needed = int(-(-len(script_tasks) * per_task * 1.5 // max(budget_seconds, 0.001)))
+        self.limit = max(self.floor, min(self.ceiling, needed))
+        return self.limit
+
+def parse_health_check_line(line, default_interval, default_timeout):
+    """Parses 'address=probe [key=value ...] [interval=N] [timeout=N]' into a ProbeTask.
+
+    For scripts, options are only recognised as trailing tokens, so script
+    paths keep working as before. Built-in probes also take their own
+    `key=value` options, checked against the plugin here. `interval` cannot be
+    shorter than the cron period, which is the scheduler's granularity.
+    """
+    if '=' not in line:
+        return None
+    address, probe = line.split('=', 1)
+    options = {}
+    probe = probe.strip()
+    while True:
+        parts = probe.rsplit(None, 1)
+        option_match = HEALTH_CHECK_OPTION_PATTERN.match(parts[-1]) if len(parts) == 2 else None
+        if not option_match:
+            break
+        options.setdefault(option_match.group(1), float(option_match.group(2)))
+        probe = parts[0]
+    if not probe:
+        return None
+    host, port = split_host_port(address)
+    kind, probe_options = "script", ()
+    if probe.startswith(BUILTIN_PROBE_PREFIX):
+        tokens = probe.split()
+        probe, kind = tokens[0], tokens[0][len(BUILTIN_PROBE_PREFIX):]
+        if kind not in PROBE_PLUGINS:
+            log(f"Unknown built-in probe '{probe}' for '{address}'.", "WARN")
+            return None
+        plugin_tokens = []
+        for token in reversed(tokens[1:]):
+            option_match = HEALTH_CHECK_OPTION_PATTERN.match(token)
+            if option_match:
+                options.setdefault(option_match.group(1), float(option_match.group(2)))
+            else:
+                plugin_tokens.insert(0, token)
+        probe_options = parse_probe_options(kind, plugin_tokens, host)
+        if probe_options is None:
+            return None
+
+    interval = options.get('interval', default_interval)
+    if interval < default_interval:
+        log(f"Interval {interval:g}s for '{address}' is shorter than the cycle period; using {default_interval:g}s.", "WARN")
+        interval = default_interval
+    return ProbeTask(address, probe, kind, host, port, probe_options, interval, options.get('timeout', default_timeout))
+
+def load_probe_tasks(file_path, default_interval, default_timeout, line_number=None):
+    """Parses the health checks file; `line_number` (1-based) selects a single line."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for index, line in enumerate(f, 1)
+                 if line.strip() and not line.startswith('#') and line_number in (None, index)]
+    tasks = []
+    for line in lines:
+        task = parse_health_check_line(line, default_interval, default_timeout)
+        if task is None:
+            log(f"Ignoring malformed health check line: '{line}'", "WARN")
+            continue
+        tasks.append(task)
+    return tasks
+
+def compile_task_table(file_path, default_interval, default_timeout):
+    """Parses the health checks file once into an immutable TaskTable, or None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    tasks = tuple(load_probe_tasks(file_path, default_interval, default_timeout))
+    return TaskTable(tasks, frozenset(task.address for task in tasks), frozenset(task.host for task in tasks))
+
+async def stream_check_now(tasks, state_data, send):
+    """Probes every task at once, sending each verdict as it lands and then a summary.
+
+    Verdicts are 'healthy', 'failed', or 'recovered' (healthy and currently
+    held in the state backup). Used by both the control socket and the
+    standalone --action check_now.
+    """
+    failed, passed = set(), set()
+
+    async def on_result(check_result):
+        if check_result['exit_code'] == 0:
+            passed.add(check_result['address'])
+            verdict = 'recovered' if check_result['address'] in state_data else 'healthy'
+        else:
+            failed.add(check_result['address'])
+            verdict = 'failed'
+        await send(dict(check_result, verdict=verdict))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(MANUAL_CHECK_CONCURRENCY, len(tasks))))
+    try:
+        await run_probe_tasks([(0, task) for task in tasks], executor, on_result)
+    finally:
+        executor.shutdown(wait=False)
+    await send({'done': True, 'checked': len(tasks), 'failed': sorted(failed),
+                'recovered': sorted(addr for addr in passed - failed if addr in state_data)})
+
+class ProbeScheduler:
+    """Decides which health check lines run in a cycle, and when within it.
+
+    A min-heap keyed by next due time holds one entry per (address, probe,
+    options), so lines with a longer `interval=` only come up every few cycles
+    and new lines are staggered across their interval. The tasks due in a cycle are launched
+    evenly (plus jitter) over the first `spread_seconds` of the cycle instead of
+    all at once on the cron tick. An address can be backed off to a longer
+    interval; lifting the backoff makes its lines due again immediately.
+    """
+
+    def __init__(self, spread_seconds, jitter=PROBE_JITTER):
+        self.spread_seconds = spread_seconds
+        self.jitter = jitter
+        self._heap = []
+        self._tasks = {}
+        self._generations = {}
+        self._backoff = {}
+        self._synced = None
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def sync(self, tasks, now, stagger=True):
+        """Adopts the current task list and returns how many lines are new.
+
+        Removed lines are dropped lazily from the heap. New lines are spread
+        over their interval, or due right away when `stagger` is false. The
+        same task tuple is only processed once.
+        """
+        if tasks is self._synced:
+            return 0
+        self._synced = tasks
+        current = OrderedDict(((task.address, task.probe, task.options), task) for task in tasks)
+        for key in list(self._generations):
+            if key not in current:
+                del self._generations[key]
+        added = 0
+        for key, task in current.items():
+            if key not in self._generations:
+                added += 1
+                generation = self._generations[key] = next(self._counter)
+                due = now + (random.uniform(0, max(task.interval, self._backoff.get(task.address, 0))) if stagger else 0)
+                heapq.heappush(self._heap, (due, next(self._counter), key, generation))
+        self._tasks = current
+        live = {key[0] for key in current}
+        for address in [a for a in self._backoff if a not in live]:
+            del self._backoff[address]
+        return added
+
+    def backoff(self, address):
+        return self._backoff.get(address, 0)
+
+    def set_backoff(self, address, seconds, now):
+        """Probes `address` at most every `seconds`; 0 lifts the backoff and rechecks it right away."""
+        if seconds > 0:
+            self._backoff[address] = seconds
+            return
+        if self._backoff.pop(address, None) is None:
+            return
+        for key in self._tasks:
+            if key[0] == address:
+                generation = self._generations[key] = next(self._counter)
+                heapq.heappush(self._heap, (now, next(self._counter), key, generation))
+
+    def pop_due(self, cycle_start, cycle_end):
+        """Returns [(launch_delay, task)] for tasks due before `cycle_end` and reschedules them."""
+        due_tasks = []
+        while self._heap and self._heap[0][0] < cycle_end:
+            due, _, key, generation = heapq.heappop(self._heap)
+            if self._generations.get(key) != generation:
+                continue
+            task = self._tasks[key]
+            due_tasks.append(task)
+            interval = max(task.interval, self._backoff.get(task.address, 0))
+            heapq.heappush(self._heap, (max(due, cycle_start) + interval, next(self._counter), key, generation))
+
+        slot = self.spread_seconds / len(due_tasks) if due_tasks else 0
+        return [(slot * (i + random.uniform(0, self.jitter)), task) for i, task in enumerate(due_tasks)]
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        pending = [task for task in all_tasks(loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        # The pinger is shared by every probe run on this loop (scheduled cycles and
+        # control-socket checks alike), so it only goes away with the loop itself.
+        IcmpPinger.close_for_loop(loop)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+class ConfigModel:
+    """In-memory realm config with reverse indexes over its endpoints.
+
+    Endpoints are kept in file order under stable slot ids, with indexes from
+    remote address and from listen address to slots. enable/disable touch only
+    the endpoints involved and update the indexes incrementally, instead of
+    rescanning the whole endpoint list for every address.
+    """
+
+    def __init__(self, config_data):
+        self.sections = OrderedDict((k, v) for k, v in config_data.items() if k != 'endpoints')
+        self._endpoints = OrderedDict()
+        self._by_remote = {}
+        self._by_listen = {}
+        self._next_slot = 0
+        for endpoint in config_data.get('endpoints', []):
+            self._add(endpoint)
+
+    @staticmethod
+    def remotes_of(endpoint):
+        return ([endpoint.get('remote')] if 'remote' in endpoint else []) + endpoint.get('extra_remotes', [])
+
+    @staticmethod
+    def balance_of(endpoint):
+        """Returns (strategy, [weight strings]) from the endpoint's `balance` field."""
+        weights, strategy = [], "roundrobin"
+        if 'balance' in endpoint:
+            balance_match = BALANCE_PATTERN.search(endpoint['balance'])
+            if balance_match:
+                strategy = balance_match.group(1).strip()
+                weights = [w.strip() for w in balance_match.group(2).split(',')]
+        return strategy, weights
+
+    @staticmethod
+    def format_balance(strategy, weights):
+        return f"{strategy}: {', '.join(str(w) for w in weights)}"
+
+    def _index(self, slot, remotes, add):
+        for remote in remotes:
+            if add:
+                self._by_remote.setdefault(remote, set()).add(slot)
+            else:
+                slots = self._by_remote.get(remote)
+                if slots is not None:
+                    slots.discard(slot)
+                    if not slots:
+                        del self._by_remote[remote]
+
+    def _add(self, endpoint):
+        slot = self._next_slot
+        self._next_slot += 1
+        self._endpoints[slot] = endpoint
+        self._index(slot, self.remotes_of(endpoint), True)
+        self._by_listen.setdefault(endpoint.get('listen'), set()).add(slot)
+        return slot
+
+    def _remove(self, slot):
+        endpoint = self._endpoints.pop(slot)
+        self._index(slot, self.remotes_of(endpoint), False)
+        listen_slots = self._by_listen[endpoint.get('listen')]
+        listen_slots.discard(slot)
+        if not listen_slots:
+            del self._by_listen[endpoint.get('listen')]
+
+    def endpoints(self):
+        return list(self._endpoints.values())
+
+    def to_data(self):
+        data = OrderedDict(self.sections)
+        data['endpoints'] = self.endpoints()
+        return data
+
+    def active_upstreams(self):
+        """Every address currently used as a remote or extra remote."""
+        return {remote for remote in self._by_remote if remote}
+
+    def listen_addresses(self):
+        return {listen for listen in self._by_listen if listen}
+
+    def endpoints_for(self, address):
+        return [self._endpoints[slot] for slot in sorted(self._by_remote.get(address, ()))]
+
+    def apply(self, action, address, state_data):
+        if action == "enable":
+            return self.enable(address, state_data)
+        if action == "disable":
+            return self.disable(address, state_data)
+        return False
+
+    def enable(self, address, state_data):
+        if address not in state_data:
+            return False
+
+        log(f"Restoring configuration for recovered upstream: '{address}'", "INFO")
+
+        blocks_to_restore_info = state_data[address]
+        for listen_addr in {info['listen'] for info in blocks_to_restore_info}:
+            for slot in list(self._by_listen.get(listen_addr, ())):
+                self._remove(slot)
+
+        for info in blocks_to_restore_info:
+            self._add(json.loads(info['original_block'], object_pairs_hook=OrderedDict))
+
+        del state_data[address]
+        return True
+
+    def disable(self, address, state_data):
+        config_changed = False
+
+        for slot in sorted(self._by_remote.get(address, ()), reverse=True):
+            target_endpoint = self._endpoints[slot]
+            listen_addr = target_endpoint.get("listen")
+
+            if not listen_addr: continue
+
+            backup_list = state_data.get(address, [])
+            if not any(item['listen'] == listen_addr for item in backup_list):
+                 backup_list.append({
+                    "listen": listen_addr,
+                    "original_block": json.dumps(target_endpoint)
+                })
+            state_data[address] = backup_list
+
+            full_remotes_list = self.remotes_of(target_endpoint)
+            original_remotes = list(full_remotes_list)
+
+            strategy, weights = self.balance_of(target_endpoint)
+
+            if weights and len(weights) != len(full_remotes_list):
+                log(f"Error: 权重数量({len(weights)})与节点数量({len(full_remotes_list)})不匹配，跳过此块。", "ERROR")
+                continue
+
+            if len(full_remotes_list) <= 1:
+                log(f"规则 '{listen_addr}' 中唯一的上游 '{address}' 失效，将移除整个规则。", "WARN")
+                self._remove(slot)
+            else:
+                failed_index = full_remotes_list.index(address)
+                full_remotes_list.pop(failed_index)
+                if weights and failed_index < len(weights):
+                    weights.pop(failed_index)
+
+                target_endpoint['remote'] = full_remotes_list.pop(0)
+                if full_remotes_list:
+                    target_endpoint['extra_remotes'] = full_remotes_list
+                elif 'extra_remotes' in target_endpoint:
+                    del target_endpoint['extra_remotes']
+
+                if full_remotes_list and weights:
+                    target_endpoint['balance'] = self.format_balance(strategy, weights)
+                elif 'balance' in target_endpoint:
+                    del target_endpoint['balance']
+
+                self._index(slot, original_remotes, False)
+                self._index(slot, self.remotes_of(target_endpoint), True)
+
+            config_changed = True
+
+        return config_changed
+
+    def weighted_endpoints(self):
+        """Yields (listen, remotes, weights) for endpoints with a per-remote `balance` weight list."""
+        for endpoint in self._endpoints.values():
+            remotes = self.remotes_of(endpoint)
+            _, weights = self.balance_of(endpoint)
+            if endpoint.get('listen') and len(remotes) > 1 and len(weights) == len(remotes):
+                try:
+                    yield endpoint['listen'], remotes, [int(w) for w in weights]
+                except ValueError:
+                    continue
+
+    def set_balance_weights(self, listen, weights_by_remote):
+        """Rewrites `balance` weights for the endpoints on `listen`; remotes missing from the map are left alone."""
+        changed = False
+        for slot in sorted(self._by_listen.get(listen, ())):
+            endpoint = self._endpoints[slot]
+            remotes = self.remotes_of(endpoint)
+            strategy, weights = self.balance_of(endpoint)
+            if len(weights) != len(remotes) or not all(r in weights_by_remote for r in remotes):
+                continue
+            balance = self.format_balance(strategy, [weights_by_remote[r] for r in remotes])
+            if endpoint.get('balance') != balance:
+                endpoint['balance'] = balance
+                changed = True
+        return changed
+
+def load_config_model(filepath):
+    config_data = parse_toml(filepath)
+    return ConfigModel(config_data) if config_data else None
+
+def stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class CachedFile:
+    """Keeps a parsed file in memory until its (inode, mtime, size) signature changes."""
+
+    def __init__(self, path, loader):
+        self.path = path
+        self._loader = loader
+        self._signature = None
+        self._value = None
+
+    def _stat_signature(self):
+        return stat_signature(self.path)
+
+    def changed(self):
+        """True if the next get() will reload the file."""
+        signature = self._stat_signature()
+        return signature is None or signature != self._signature
+
+    def get(self):
+        signature = self._stat_signature()
+        if signature is None or signature != self._signature:
+            self._value = self._loader(self.path)
+            self._signature = signature
+        return self._value
+
+    def store(self, value):
+        """Records `value` as the parsed form of what we just wrote to the file."""
+        self._value = value
+        self._signature = self._stat_signature()
+
+    def invalidate(self):
+        self._signature = None
+        self._value = None
+
+class FileWatcher:
+    """Calls `on_change(path)` on the event loop when a watched file is written, replaced or removed.
+
+    Watches the files' directories through inotify (via ctypes), so editors
+    that save by rename and our own atomic writes are seen too. Bursts of
+    events for one file are coalesced over WATCH_DEBOUNCE seconds. Where
+    inotify is unavailable, stat signatures are polled every
+    WATCH_POLL_INTERVAL seconds instead.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, paths, on_change, poll_interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE):
+        self.paths = {os.path.abspath(path) for path in paths}
+        self._on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._fd = None
+        self._directories = {}
+        self._scheduled = set()
+        self._poll_task = None
+        self.mode = None
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        try:
+            self._start_inotify(loop)
+            self.mode = "inotify"
+        except (OSError, AttributeError) as e:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            log(f"inotify unavailable ({e}); polling watched files every {self.poll_interval:g}s.", "WARN")
+            self._poll_task = loop.create_task(self._poll())
+            self.mode = "poll"
+
+    def _start_inotify(self, loop):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._fd = fd
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            wd = libc.inotify_add_watch(fd, directory.encode(), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"{directory}: {os.strerror(errno)}")
+            self._directories[wd] = directory
+        loop.add_reader(fd, self._on_readable)
+
+    def _on_readable(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            offset = 0
+            while offset + self.EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\x00').decode('utf-8', 'replace')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.update(self.paths)
+                elif wd in self._directories:
+                    path = os.path.join(self._directories[wd], name)
+                    if path in self.paths:
+                        changed.add(path)
+        for path in changed:
+            self._schedule(path)
+
+    def _schedule(self, path):
+        if path in self._scheduled:
+            return
+        self._scheduled.add(path)
+        asyncio.get_event_loop().call_later(self.debounce, self._fire, path)
+
+    def _fire(self, path):
+        self._scheduled.discard(path)
+        try:
+            self._on_change(path)
+        except Exception as e:
+            log(f"Error while reloading '{path}': {e}", "ERROR")
+
+    async def _poll(self):
+        signatures = {path: stat_signature(path) for path in self.paths}
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for path in self.paths:
+                signature = stat_signature(path)
+                if signature != signatures[path]:
+                    signatures[path] = signature
+                    self._fire(path)
+
+    def close(self):
+        if self._fd is not None:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+
+def perform_modification(config_file, action, address, state_file):
+    model = load_config_model(config_file)
+    if not model:
+        log(f"无法解析配置文件: {config_file}", "ERROR")
+        return False
+    
+    state_data = load_json_file(state_file)
+    
+    modified = model.apply(action, address, state_data)
+
+    if modified:
+        log(f"配置已更新 (操作: {action}, 地址: {address})。正在写回文件...")
+        new_toml_content = serialize_to_toml(model.to_data())
+        return write_config_and_state(config_file, new_toml_content, state_file, state_data)
+    else:
+        return False
+
+def perform_batch_modification(config_file, operations, state_file):
+    """Applies (action, address) pairs to one parsed model and writes config and state once.
+
+    Returns [(action, address, changed), ...] in input order, or None if
+    nothing could be written.
+    """
+    model = load_config_model(config_file)
+    if not model:
+        log(f"无法解析配置文件: {config_file}", "ERROR")
+        return None
+
+    state_data = load_json_file(state_file)
+    summary = [(action, address, model.apply(action, address, state_data)) for action, address in operations]
+
+    if any(changed for _, _, changed in summary):
+        log(f"批量更新配置 ({len(operations)} 项操作)。正在写回文件...")
+        new_toml_content = serialize_to_toml(model.to_data())
+        if not write_config_and_state(config_file, new_toml_content, state_file, state_data):
+            return None
+    return summary
+
+def print_apply_summary(summary):
+    labels = {"enable": "已启用", "disable": "已禁用"}
+    for action, address, changed in summary:
+        if changed:
+            print(f"{labels[action]}: {address}")
+        else:
+            print(f"无变化 ({action}): {address}")
+    print(f"共 {len(summary)} 项操作，{sum(1 for _, _, changed in summary if changed)} 项生效。")
+
+def parse_apply_operations(args):
+    """Collects batch operations from --enable/--disable flags, or a JSON list on stdin."""
+    if args.enable or args.disable:
+        return [("enable", addr) for addr in args.enable or ()] + [("disable", addr) for addr in args.disable or ()]
+    try:
+        items = json.load(sys.stdin)
+        operations = [(item['action'], item['address']) for item in items]
+    except (ValueError, KeyError, TypeError) as e:
+        log(f"无法解析标准输入中的操作列表: {e}", "ERROR")
+        return None
+    for action, _ in operations:
+        if action not in ("enable", "disable"):
+            log(f"不支持的操作: {action}", "ERROR")
+            return None
+    return operations
+
+def parse_and_print_upstreams(config_file):
+    model = load_config_model(config_file)
+    if not model:
+        sys.exit(1)
+
+    for upstream in sorted(model.active_upstreams()):
+        print(upstream)
+
+class HistoryRing:
+    """Per-upstream probe history in a fixed-size memory-mapped file.
+
+    The file is a header followed by `slots` equal slots. A slot holds an
+    upstream address, its write cursor and record count, and a ring of
+    `entries` 8-byte records (unix time, RTT in 0.1 ms units or 0xFFFF, status).
+    An address claims a free slot on its first write; once all are taken, the
+    slot written longest ago is recycled. Readers map the file read-only
+    without locking, so at worst they see one record mid-write.
+    """
+    MAGIC = b'RHH1'
+    HEADER = struct.Struct('<4sII')
+    SLOT_HEADER = struct.Struct('<128sII')
+    RECORD = struct.Struct('<IHBx')
+    STATUS_OK, STATUS_FAILED, STATUS_TIMEOUT = 0, 1, 2
+    NO_RTT = 0xFFFF
+
+    def __init__(self, mapped, slots, entries):
+        self._map = mapped
+        self.slots = slots
+        self.entries = entries
+        self._slot_size = self.SLOT_HEADER.size + entries * self.RECORD.size
+        self._by_address = {}
+        self._last_write = [0] * slots
+        for slot in range(slots):
+            address, cursor, count = self._slot_header(slot)
+            if address:
+                self._by_address[address] = slot
+                if count:
+                    self._last_write[slot] = self._record(slot, (cursor - 1) % entries)[0]
+
+    @classmethod
+    def file_size(cls, slots, entries):
+        return cls.HEADER.size + slots * (cls.SLOT_HEADER.size + entries * cls.RECORD.size)
+
+    @classmethod
+    def open_for_write(cls, path, slots=HISTORY_SLOTS, entries=HISTORY_ENTRIES):
+        """Maps `path` read-write, (re)creating it when missing or laid out for other sizes."""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, cls.HEADER.size, 0)
+            if header != cls.HEADER.pack(cls.MAGIC, slots, entries):
+                if header:
+                    log(f"History file '{path}' has a different layout; starting a new history.", "WARN")
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, cls.file_size(slots, entries))
+                os.pwrite(fd, cls.HEADER.pack(cls.MAGIC, slots, entries), 0)
+            mapped = mmap.mmap(fd, cls.file_size(slots, entries))
+        finally:
+            os.close(fd)
+        return cls(mapped, slots, entries)
+
+    @classmethod
+    def open_for_read(cls, path):
+        with open(path, 'rb') as f:
+            magic, slots, entries = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or os.fstat(f.fileno()).st_size < cls.file_size(slots, entries):
+                raise ValueError(f"'{path}' is not a health history file")
+            mapped = mmap.mmap(f.fileno(), cls.file_size(slots, entries), access=mmap.ACCESS_READ)
+        return cls(mapped, slots, entries)
+
+    def close(self, flush=False):
+        if not self._map.closed:
+            if flush:
+                self._map.flush()
+            self._map.close()
+
+    def _slot_offset(self, slot):
+        return self.HEADER.size + slot * self._slot_size
+
+    def _slot_header(self, slot):
+        address, cursor, count = self.SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))
+        return address.rstrip(b'\x00').decode('utf-8', 'replace'), cursor, count
+
+    def _record(self, slot, index):
+        return self.RECORD.unpack_from(self._map, self._slot_offset(slot) + self.SLOT_HEADER.size + index * self.RECORD.size)
+
+    def _claim(self, address):
+        encoded = address.encode('utf-8')
+        if len(encoded) > self.SLOT_HEADER.size - 8:
+            return None
+        taken = set(self._by_address.values())
+        free = [slot for slot in range(self.slots) if slot not in taken]
+        if free:
+            slot = free[0]
+        else:
+            slot = min(range(self.slots), key=self._last_write.__getitem__)
+            evicted = self._slot_header(slot)[0]
+            del self._by_address[evicted]
+            log(f"History is full ({self.slots} slots); reusing the slot of '{evicted}' for '{address}'.")
+        self.SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), encoded, 0, 0)
+        self._by_address[address] = slot
+        return slot
+
+    def record(self, address, timestamp, status, rtt):
+        slot = self._by_address.get(address)
+        if slot is None:
+            slot = self._claim(address)
+            if slot is None:
+                return
+        encoded, cursor, count = self.SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))
+        rtt_units = self.NO_RTT if rtt is None else min(self.NO_RTT - 1, int(round(rtt * 10000)))
+        self.RECORD.pack_into(self._map, self._slot_offset(slot) + self.SLOT_HEADER.size + cursor * self.RECORD.size,
+                              int(timestamp), rtt_units, status)
+        self.SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), encoded,
+                                   (cursor + 1) % self.entries, min(count + 1, self.entries))
+        self._last_write[slot] = int(timestamp)
+
+    def addresses(self):
+        return sorted(self._by_address)
+
+    def history(self, address):
+        """Returns [(timestamp, status, rtt_seconds_or_None)] for `address`, oldest first."""
+        slot = self._by_address.get(address)
+        if slot is None:
+            return []
+        _, cursor, count = self._slot_header(slot)
+        records = []
+        for i in range(count):
+            timestamp, rtt_units, status = self._record(slot, (cursor - count + i) % self.entries)
+            records.append((timestamp, status, None if rtt_units == self.NO_RTT else rtt_units / 10000))
+        return records
+
+def record_history(history, check_results, timestamp):
+    for result in check_results:
+        if result['exit_code'] == 0:
+            status = HistoryRing.STATUS_OK
+        elif result['exit_code'] == PROBE_TIMEOUT_EXIT_CODE or result.get('status') == 'timeout':
+            status = HistoryRing.STATUS_TIMEOUT
+        else:
+            status = HistoryRing.STATUS_FAILED
+        rtts = [rtt for rtt in result['latencies'] if rtt is not None]
+        history.record(result['address'], timestamp, status, sum(rtts) / len(rtts) if rtts else None)
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize_history(records, since):
+    """Availability, RTT percentiles and flaps (up/down transitions) over the records newer than `since`."""
+    recent = [record for record in records if record[0] >= since]
+    if not recent:
+        return None
+    passed = [record for record in recent if record[1] == HistoryRing.STATUS_OK]
+    rtts = sorted(record[2] for record in passed if record[2] is not None)
+    flaps = sum(1 for previous, current in zip(recent, recent[1:])
+                if (previous[1] == HistoryRing.STATUS_OK) != (current[1] == HistoryRing.STATUS_OK))
+    return {'samples': len(recent), 'availability': len(passed) / len(recent),
+            'rtt_p50': _percentile(rtts, 0.5), 'rtt_p95': _percentile(rtts, 0.95),
+            'flaps': flaps, 'last_ok': recent[-1][1] == HistoryRing.STATUS_OK, 'last_at': recent[-1][0]}
+
+def print_history(path, address=None, hours=24, as_json=False):
+    try:
+        history = HistoryRing.open_for_read(path)
+    except (OSError, ValueError, struct.error) as e:
+        log(f"无法读取检测历史文件 '{path}': {e}", "ERROR")
+        return False
+    try:
+        since = time.time() - hours * 3600
+        addresses = [address] if address else history.addresses()
+        summaries = OrderedDict((addr, summarize_history(history.history(addr), since)) for addr in addresses)
+    finally:
+        history.close()
+    if as_json:
+        print(json.dumps(summaries, ensure_ascii=False))
+        return True
+    if not any(summaries.values()):
+        print(f"最近 {hours:g} 小时内没有检测记录。")
+        return True
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}ms"
+    print(f"最近 {hours:g} 小时的检测统计:")
+    print(f"  {'上游地址':<30}{'样本':>6}{'可用率':>9}{'RTT p50':>11}{'RTT p95':>11}{'抖动':>6}  最近结果")
+    for addr, summary in summaries.items():
+        if summary is None:
+            continue
+        last = "正常" if summary['last_ok'] else "异常"
+        last += time.strftime(' (%m-%d %H:%M)', time.localtime(summary['last_at']))
+        print(f"  {addr:<34}{summary['samples']:>6}{summary['availability']:>10.1%}"
+              f"{ms(summary['rtt_p50']):>11}{ms(summary['rtt_p95']):>11}{summary['flaps']:>6}  {last}")
+    return True
+
+class DecisionPolicy(namedtuple('DecisionPolicy', ['failures_to_disable', 'successes_to_enable', 'flap_half_life',
+                                                   'flap_suppress_limit', 'flap_reuse_limit', 'probe_backoff_max'])):
+    """Thresholds behind the failover decisions; DEFAULT_POLICY is read from the environment."""
+    __slots__ = ()
+
+DEFAULT_POLICY = DecisionPolicy(FAILURES_TO_DISABLE, SUCCESSES_TO_ENABLE, FLAP_HALF_LIFE,
+                                FLAP_SUPPRESS_LIMIT, FLAP_REUSE_LIMIT, PROBE_BACKOFF_MAX)
+
+class UpstreamHealth:
+    """Smoothed view of one upstream built from its probe results.
+
+    `rtt` and `loss` are exponentially weighted moving averages; `rtt` stays
+    None until a probe reports latencies (script probes only report up/down).
+    `failures`/`successes` are the consecutive counters behind the fall and
+    rise thresholds of `policy`. Every fall adds FLAP_PENALTY to a penalty
+    that halves every flap_half_life seconds; past flap_suppress_limit the
+    upstream is suppressed (not re-enabled) until the penalty drops below
+    flap_reuse_limit.
+    """
+
+    def __init__(self, alpha=BALANCE_EWMA_ALPHA, policy=DEFAULT_POLICY):
+        self.alpha = alpha
+        self.policy = policy
+        self.rtt = None
+        self.loss = None
+        self.samples = 0
+        self.failures = 0
+        self.successes = 0
+        self.down = False
+        self.last_checked = None
+        self.last_ok = None
+        self._penalty = 0.0
+        self._penalty_at = 0.0
+        self._suppressed = False
+
+    SNAPSHOT_FIELDS = ('rtt', 'loss', 'samples', 'failures', 'successes', 'down', 'last_checked', 'last_ok',
+                       '_penalty', '_penalty_at', '_suppressed')
+
+    def snapshot(self):
+        return {name.lstrip('_'): getattr(self, name) for name in self.SNAPSHOT_FIELDS}
+
+    @classmethod
+    def restore(cls, data, policy=DEFAULT_POLICY):
+        upstream = cls(policy=policy)
+        for name in cls.SNAPSHOT_FIELDS:
+            if name.lstrip('_') in data:
+                setattr(upstream, name, data[name.lstrip('_')])
+        return upstream
+
+    def record(self, ok, now):
+        """Advances the rise/fall counters; returns 'down' or 'up' when the state flips."""
+        self.last_checked = now
+        if ok:
+            self.last_ok = now
+            self.failures, self.successes = 0, self.successes + 1
+            if self.down and self.successes >= self.policy.successes_to_enable:
+                self.down = False
+                return 'up'
+            return None
+        self.failures, self.successes = self.failures + 1, 0
+        if self.down or self.failures < self.policy.failures_to_disable:
+            return None
+        self.down = True
+        self._penalty = min(self.penalty(now) + FLAP_PENALTY, FLAP_PENALTY_CEILING)
+        if self._penalty >= self.policy.flap_suppress_limit:
+            self._suppressed = True
+        return 'down'
+
+    def penalty(self, now):
+        if self._penalty:
+            self._penalty *= 0.5 ** (max(0.0, now - self._penalty_at) / self.policy.flap_half_life)
+            if self._penalty < 1:
+                self._penalty = 0.0
+        self._penalty_at = now
+        if self._suppressed and self._penalty < self.policy.flap_reuse_limit:
+            self._suppressed = False
+        return self._penalty
+
+    def suppressed(self, now):
+        self.penalty(now)
+        return self._suppressed
+
+    def _smooth(self, current, sample):
+        return sample if current is None else current + self.alpha * (sample - current)
+
+    def update(self, exit_code, latencies):
+        if latencies:
+            answered = [latency for latency in latencies if latency is not None]
+            loss_sample = 1 - len(answered) / len(latencies)
+            if answered:
+                self.rtt = self._smooth(self.rtt, sum(answered) / len(answered))
+        else:
+            loss_sample = 0.0 if exit_code == 0 else 1.0
+        self.loss = self._smooth(self.loss, loss_sample)
+        self.samples += 1
+
+    def score(self):
+        """Relative goodness (higher is better), or None while there is too little data."""
+        if self.rtt is None or self.samples < BALANCE_MIN_SAMPLES:
+            return None
+        return (1 - self.loss) / max(self.rtt, BALANCE_RTT_FLOOR)
+
+def update_upstream_health(health, check_results):
+    for result in check_results:
+        upstream = health.get(result['address'])
+        if upstream is None:
+            upstream = health[result['address']] = UpstreamHealth()
+        upstream.update(result['exit_code'], result['latencies'])
+        if upstream.rtt is not None:
+            METRICS.set('realm_health_upstream_rtt_ewma_seconds', upstream.rtt, address=result['address'])
+        METRICS.set('realm_health_upstream_loss_ewma_ratio', upstream.loss, address=result['address'])
+
+def _weights_differ(current, target, threshold):
+    """True if any weight moved by at least `threshold`, after scaling both lists to the same maximum."""
+    top_current, top_target = max(current) or 1, max(target) or 1
+    for c, t in zip(current, target):
+        c, t = c / top_current, t / top_target
+        if abs(c - t) / max(c, t, 1e-9) >= threshold:
+            return True
+    return False
+
+class BalanceTuner:
+    """Turns upstream health into `balance` weight changes, with hysteresis.
+
+    A new weight set is only proposed when it differs from the live one by at
+    least `threshold` and the same target (within `threshold`) has been seen
+    for `hold_cycles` consecutive cycles, so small drift never restarts realm.
+    """
+
+    def __init__(self, threshold=BALANCE_CHANGE_THRESHOLD, hold_cycles=BALANCE_HOLD_CYCLES):
+        self.threshold = threshold
+        self.hold_cycles = max(1, hold_cycles)
+        self._candidates = {}
+
+    @staticmethod
+    def target_weights(remotes, health):
+        scores = [health[r].score() if r in health else None for r in remotes]
+        if any(score is None for score in scores):
+            return None
+        best = max(scores)
+        if best <= 0:
+            return None
+        return [max(1, int(round(BALANCE_WEIGHT_SCALE * score / best))) for score in scores]
+
+    def propose(self, model, health):
+        """Returns {listen: {remote: weight}} for endpoints whose new weights are due."""
+        changes = {}
+        seen = set()
+        for listen, remotes, current in model.weighted_endpoints():
+            seen.add(listen)
+            target = self.target_weights(remotes, health)
+            if target is None or not _weights_differ(current, target, self.threshold):
+                self._candidates.pop(listen, None)
+                continue
+            previous = self._candidates.get(listen)
+            streak = 1
+            if previous and previous[0] == remotes and not _weights_differ(previous[1], target, self.threshold):
+                streak = previous[2] + 1
+            if streak >= self.hold_cycles:
+                changes[listen] = dict(zip(remotes, target))
+                self._candidates.pop(listen, None)
+            else:
+                self._candidates[listen] = (remotes, target, streak)
+        for listen in list(self._candidates):
+            if listen not in seen:
+                del self._candidates[listen]
+        return changes
+
+CONFIG_CACHE = CachedFile(REALM_CONFIG_FILE, load_config_model)
+STATE_CACHE = CachedFile(STATE_BACKUP_FILE, load_json_file)
+
+Decisions = namedtuple('Decisions', ['enable', 'disable', 'healthy', 'unhealthy', 'urgent', 'recovered', 'suppressed'])
+
+def decide_upstreams(check_results, health, model, state_data, now, policy=DEFAULT_POLICY):
+    """The failover decision core: updates the rise/fall counters in `health` and picks what to change.
+
+    Pure apart from `health`: no logging, metrics or file access, so the
+    replay simulator can drive it with recorded or synthetic results. Only
+    'address' and 'exit_code' of each result are read. A disabled upstream
+    (one in `state_data`) is only enabled after successes_to_enable
+    consecutive successes and while it is not suppressed for flapping; an
+    active one is disabled after failures_to_disable consecutive failures.
+    `urgent` is set when a recovered upstream would restore an endpoint that
+    has lost all its remotes. `recovered` lists upstreams passing after a
+    failure and `suppressed` maps held-back upstreams to their flap penalty.
+    """
+    upstreams_to_disable = set()
+    upstreams_to_enable = set()
+    active_upstreams = None
+    healthy, unhealthy = set(), set()
+    recovered, suppressed = [], {}
+    for result in check_results:
+        address = result['address']
+        upstream = health.get(address)
+        if upstream is None:
+            upstream = health[address] = UpstreamHealth(policy=policy)
+
+        if result['exit_code'] == 0:
+            healthy.add(address)
+            unhealthy.discard(address)
+            if upstream.failures > 0:
+                recovered.append(address)
+            upstream.record(True, now)
+            upstreams_to_enable.discard(address)
+            if address in state_data and upstream.successes >= policy.successes_to_enable:
+                if upstream.suppressed(now):
+                    suppressed[address] = upstream.penalty(now)
+                else:
+                    upstreams_to_enable.add(address)
+        else:
+            unhealthy.add(address)
+            healthy.discard(address)
+            upstreams_to_enable.discard(address)
+            upstream.record(False, now)
+            if upstream.failures >= policy.failures_to_disable:
+                if active_upstreams is None:
+                    active_upstreams = model.active_upstreams()
+                if address in active_upstreams:
+                    upstreams_to_disable.add(address)
+
+    live_listens = model.listen_addresses() if upstreams_to_enable else ()
+    urgent = any(info['listen'] not in live_listens
+                 for address in upstreams_to_enable for info in state_data.get(address, []))
+    return Decisions(upstreams_to_enable, upstreams_to_disable, healthy, unhealthy, urgent, recovered, suppressed)
+
+def process_check_results(check_results, health):
+    """Runs decide_upstreams() on one cycle's results against the cached config and state, and logs the outcome.
+
+    Returns (upstreams_to_enable, upstreams_to_disable, healthy, unhealthy, urgent),
+    or None if the realm config could not be read.
+    """
+    success_count = sum(1 for r in check_results if r['exit_code'] == 0)
+    fail_count = len(check_results) - success_count
+    log(f"Check cycle summary: {len(check_results)} total, {success_count} successful, {fail_count} failed.",
+        event="cycle_summary", total=len(check_results), successful=success_count, failed=fail_count)
+
+    with METRICS.phase('parse'):
+        state_data = STATE_CACHE.get()
+        model = CONFIG_CACHE.get()
+    if not model:
+        log("Could not parse main config, skipping result processing.", "ERROR")
+        return None
+
+    decisions = decide_upstreams(check_results, health, model, state_data, time.time())
+    for address in decisions.recovered:
+        log(f"Upstream '{address}' has RECOVERED.", "INFO", event="recovered", address=address)
+    for address, penalty in decisions.suppressed.items():
+        log(f"Upstream '{address}' is passing again but is flapping (penalty {penalty:.0f}); keeping it disabled.", "WARN",
+            event="flap_suppressed", address=address, penalty=round(penalty))
+    for result in check_results:
+        if result['exit_code'] == 0:
+            continue
+        address, exit_code = result['address'], result['exit_code']
+        failures = health[address].failures
+        latency_info = f", Latencies: {format_latencies(result['latencies'])}" if result['latencies'] else ""
+        detail_info = f", Detail: {result['detail']}" if result.get('detail') else ""
+        log(f"Upstream '{address}' FAILED check (Exit code: {exit_code}, Failures: {failures}{latency_info}{detail_info}).", "WARN",
+            event="check_failed", address=address, exit_code=exit_code, failures=failures,
+            latencies=result['latencies'], detail=result.get('detail'))
+    return tuple(decisions[:5])
+
+def apply_decisions(model, state_data, upstreams_to_enable, upstreams_to_disable, weight_changes=None):
+    """Applies one batch of decisions to `model` and `state_data` in place.
+
+    Returns (changed, rebalanced), where `rebalanced` lists the listen
+    addresses whose balance weights were rewritten.
+    """
+    changed = False
+    for addr in upstreams_to_enable:
+        if model.enable(addr, state_data): changed = True
+
+    for addr in upstreams_to_disable:
+        if model.disable(addr, state_data): changed = True
+
+    rebalanced = [listen for listen, weights_by_remote in (weight_changes or {}).items()
+                  if model.set_balance_weights(listen, weights_by_remote)]
+    return changed or bool(rebalanced), rebalanced
+
+def apply_config_changes(upstreams_to_enable, upstreams_to_disable, weight_changes=None):
+    """Rewrites the realm config for a batch of decisions; returns True if it changed and realm needs a restart."""
+    log("Applying configuration changes...", "INFO")
+    with METRICS.phase('parse'):
+        model = CONFIG_CACHE.get()
+        state_data = STATE_CACHE.get()
+    if not model:
+        log("Failed to read config file for modification. Aborting update.", "ERROR")
+        return False
+
+    with METRICS.phase('modify'):
+        config_modified, rebalanced = apply_decisions(model, state_data, upstreams_to_enable, upstreams_to_disable, weight_changes)
+    for listen in rebalanced:
+        log(f"Rebalancing '{listen}': {', '.join(f'{r}={w}' for r, w in weight_changes[listen].items())}.", "INFO")
+        METRICS.inc('realm_health_balance_updates_total')
+
+    if not config_modified:
+        log("No effective configuration changes were made after processing results.")
+        STATE_CACHE.invalidate()
+        return False
+
+    return commit_config(model, state_data)
+
+def restart_realm():
+    """Runs REALM_RESTART_COMMAND; returns True only if it exited 0 within REALM_RESTART_TIMEOUT."""
+    log("Restarting realm service...", "INFO")
+    try:
+        with METRICS.phase('restart'):
+            process = subprocess.run(REALM_RESTART_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True, timeout=REALM_RESTART_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log(f"Restarting realm failed: {e}", "ERROR")
+        METRICS.inc('realm_health_restart_failures_total')
+        return False
+    if process.returncode != 0:
+        output = (process.stderr.strip() or process.stdout.strip()).splitlines()
+        log(f"Restarting realm failed (exit code {process.returncode}){': ' + output[-1] if output else ''}.", "ERROR")
+        METRICS.inc('realm_health_restart_failures_total')
+        return False
+    METRICS.inc('realm_health_restarts_total')
+    return True
+
+def commit_config(model, state_data):
+    """Validates and writes a modified model and state backup; returns True on success.
+
+    Every daemon-side write (cycle decisions and control socket requests) goes
+    through here on the event loop thread, so writes are serialized. On failure
+    the caches are dropped so the next read reflects what is actually on disk.
+    """
+    log("Validating new configuration...")
+    with METRICS.phase('validate'):
+        validation = validate_data(model.to_data())
+    if not validation.is_valid:
+        for issue in validation.errors:
+            log(f"Validation error at '{issue.location}': {issue.message}", "ERROR")
+        log("Validation FAILED! Configuration not written and realm service not restarted. Please check config manually.", "ERROR")
+        CONFIG_CACHE.invalidate()
+        STATE_CACHE.invalidate()
+        return False
+    log("Validation successful.")
+
+    log("Saving modified configuration and state files...")
+    with METRICS.phase('serialize'):
+        new_toml_content = serialize_to_toml(validation.data)
+    with METRICS.phase('write'):
+        written = write_config_and_state(REALM_CONFIG_FILE, new_toml_content, STATE_BACKUP_FILE, state_data)
+    if not written:
+        CONFIG_CACHE.invalidate()
+        STATE_CACHE.invalidate()
+        return False
+    CONFIG_CACHE.store(model)
+    STATE_CACHE.store(state_data)
+    return True
+
+class RestartCoordinator:
+    """Coalesces enable/disable and rebalance decisions from several cycles into one rewrite+restart.
+
+    Decisions are held until `batch_window` seconds after the first pending one,
+    and restarts draw from a token bucket holding at most `burst` tokens, refilled
+    at one per `min_interval` seconds. An urgent batch (an endpoint that lost all
+    its remotes can be restored) bypasses both. A decision is dropped again if a
+    later result contradicts it before the flush. When the restart itself fails,
+    the rewritten config stays in place and only the restart is retried, no
+    sooner than `retry_seconds` later; the token it used is given back.
+    """
+
+    def __init__(self, batch_window, min_interval, burst, clock=time.monotonic, retry_seconds=RESTART_RETRY_SECONDS):
+        self.batch_window = batch_window
+        self.min_interval = min_interval
+        self.burst = max(1, burst)
+        self.retry_seconds = retry_seconds
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._last_refill = clock()
+        self.pending_enable = set()
+        self.pending_disable = set()
+        self.pending_weights = {}
+        self.urgent = False
+        self._first_pending_at = None
+        self._batches = 0
+        self.restarts = 0
+        self.restarts_avoided = 0
+        self.restart_due = False
+        self._restart_batches = 0
+        self._retry_at = None
+
+    def has_pending(self):
+        return bool(self.pending_enable or self.pending_disable or self.pending_weights)
+
+    def submit_weights(self, weight_changes):
+        """Queues {listen: {remote: weight}} rebalances; a newer target replaces an older one."""
+        if not weight_changes:
+            return
+        if not self.has_pending():
+            self._first_pending_at = self._clock()
+        self.pending_weights.update(weight_changes)
+        self._batches += 1
+
+    def submit(self, upstreams_to_enable, upstreams_to_disable, healthy=(), unhealthy=(), urgent=False):
+        """Merges one cycle's decisions into the pending batch."""
+        cancelled = (self.pending_disable & set(healthy)) | (self.pending_enable & set(unhealthy))
+        self.pending_disable -= set(healthy)
+        self.pending_enable -= set(unhealthy)
+        added = (set(upstreams_to_enable) - self.pending_enable) | (set(upstreams_to_disable) - self.pending_disable)
+        self.pending_disable -= set(upstreams_to_enable)
+        self.pending_enable -= set(upstreams_to_disable)
+        self.pending_enable |= set(upstreams_to_enable)
+        self.pending_disable |= set(upstreams_to_disable)
+        self.urgent = self.urgent or urgent
+
+        if added:
+            self._batches += 1
+            if self._first_pending_at is None:
+                self._first_pending_at = self._clock()
+        if cancelled:
+            log(f"Pending change(s) for {', '.join(sorted(cancelled))} cancelled by newer results.")
+        if not self.has_pending() and self._batches:
+            self._count_avoided(self._batches)
+            log(f"All pending changes cancelled out; {self.restarts_avoided} restart(s) avoided so far.")
+            self._reset()
+
+    def _refill(self):
+        now = self._clock()
+        if self.min_interval > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) / self.min_interval)
+        else:
+            self._tokens = float(self.burst)
+        self._last_refill = now
+
+    def seconds_until_ready(self):
+        """Seconds until the pending batch (or a failed restart) may be flushed, or None if nothing is pending."""
+        if not self.has_pending():
+            if not self.restart_due:
+                return None
+            return max(0.0, self._retry_at - self._clock())
+        if self.urgent:
+            wait = 0.0
+        else:
+            self._refill()
+            window_wait = self._first_pending_at + self.batch_window - self._clock()
+            token_wait = (1 - self._tokens) * self.min_interval if self._tokens < 1 else 0.0
+            wait = max(0.0, window_wait, token_wait)
+        if self.restart_due:
+            wait = max(wait, self._retry_at - self._clock())
+        return wait
+
+    def flush(self, apply_changes, restart=lambda: True):
+        """Applies the pending batch with apply_changes(enable, disable, weights) and restart() if it is ready.
+
+        apply_changes returns True when it changed the config; restart()
+        returns False when the restart failed and must be retried.
+        """
+        wait = self.seconds_until_ready()
+        if wait is None:
+            return False
+        if wait > 0:
+            if self.has_pending():
+                log(f"Deferring {len(self.pending_enable) + len(self.pending_disable) + len(self.pending_weights)} pending change(s) for {wait:.0f}s (batch window / restart rate limit).")
+            return False
+        if self.urgent:
+            log("An endpoint with no remaining remotes can be restored; applying changes immediately.", "WARN")
+        self._tokens = max(0.0, self._tokens - 1)
+        if self.has_pending():
+            if apply_changes(self.pending_enable, self.pending_disable, self.pending_weights):
+                self.restart_due = True
+                self._restart_batches += self._batches
+            self._reset()
+        if not self.restart_due:
+            return False
+        if not restart():
+            self._tokens = min(float(self.burst), self._tokens + 1)
+            self._retry_at = self._clock() + self.retry_seconds
+            log(f"The new configuration is written but realm was not restarted; retrying in {self.retry_seconds:g}s.", "WARN")
+            return False
+        self.restart_due = False
+        self.restarts += 1
+        self._count_avoided(self._restart_batches - 1)
+        if self._restart_batches > 1:
+            log(f"Coalesced {self._restart_batches} decision batches into one restart; {self.restarts_avoided} restart(s) avoided so far.")
+        self._restart_batches = 0
+        return True
+
+    def _count_avoided(self, count):
+        """Exports avoided restarts as soon as they happen, including flushes between cycles."""
+        if count > 0:
+            self.restarts_avoided += count
+            METRICS.inc('realm_health_restarts_avoided_total', count)
+
+    def _reset(self):
+        self.pending_enable = set()
+        self.pending_disable = set()
+        self.pending_weights = {}
+        self.urgent = False
+        self._first_pending_at = None
+        self._batches = 0
+
+class PeerMesh(asyncio.DatagramProtocol):
+    """Exchanges per-upstream verdicts with peer daemons over UDP and applies a disable quorum.
+
+    After every cycle each node sends which upstreams it considers down
+    (failure count at FAILURES_TO_DISABLE) and which it considers up. A
+    datagram is an HMAC-SHA256 digest over its JSON payload; payloads carry
+    the sender's node id and a millisecond sequence number, and stale or
+    replayed sequences are ignored. An upstream this node sees as down is
+    only disabled when at least `quorum` nodes, counting itself, report it
+    down within `ttl` seconds.
+    """
+
+    def __init__(self, node_id, peers, secret, quorum, ttl, listen=PEER_LISTEN, clock=time.time):
+        self.node_id = node_id
+        self.peers = peers
+        self._secret = secret.encode('utf-8')
+        self.quorum = quorum
+        self.ttl = ttl
+        self.listen = listen
+        self._clock = clock
+        self._views = {}
+        self._transports = {}
+        self._listener = None
+        self.rejected = 0
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()
+
+    def encode(self, down, up, seq):
+        """Splits one verdict set into signed datagrams sharing `seq`."""
+        entries = [(address, 1) for address in sorted(down)] + [(address, 0) for address in sorted(up)]
+        datagrams = []
+        for start in range(0, max(len(entries), 1), PEER_ADDRESSES_PER_DATAGRAM):
+            chunk = entries[start:start + PEER_ADDRESSES_PER_DATAGRAM]
+            payload = json.dumps({'n': self.node_id, 's': seq, 'v': dict(chunk)}, separators=(',', ':')).encode('utf-8')
+            datagrams.append(self._sign(payload) + payload)
+        return datagrams
+
+    def datagram_received(self, data, addr):
+        digest, payload = data[:32], data[32:]
+        if len(digest) < 32 or not hmac.compare_digest(digest, self._sign(payload)):
+            self.rejected += 1
+            return
+        try:
+            message = json.loads(payload.decode('utf-8'))
+            node, seq, verdicts = message['n'], int(message['s']), message['v']
+        except (ValueError, KeyError, TypeError):
+            self.rejected += 1
+            return
+        if node == self.node_id or seq < (self._clock() - self.ttl) * 1000:
+            return
+        view = self._views.get(node)
+        if view is None or seq > view['seq']:
+            view = self._views[node] = {'seq': seq, 'received': self._clock(), 'down': set(), 'up': set()}
+        elif seq < view['seq']:
+            return
+        for address, is_down in verdicts.items():
+            (view['down'] if is_down else view['up']).add(address)
+        METRICS.set('realm_health_peer_last_seen_timestamp_seconds', view['received'], peer=node)
+
+    def fresh_views(self):
+        cutoff = self._clock() - self.ttl
+        return {node: view for node, view in self._views.items() if view['received'] >= cutoff}
+
+    def down_votes(self, address):
+        """Nodes other than this one currently reporting `address` as down."""
+        return sum(1 for view in self.fresh_views().values() if address in view['down'])
+
+    def filter_disable(self, candidates):
+        """Splits locally-failing upstreams into (allowed, held) by the quorum."""
+        allowed, held = set(), set()
+        for address in candidates:
+            (allowed if 1 + self.down_votes(address) >= self.quorum else held).add(address)
+        return allowed, held
+
+    async def start(self):
+        """Listens on `listen`; 0.0.0.0, [::] or a concrete address pick the socket's family."""
+        loop = asyncio.get_event_loop()
+        host, port = split_host_port(self.listen)
+        try:
+            transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host or "0.0.0.0", int(port)))
+            self._listener = transport
+            self._transports[transport.get_extra_info('socket').family] = transport
+        except (OSError, ValueError) as e:
+            log(f"Peer listener unavailable on {self.listen}: {e}. Verdicts will be sent but not received.", "WARN")
+        log(f"Peer mode: node '{self.node_id}', {len(self.peers)} peer(s), quorum {self.quorum}, listening on {self.listen}.")
+
+    def sockname(self):
+        """The address the listener is bound to, or None without one."""
+        return self._listener.get_extra_info('sockname') if self._listener is not None else None
+
+    def close(self):
+        for transport in self._transports.values():
+            transport.close()
+        self._transports.clear()
+        self._listener = None
+
+    async def _transport_for(self, family):
+        """The listener when it has this family, otherwise a send-only socket of that family."""
+        transport = self._transports.get(family)
+        if transport is None:
+            transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(lambda: self, family=family)
+            self._transports[family] = transport
+        return transport
+
+    async def broadcast(self, failure_counts):
+        loop = asyncio.get_event_loop()
+        down = {address for address, count in failure_counts.items() if count >= FAILURES_TO_DISABLE}
+        up = set(failure_counts) - down
+        datagrams = self.encode(down, up, int(self._clock() * 1000))
+        for peer in self.peers:
+            host, port = split_host_port(peer)
+            try:
+                infos = await loop.getaddrinfo(host, int(port), type=socket.SOCK_DGRAM)
+                family, _, _, _, sock_addr = infos[0]
+                transport = await self._transport_for(family)
+            except (OSError, ValueError) as e:
+                log(f"Cannot reach peer '{peer}': {e}", "WARN")
+                continue
+            for datagram in datagrams:
+                transport.sendto(datagram, sock_addr)
+
+    def status(self):
+        now = self._clock()
+        return {node: {'age': round(now - view['received'], 1), 'down': sorted(view['down'])}
+                for node, view in self._views.items()}
+
+def create_peer_mesh(total_cycle_seconds):
+    if not PEERS:
+        return None
+    if not PEER_SECRET:
+        log("PEERS is set but PEER_SECRET is empty; peer quorum disabled.", "ERROR")
+        return None
+    node_id = NODE_ID or f"{socket.gethostname()}:{split_host_port(PEER_LISTEN)[1]}"
+    quorum = PEER_QUORUM or (len(PEERS) + 1) // 2 + 1
+    ttl = PEER_VERDICT_TTL or 3 * total_cycle_seconds
+    return PeerMesh(node_id, PEERS, PEER_SECRET, quorum, ttl)
+
+class CycleProfiler:
+    """Profiles check cycles on demand and keeps dumps of the slow ones.
+
+    While enabled (--profile, or toggled with SIGUSR1), each cycle runs under
+    cProfile and its phase timers and per-probe durations are collected. A
+    cycle that takes at least `threshold` seconds is saved to a new directory
+    under PROFILE_DIR holding profile.pstats, a profile.txt summary and
+    timings.json; only the newest PROFILE_KEEP dumps are kept.
+    """
+
+    def __init__(self, threshold, enabled=False, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.threshold = threshold
+        self.enabled = enabled
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.dumps = 0
+        self.last_dump = None
+        self._profile = None
+        self._phases = OrderedDict()
+        self._probes = []
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if self.enabled:
+            log(f"Cycle profiling enabled; cycles of {self.threshold:g}s or more are saved under '{self.directory}'.")
+        else:
+            log("Cycle profiling disabled.")
+
+    def begin_cycle(self):
+        if not self.enabled:
+            return
+        self._phases = OrderedDict()
+        self._probes = []
+        METRICS.phase_listener = self._on_phase
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def _on_phase(self, name, elapsed):
+        self._phases[name] = self._phases.get(name, 0) + elapsed
+
+    def note_probes(self, check_results):
+        if self._profile is not None:
+            self._probes.extend(check_results)
+
+    def end_cycle(self, duration):
+        if self._profile is None:
+            return
+        profile, self._profile = self._profile, None
+        profile.disable()
+        METRICS.phase_listener = None
+        if duration < self.threshold:
+            return
+        try:
+            self._dump(profile, duration)
+        except (IOError, OSError) as e:
+            log(f"Could not save the profile of a slow cycle: {e}", "ERROR")
+
+    def _dump(self, profile, duration):
+        started = time.time() - duration
+        path = os.path.join(self.directory, time.strftime('cycle-%Y%m%d-%H%M%S', time.localtime(started)))
+        os.makedirs(path, exist_ok=True)
+        profile.dump_stats(os.path.join(path, "profile.pstats"))
+        with open(os.path.join(path, "profile.txt"), 'w', encoding='utf-8') as f:
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(40)
+        probes = sorted(self._probes, key=lambda r: r.get('duration') or 0, reverse=True)
+        timings = {
+            'started_at': started, 'duration': duration, 'threshold': self.threshold,
+            'phases': self._phases, 'unaccounted': max(0, duration - sum(self._phases.values())),
+            'probes': [{key: r.get(key) for key in ('address', 'probe', 'status', 'exit_code', 'duration', 'shared', 'detail')}
+                       for r in probes],
+        }
+        write_file_atomic(os.path.join(path, "timings.json"), json.dumps(timings, indent=2, ensure_ascii=False))
+        self.dumps += 1
+        self.last_dump = path
+        slowest = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in
+                            sorted(self._phases.items(), key=lambda item: item[1], reverse=True)[:3])
+        log(f"Cycle took {duration:.1f}s (threshold {self.threshold:g}s); profile saved to '{path}'"
+            + (f". Slowest phases: {slowest}." if slowest else "."), "WARN")
+        self._rotate()
+
+    def _rotate(self):
+        dumps = sorted(name for name in os.listdir(self.directory) if name.startswith("cycle-"))
+        for name in dumps[:-self.keep]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def status(self):
+        return {'enabled': self.enabled, 'threshold': self.threshold, 'directory': self.directory,
+                'dumps': self.dumps, 'last_dump': self.last_dump}
+
+def _exit_on_sigterm(signum, frame):
+    """Turns SIGTERM into a normal exit so atexit handlers run; repeats are ignored while they do."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+def cron_period_seconds(expression):
+    """Seconds between the next two runs of a cron expression; raises ValueError if it is invalid."""
+    schedule = croniter(expression, datetime.now())
+    first_run_time = schedule.get_next(datetime)
+    second_run_time = schedule.get_next(datetime)
+    return (second_run_time - first_run_time).total_seconds()
+
+def health_check_daemon(profile=False):
+    """Main daemon loop for concurrent health checks."""
+    start_background_logging()
+    effective_cron = HEALTH_CHECK_CRON
+    log(f"Health check daemon starting with schedule: '{effective_cron}'")
+    
+    try:
+        total_cycle_seconds = cron_period_seconds(effective_cron)
+    except ValueError as e:
+        log(f"Invalid cron format '{effective_cron}': {e}. Exiting.", "ERROR")
+        sys.exit(1)
+    
+    if total_cycle_seconds < MIN_CYCLE_SECONDS:
+        log(f"Cron schedule '{effective_cron}' results in a period shorter than {MIN_CYCLE_SECONDS}s.", "WARN")
+        total_cycle_seconds = MIN_CYCLE_SECONDS
+        log(f"Period has been automatically adjusted to {MIN_CYCLE_SECONDS} seconds.", "WARN")
+
+    dynamic_timeout = max(1, int(total_cycle_seconds / 2))
+    spread_seconds = float(PROBE_SPREAD_SECONDS) if PROBE_SPREAD_SECONDS else min(total_cycle_seconds / 2, 60)
+    log(f"Cycle interval set to {total_cycle_seconds}s. Health check timeout set to {dynamic_timeout}s. Probes are spread over {spread_seconds:g}s.")
+
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    run_async(_daemon_loop(effective_cron, total_cycle_seconds, dynamic_timeout, spread_seconds, profile))
+
+class DaemonContext:
+    """Warm daemon state shared by the check loop and the control socket."""
+
+    def __init__(self, total_cycle_seconds, dynamic_timeout, spread_seconds, profile=False):
+        self.total_cycle_seconds = total_cycle_seconds
+        self.dynamic_timeout = dynamic_timeout
+        self.scheduler = ProbeScheduler(spread_seconds)
+        self.coordinator = RestartCoordinator(RESTART_BATCH_WINDOW, RESTART_MIN_INTERVAL, RESTART_BURST)
+        self.health = {}
+        self.dns = DnsCache()
+        self.balance_tuner = BalanceTuner() if BALANCE_WEIGHTING == "latency" else None
+        self.peers = create_peer_mesh(total_cycle_seconds)
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHECKS)
+        self.concurrency = ConcurrencyController(CONCURRENT_CHECKS, MAX_CONCURRENT_CHECKS)
+        self.started_at = time.time()
+        self.cycles = 0
+        self.last_cycle_at = None
+        self.snapshot_saved_at = 0
+        slow_cycle = float(PROFILE_SLOW_CYCLE_SECONDS) if PROFILE_SLOW_CYCLE_SECONDS else total_cycle_seconds * CYCLE_DEADLINE_RATIO
+        self.profiler = CycleProfiler(slow_cycle, profile)
+        self.checks = CachedFile(HEALTH_CHECKS_FILE,
+                                 lambda path: compile_task_table(path, total_cycle_seconds, dynamic_timeout))
+        self.checks_changed = asyncio.Event()
+        self.watcher = FileWatcher([HEALTH_CHECKS_FILE, REALM_CONFIG_FILE], self.on_file_changed)
+        try:
+            self.history = HistoryRing.open_for_write(HEALTH_HISTORY_FILE)
+        except (OSError, ValueError) as e:
+            log(f"Could not open the history file '{HEALTH_HISTORY_FILE}', probe history is disabled: {e}", "WARN")
+            self.history = None
+
+    def on_file_changed(self, path):
+        """Reloads a watched file as soon as it changes; new check lines wake the loop to probe them."""
+        if path == os.path.abspath(HEALTH_CHECKS_FILE) and self.checks.changed():
+            table = self.checks.get()
+            METRICS.inc('realm_health_reloads_total', file='health_checks')
+            if table is None:
+                log("Health checks file was removed.", "WARN")
+                return
+            added = self.scheduler.sync(table.tasks, asyncio.get_event_loop().time(), stagger=False)
+            log(f"Health checks file changed: {len(table.tasks)} checks loaded, {added} new.")
+            if added:
+                self.checks_changed.set()
+        elif path == os.path.abspath(REALM_CONFIG_FILE) and CONFIG_CACHE.changed():
+            model = CONFIG_CACHE.get()
+            METRICS.inc('realm_health_reloads_total', file='config')
+            if model:
+                log(f"Realm config changed on disk; reloaded ({len(model.active_upstreams())} active upstreams).")
+
+    def save_health_snapshot(self):
+        """Writes the per-upstream health state so a restarted daemon can pick it up."""
+        upstreams = {}
+        for address, upstream in self.health.items():
+            upstreams[address] = upstream.snapshot()
+            upstreams[address]['backoff'] = self.scheduler.backoff(address)
+        snapshot = {'version': 1, 'saved_at': time.time(), 'upstreams': upstreams}
+        try:
+            write_file_atomic(HEALTH_STATE_FILE, json.dumps(snapshot, separators=(',', ':')))
+            self.snapshot_saved_at = snapshot['saved_at']
+        except (IOError, OSError) as e:
+            log(f"Could not write health state snapshot '{HEALTH_STATE_FILE}': {e}", "WARN")
+
+    def maybe_save_health_snapshot(self):
+        if time.time() - self.snapshot_saved_at >= HEALTH_SNAPSHOT_INTERVAL:
+            self.save_health_snapshot()
+
+    def load_health_snapshot(self):
+        """Restores health state saved by a previous run, unless it is older than HEALTH_SNAPSHOT_MAX_AGE."""
+        if not HEALTH_STATE_FILE or not os.path.exists(HEALTH_STATE_FILE):
+            return
+        snapshot = load_json_file(HEALTH_STATE_FILE)
+        if not isinstance(snapshot, dict) or snapshot.get('version') != 1 or not isinstance(snapshot.get('upstreams'), dict):
+            log(f"Ignoring unreadable health state snapshot '{HEALTH_STATE_FILE}'.", "WARN")
+            return
+        age = time.time() - snapshot.get('saved_at', 0)
+        if age > HEALTH_SNAPSHOT_MAX_AGE:
+            log(f"Ignoring health state snapshot saved {int(age)}s ago (older than {HEALTH_SNAPSHOT_MAX_AGE:g}s).")
+            return
+        now = asyncio.get_event_loop().time()
+        for address, data in snapshot['upstreams'].items():
+            self.health[address] = UpstreamHealth.restore(data)
+            if data.get('backoff'):
+                self.scheduler.set_backoff(address, data['backoff'], now)
+        log(f"Restored health state of {len(self.health)} upstream(s) saved {int(age)}s ago.")
+
+    def status(self):
+        model = CONFIG_CACHE.get()
+        now = time.time()
+        return {
+            'pid': os.getpid(),
+            'uptime': int(now - self.started_at),
+            'cron': HEALTH_CHECK_CRON,
+            'cycle_seconds': self.total_cycle_seconds,
+            'cycles': self.cycles,
+            'last_cycle_at': self.last_cycle_at,
+            'checks_configured': len(self.scheduler),
+            'file_watch': self.watcher.mode,
+            'active_upstreams': len(model.active_upstreams()) if model else 0,
+            'disabled_upstreams': sorted(STATE_CACHE.get()),
+            'failure_counts': {addr: h.failures for addr, h in self.health.items() if h.failures},
+            'pending_enable': sorted(self.coordinator.pending_enable),
+            'pending_disable': sorted(self.coordinator.pending_disable),
+            'pending_weights': self.coordinator.pending_weights,
+            'health': {addr: {'rtt': h.rtt, 'loss': h.loss, 'samples': h.samples, 'successes': h.successes,
+                              'last_checked': h.last_checked, 'last_ok': h.last_ok,
+                              'flap_penalty': round(h.penalty(now)), 'suppressed': h.suppressed(now),
+                              'probe_backoff': self.scheduler.backoff(addr)}
+                       for addr, h in self.health.items()},
+            'dns': self.dns.status(),
+            'profiling': self.profiler.status(),
+            'peers': self.peers.status() if self.peers else None,
+            'restarts': self.coordinator.restarts,
+            'restarts_avoided': self.coordinator.restarts_avoided,
+            'restart_due': self.coordinator.restart_due,
+        }
+
+def _same_file(path_a, path_b):
+    return bool(path_a) and os.path.realpath(path_a) == os.path.realpath(path_b)
+
+async def handle_control_request(request, ctx, send):
+    """Answers one control request; `send` writes a JSON response line."""
+    cmd = request.get('cmd')
+    managed = (('file', REALM_CONFIG_FILE), ('state_file', STATE_BACKUP_FILE), ('checks_file', HEALTH_CHECKS_FILE))
+    if not all(_same_file(request[key], path) for key, path in managed if request.get(key)):
+        await send({'ok': False, 'fallback': True, 'error': "request targets files the daemon does not manage"})
+        return
+
+    if cmd == 'status':
+        await send(dict(ok=True, **ctx.status()))
+    elif cmd == 'list':
+        model = CONFIG_CACHE.get()
+        if not model:
+            await send({'ok': False, 'error': f"cannot parse {REALM_CONFIG_FILE}"})
+            return
+        await send({'ok': True, 'upstreams': sorted(model.active_upstreams()), 'disabled': sorted(STATE_CACHE.get())})
+    elif cmd in ('enable', 'disable', 'apply'):
+        if cmd == 'apply':
+            operations = [(op.get('action'), op.get('address')) for op in request.get('operations') or ()]
+        else:
+            operations = [(cmd, request.get('address'))]
+        model = CONFIG_CACHE.get()
+        if not operations or not model or not all(addr and action in ('enable', 'disable') for action, addr in operations):
+            await send({'ok': False, 'error': "invalid operations or unreadable config"})
+            return
+        state_data = STATE_CACHE.get()
+        summary = [{'action': action, 'address': addr, 'changed': model.apply(action, addr, state_data)}
+                   for action, addr in operations]
+        changed = any(item['changed'] for item in summary)
+        if not changed:
+            STATE_CACHE.invalidate()
+            await send({'ok': True, 'changed': False, 'summary': summary})
+            return
+        log(f"配置已更新 ({len(operations)} 项操作, 来源: control socket)。正在写回文件...")
+        await send({'ok': commit_config(model, state_data), 'changed': True, 'summary': summary})
+    elif cmd == 'check_now':
+        tasks = None
+        if os.path.exists(HEALTH_CHECKS_FILE):
+            tasks = load_probe_tasks(HEALTH_CHECKS_FILE, 0, MANUAL_CHECK_TIMEOUT, request.get('line'))
+        if not tasks:
+            await send({'ok': False, 'error': "no health checks configured"})
+            return
+        await stream_check_now(tasks, STATE_CACHE.get(), send)
+    else:
+        await send({'ok': False, 'error': f"unknown command '{cmd}'"})
+
+def remove_stale_control_socket(path):
+    """Clears the way for binding `path`; returns False if a live server (or a non-socket file) is there.
+
+    A socket file is only removed when connecting to it is refused, i.e. the
+    daemon that created it is gone.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return True
+    if not stat.S_ISSOCK(mode):
+        return False
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(1)
+    try:
+        probe.connect(path)
+        return False
+    except (ConnectionRefusedError, FileNotFoundError):
+        pass
+    finally:
+        probe.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+async def start_control_server(ctx):
+    """Listens on CONTROL_SOCKET_PATH for newline-delimited JSON requests."""
+    async def on_client(reader, writer):
+        async def send(message):
+            writer.write((json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8'))
+            await writer.drain()
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                await send({'ok': False, 'error': f"malformed request: {e}"})
+                return
+            await handle_control_request(request, ctx, send)
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            log(f"Control request failed: {e}", "ERROR")
+            try:
+                await send({'ok': False, 'error': str(e)})
+            except (ConnectionError, OSError):
+                pass
+        finally:
+            writer.close()
+
+    try:
+        if not remove_stale_control_socket(CONTROL_SOCKET_PATH):
+            log(f"{CONTROL_SOCKET_PATH} is held by another running daemon or is not a socket; "
+                "leaving it alone, this daemon has no control socket.", "ERROR")
+            return None
+        # Created 0600 from the start, so other users can never connect in between bind and chmod.
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(on_client, path=CONTROL_SOCKET_PATH)
+        finally:
+            os.umask(old_umask)
+    except OSError as e:
+        log(f"Control socket unavailable at {CONTROL_SOCKET_PATH}: {e}. CLI actions will fall back to direct file access.", "WARN")
+        return None
+    log(f"Control socket listening on {CONTROL_SOCKET_PATH}.")
+    return server
+
+def control_request(request, timeout=CONTROL_TIMEOUT):
+    """Sends a request to the running daemon and returns an iterator over its responses.
+
+    Returns None when no daemon is listening, so callers can fall back to the
+    direct file path.
+    """
+    if not os.path.exists(CONTROL_SOCKET_PATH):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(CONTROL_SOCKET_PATH)
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+    except OSError:
+        sock.close()
+        return None
+
+    def responses():
+        with sock, sock.makefile('r', encoding='utf-8') as stream:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+    return responses()
+
+def control_request_one(request, timeout=CONTROL_TIMEOUT):
+    """Like control_request() for single-response commands; None means use the fallback path."""
+    responses = control_request(request, timeout)
+    if responses is None:
+        return None
+    try:
+        response = next(responses, None)
+    except (OSError, ValueError):
+        return None
+    if response is None or response.get('fallback'):
+        return None
+    return response
+
+async def _sleep_until(wake_time, coordinator, wake_event):
+    """Sleeps until wake_time, flushing deferred config changes as soon as they become due.
+
+    Returns True early if `wake_event` gets set, False once wake_time is reached.
+    """
+    while True:
+        remaining = (wake_time - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return False
+        flush_wait = coordinator.seconds_until_ready()
+        flush_due = flush_wait is not None and flush_wait < remaining
+        try:
+            await asyncio.wait_for(wake_event.wait(), flush_wait if flush_due else remaining)
+            return True
+        except asyncio.TimeoutError:
+            pass
+        if flush_due:
+            coordinator.flush(apply_config_changes, restart_realm)
+
+def probe_backoff_seconds(failures, base_seconds, policy=DEFAULT_POLICY):
+    """Probe interval of a disabled upstream after `failures` consecutive failures, or 0 for no backoff."""
+    extra = failures - policy.failures_to_disable
+    if extra <= 0:
+        return 0
+    return min(base_seconds * 2 ** min(extra, 32), max(policy.probe_backoff_max, base_seconds))
+
+def update_probe_backoff(scheduler, health, state_data, base_seconds, now):
+    """Backs off probing of disabled upstreams that keep failing, and lifts it on success.
+
+    Each failure past FAILURES_TO_DISABLE doubles the probe interval of a
+    disabled upstream, up to PROBE_BACKOFF_MAX. A success lifts the backoff, so
+    the upstream is rechecked at once and can reach SUCCESSES_TO_ENABLE quickly.
+    """
+    wall = time.time()
+    for address, upstream in health.items():
+        seconds = probe_backoff_seconds(upstream.failures, base_seconds) if address in state_data else 0
+        if seconds and seconds != scheduler.backoff(address):
+            log(f"Upstream '{address}' has failed {upstream.failures} checks in a row; probing it every {seconds:g}s.",
+                event="probe_backoff", address=address, interval=seconds)
+        elif not seconds and scheduler.backoff(address):
+            log(f"Upstream '{address}' passed a check; lifting its probe backoff.", event="probe_backoff", address=address, interval=0)
+        scheduler.set_backoff(address, seconds, now)
+        METRICS.set('realm_health_probe_backoff_seconds', seconds, address=address)
+        METRICS.set('realm_health_flap_penalty', upstream.penalty(wall), address=address)
+        METRICS.set('realm_health_flap_suppressed', int(upstream.suppressed(wall)), address=address)
+
+async def run_cycle(ctx, immediate=False):
+    """Runs one check cycle: probe the due tasks and hand decisions to the coordinator.
+
+    With `immediate`, only the checks already due (lines just added to the
+    checks file) are probed, without staggering, between two cron ticks.
+    """
+    loop = asyncio.get_event_loop()
+    scheduler, coordinator = ctx.scheduler, ctx.coordinator
+
+    table = ctx.checks.get()
+    if table is None:
+        log("Health checks file not found. Skipping cycle.", "WARN")
+        return
+    if not table.tasks:
+        log("No health checks configured. Skipping cycle.")
+        return
+
+    cycle_start = loop.time()
+    scheduler.sync(table.tasks, cycle_start)
+    METRICS.retain('address', table.addresses)
+    METRICS.retain('host', table.hosts)
+    ctx.dns.retain(table.hosts)
+    for address in [a for a in ctx.health if a not in table.addresses]:
+        del ctx.health[address]
+    if immediate:
+        scheduled_tasks = [(0, task) for _, task in scheduler.pop_due(cycle_start, cycle_start)]
+    else:
+        scheduled_tasks = scheduler.pop_due(cycle_start, cycle_start + ctx.total_cycle_seconds)
+    if not scheduled_tasks:
+        if not immediate:
+            log(f"None of the {len(scheduler)} configured checks are due this cycle.")
+        return
+    model = CONFIG_CACHE.get()
+    if model:
+        ctx.dns.configure(model.sections.get('dns') or {})
+    with METRICS.phase('resolve'):
+        await ctx.dns.refresh(task.host for _, task in scheduled_tasks)
+    scheduled_tasks = [(delay, task._replace(host=ctx.dns.lookup(task.host))) for delay, task in scheduled_tasks]
+    deadline = cycle_start + ctx.total_cycle_seconds * CYCLE_DEADLINE_RATIO
+    limit = ctx.concurrency.size([task for _, task, _ in group_probe_tasks(scheduled_tasks)], deadline - cycle_start)
+    METRICS.set('realm_health_pool_workers', limit)
+    log(f"{len(scheduled_tasks)} of {len(scheduler)} checks due this cycle, staggered over {scheduler.spread_seconds:g}s, script concurrency {limit}.")
+
+    with METRICS.phase('probe'):
+        check_results = await run_probe_tasks(scheduled_tasks, ctx.executor, deadline=deadline, script_limit=limit)
+    ctx.concurrency.observe(check_results)
+    ctx.profiler.note_probes(check_results)
+    stragglers = [r['address'] for r in check_results if r['status'] == 'timeout']
+    if stragglers:
+        log(f"{len(stragglers)} check(s) still running at the cycle deadline were recorded as timeouts: {', '.join(stragglers)}.", "WARN")
+    decisions = process_check_results(check_results, ctx.health)
+    record_probe_metrics(check_results, ctx.health)
+    if ctx.history is not None:
+        record_history(ctx.history, check_results, time.time())
+    update_upstream_health(ctx.health, check_results)
+    update_probe_backoff(scheduler, ctx.health, STATE_CACHE.get(), ctx.total_cycle_seconds, loop.time())
+    if ctx.peers is not None:
+        await ctx.peers.broadcast({address: upstream.failures for address, upstream in ctx.health.items()})
+    if decisions is None:
+        return
+    if ctx.peers is not None and decisions[1]:
+        allowed, held = ctx.peers.filter_disable(decisions[1])
+        if held:
+            METRICS.inc('realm_health_quorum_held_total', len(held))
+            log(f"Holding disable of {', '.join(sorted(held))}: fewer than {ctx.peers.quorum} node(s) agree it is down.", "WARN")
+        decisions = (decisions[0], allowed) + tuple(decisions[2:])
+    coordinator.submit(*decisions)
+    if ctx.balance_tuner is not None:
+        model = CONFIG_CACHE.get()
+        if model:
+            coordinator.submit_weights(ctx.balance_tuner.propose(model, ctx.health))
+    if coordinator.has_pending() or coordinator.restart_due:
+        coordinator.flush(apply_config_changes, restart_realm)
+    else:
+        log("All checks passed or no action required.")
+
+async def _daemon_loop(effective_cron, total_cycle_seconds, dynamic_timeout, spread_seconds, profile=False):
+    ctx = DaemonContext(total_cycle_seconds, dynamic_timeout, spread_seconds, profile)
+    ctx.load_health_snapshot()
+    atexit.register(ctx.save_health_snapshot)
+    if ctx.history is not None:
+        atexit.register(ctx.history.close, flush=True)
+    table = ctx.checks.get()
+    if table:
+        ctx.scheduler.sync(table.tasks, asyncio.get_event_loop().time())
+    ctx.watcher.start()
+    asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, ctx.profiler.toggle)
+    if profile:
+        log(f"Cycle profiling enabled by --profile; cycles of {ctx.profiler.threshold:g}s or more are saved under '{ctx.profiler.directory}'.")
+    await start_control_server(ctx)
+    await start_metrics_server()
+    if ctx.peers is not None:
+        await ctx.peers.start()
+    cron = croniter(effective_cron, datetime.now())
+
+    while True:
+        try:
+            next_run_time = cron.get_next(datetime)
+            
+            sleep_duration = (next_run_time - datetime.now()).total_seconds()
+            if sleep_duration > 0:
+                log(f"Sleeping for {int(sleep_duration)} seconds until next cycle at {next_run_time.strftime('%H:%M:%S')}.")
+                while await _sleep_until(next_run_time, ctx.coordinator, ctx.checks_changed):
+                    ctx.checks_changed.clear()
+                    log("Probing newly added health checks now.")
+                    await run_cycle(ctx, immediate=True)
+            
+            log(f"--- New Check Cycle --- (Concurrency: {ctx.concurrency.floor}-{ctx.concurrency.ceiling}, Timeout: {dynamic_timeout}s)")
+            ctx.cycles += 1
+            ctx.last_cycle_at = time.time()
+            cycle_started = time.monotonic()
+            ctx.profiler.begin_cycle()
+            try:
+                await run_cycle(ctx)
+            finally:
+                cycle_duration = time.monotonic() - cycle_started
+                ctx.profiler.end_cycle(cycle_duration)
+                if cycle_duration > total_cycle_seconds:
+                    overrun = cycle_duration - total_cycle_seconds
+                    log(f"Cycle overran its {total_cycle_seconds:g}s period by {overrun:.1f}s; the next cycle will start late.", "WARN")
+                    METRICS.inc('realm_health_cycle_overruns_total')
+                    METRICS.set('realm_health_cycle_overrun_seconds', overrun)
+                METRICS.observe('realm_health_cycle_duration_seconds', cycle_duration)
+                METRICS.inc('realm_health_cycles_total')
+                METRICS.set('realm_health_last_cycle_timestamp_seconds', time.time())
+                POOL_GAUGE.export(end_of_cycle=True)
+                write_metrics_textfile()
+                ctx.maybe_save_health_snapshot()
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log(f"An unexpected error occurred in the daemon loop: {e}", "ERROR")
+            await asyncio.sleep(60)
+
+def format_check_result(message, tsv=False):
+    """One check_now message as a JSON line, or as a tab-separated row for shell scripts.
+
+    TSV rows are `result<TAB>address<TAB>probe<TAB>exit_code<TAB>verdict<TAB>detail`
+    with whitespace runs in the fields flattened to single spaces. Only the
+    trailing detail may be empty (`read` collapses adjacent tabs), so missing
+    leading fields are written as '-'. The final summary message has no row.
+    """
+    if not tsv:
+        return json.dumps(message, ensure_ascii=False)
+    if message.get('done'):
+        return None
+    fields = [' '.join(str(message.get(key) if message.get(key) is not None else '').split())
+              for key in ('address', 'probe', 'exit_code', 'verdict', 'detail')]
+    return '\t'.join(['result'] + [field or '-' for field in fields[:-1]] + fields[-1:])
+
+def check_now(checks_file, state_file, line_number=None, tsv=False):
+    """Prints check_now results as JSON lines (or TSV rows), via the daemon when it manages these files."""
+    responses = control_request({'cmd': 'check_now', 'checks_file': checks_file,
+                                 'state_file': state_file, 'line': line_number}, timeout=None)
+    if responses is not None:
+        try:
+            first = next(responses, None)
+            if first is not None and not first.get('fallback'):
+                for response in itertools.chain([first], responses):
+                    if response.get('ok') is False:
+                        log(f"守护进程无法执行检测: {response.get('error')}", "ERROR")
+                        sys.exit(1)
+                    line = format_check_result(response, tsv)
+                    if line is not None:
+                        print(line, flush=True)
+                return
+        except (OSError, ValueError) as e:
+            log(f"与守护进程通信失败，改为本地检测: {e}", "WARN")
+
+    if not os.path.exists(checks_file):
+        log(f"健康检测配置文件不存在: {checks_file}", "ERROR")
+        sys.exit(1)
+    tasks = load_probe_tasks(checks_file, 0, MANUAL_CHECK_TIMEOUT, line_number)
+    if not tasks:
+        log("没有可执行的健康检测。", "WARN")
+        sys.exit(1)
+
+    async def send(message):
+        line = format_check_result(message, tsv)
+        if line is not None:
+            print(line, flush=True)
+
+    run_async(stream_check_now(tasks, load_json_file(state_file), send))
+
+def main():
+    parser = argparse.ArgumentParser(description="Realm Health Checker and Tools.")
+    parser.add_argument("--action", required=True, choices=["start_daemon", "disable", "enable", "apply", "check_now", "parse_upstreams", "validate", "probe", "status", "history"], help="Action to perform.")
+    parser.add_argument("--file", help="Path to the realm config file.")
+    parser.add_argument("--address", help="The upstream address to act upon for disable/enable/probe actions.")
+    parser.add_argument("--state-file", help="Path to the state backup JSON file.")
+    parser.add_argument("--checks-file", default=HEALTH_CHECKS_FILE, help="Path to health_checks.conf for check_now.")
+    parser.add_argument("--line", type=int, help="Only run this line (1-based) of the health checks file for check_now.")
+    parser.add_argument("--enable", action="append", metavar="ADDRESS", help="Address to enable in an 'apply' batch (repeatable).")
+    parser.add_argument("--disable", action="append", metavar="ADDRESS", help="Address to disable in an 'apply' batch (repeatable).")
+    parser.add_argument("--probe", help="Built-in probe to run for the probe action, e.g. 'builtin:tcp'.")
+    parser.add_argument("--timeout", type=int, default=10, help="Overall timeout in seconds for the probe action.")
+    parser.add_argument("--history-file", default=HEALTH_HISTORY_FILE, help="Path to the probe history file for the history action.")
+    parser.add_argument("--hours", type=float, default=24, help="How many hours of probe history the history action summarizes.")
+    parser.add_argument("--profile", action="store_true", help="Profile check cycles from start_daemon and save slow ones (SIGUSR1 toggles this at runtime).")
+    parser.add_argument("--json", action="store_true", help="Print the history summary as JSON.")
+    parser.add_argument("--tsv", action="store_true", help="Print check_now results as tab-separated rows instead of JSON lines.")
+    
+    args = parser.parse_args()
+
+    if args.action == "start_daemon":
+        health_check_daemon(args.profile)
+    elif args.action in ["disable", "enable"]:
+        if not all([args.file, args.address, args.state_file]):
+            sys.exit(1)
+        response = control_request_one({'cmd': args.action, 'address': args.address,
+                                        'file': args.file, 'state_file': args.state_file})
+        if response is None:
+            perform_modification(args.file, args.action, args.address, args.state_file)
+        elif not response.get('ok'):
+            log(f"守护进程未能应用修改: {response.get('error', '配置校验失败')}", "ERROR")
+            sys.exit(1)
+        elif response.get('changed'):
+            log(f"配置已由守护进程更新 (操作: {args.action}, 地址: {args.address})。")
+    elif args.action == "apply":
+        if not all([args.file, args.state_file]):
+            sys.exit(1)
+        operations = parse_apply_operations(args)
+        if operations is None:
+            sys.exit(1)
+        if not operations:
+            return
+        response = control_request_one({'cmd': 'apply', 'file': args.file, 'state_file': args.state_file,
+                                        'operations': [{'action': action, 'address': addr} for action, addr in operations]})
+        if response is None:
+            summary = perform_batch_modification(args.file, operations, args.state_file)
+        elif response.get('ok'):
+            summary = [(item['action'], item['address'], item['changed']) for item in response['summary']]
+        else:
+            log(f"守护进程未能应用修改: {response.get('error', '配置校验失败')}", "ERROR")
+            summary = None
+        if summary is None:
+            sys.exit(1)
+        print_apply_summary(summary)
+    elif args.action == "check_now":
+        check_now(args.checks_file, args.state_file or STATE_BACKUP_FILE, args.line, args.tsv)
+    elif args.action == "parse_upstreams":
+        if not args.file:
+            sys.exit(1)
+        response = control_request_one({'cmd': 'list', 'file': args.file})
+        if response is not None and response.get('ok'):
+            for upstream in response['upstreams']:
+                print(upstream)
+        else:
+            parse_and_print_upstreams(args.file)
+    elif args.action == "status":
+        response = control_request_one({'cmd': 'status'})
+        if response is None:
+            log("健康检测守护进程未运行或控制套接字不可用。", "WARN")
+            sys.exit(1)
+        print(json.dumps(response, indent=2, ensure_ascii=False))
+    elif args.action == "history":
+        if not print_history(args.history_file, args.address, args.hours, args.json):
+            sys.exit(1)
+    elif args.action == "probe":
+        if not args.address or not args.probe or not args.probe.startswith(BUILTIN_PROBE_PREFIX):
+            sys.exit(1)
+        task = parse_health_check_line(f"{args.address}={args.probe}", 0, args.timeout)
+        if task is None:
             sys.exit(1)
-        parse_and_print_upstreams(args.file)
+        result = run_async(run_builtin_probe(task.kind, task.host, task.port, task.timeout, task.options))
+        if result.detail:
+            print(f"Detail: {result.detail}")
+        if result.latencies:
+            stats = latency_stats(result.latencies)
+            print(f"Latencies: {format_latencies(result.latencies)}")
+            summary = f"{stats['sent']} sent, {stats['received']} received, {stats['loss']:.0%} loss"
+            if stats['received']:
+                summary += f", rtt min/avg/max = {stats['rtt_min'] * 1000:.1f}/{stats['rtt_avg'] * 1000:.1f}/{stats['rtt_max'] * 1000:.1f} ms"
+            print(summary)
+        sys.exit(result.exit_code)
 
 if __name__ == "__main__":
     main()
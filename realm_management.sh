@@ -52,6 +52,9 @@ VALIDATOR_SCRIPT_PATH="${SCRIPT_DIR}/validator.py"
 HEALTH_CHECK_CONFIG_FILE="${REALM_CONFIG_DIR}/health_checks.conf"
 HEALTH_CHECK_LOG_FILE="/var/log/realm_health_check.log"
 STATE_BACKUP_FILE="${SCRIPT_DIR}/state.backup.json"
+HEALTH_STATE_FILE="${SCRIPT_DIR}/health_state.json"
+HEALTH_HISTORY_FILE="${SCRIPT_DIR}/health_history.bin"
+PROFILE_DIR="${SCRIPT_DIR}/profiles"
 
 DAEMON_PID_FILE="/var/run/realm_health_check_daemon.pid"
 
@@ -479,8 +482,9 @@ uninstall_realm() {
         rm -rf "$REALM_CONFIG_DIR"
         
         _log warn "正在删除健康检测日志、状态文件和脚本配置文件..."
-        rm -f "$HEALTH_CHECK_LOG_FILE"
-        rm -f "$STATE_BACKUP_FILE"
+        rm -f "$HEALTH_CHECK_LOG_FILE" "$HEALTH_CHECK_LOG_FILE".*.gz "$HEALTH_CHECK_LOG_FILE".bak
+        rm -f "$STATE_BACKUP_FILE" "$HEALTH_STATE_FILE" "$HEALTH_HISTORY_FILE"
+        rm -rf "$PROFILE_DIR"
         rm -f "$MANAGER_SETTINGS_FILE"
 
         rm -f "$DAEMON_SERVICE_FILE"
@@ -753,13 +757,12 @@ parse_upstreams_from_config() {
 }
 
 
-modify_upstream_state() {
-    local address="$1"
-    local action="$2"
-
-    _log info "通过执行器调用 Python 核心逻辑处理配置文件..."
-    if ! bash "$PYTHON_EXECUTOR_SCRIPT" modify_state "$action" "$address" "$REALM_CONFIG_FILE" "$STATE_BACKUP_FILE"; then
+apply_upstream_states() {
+    # 参数为 --enable <地址> / --disable <地址> 的组合，一次性写回配置与状态文件
+    _log info "通过执行器调用 Python 核心逻辑批量处理配置文件..."
+    if ! bash "$PYTHON_EXECUTOR_SCRIPT" apply_state "$REALM_CONFIG_FILE" "$STATE_BACKUP_FILE" "$@"; then
         _log err "配置文件修改失败，请检查 Python 脚本输出。"
+        return 1
     fi
 }
 
@@ -771,69 +774,50 @@ run_manual_health_check() {
         return
     fi
 
-    local checks_to_run
-    if [[ -n "$line_to_check" ]]; then
-        checks_to_run=$(sed -n "${line_to_check}p" "$HEALTH_CHECK_CONFIG_FILE")
-    else
-        checks_to_run=$(cat "$HEALTH_CHECK_CONFIG_FILE")
-    fi
-
     (
         echo -e "\n--- [手动检测] Manual Check Executed: $(date) ---"
         declare -A failed_upstreams
         declare -A recovered_upstreams
-        
-        while IFS= read -r line; do
-            if [[ -z "$line" ]]; then
+        local checked_count=0
+
+        # 所有检测并发执行，结果按完成顺序以制表符分隔的行逐条返回 (字段由 Python 端清理，可安全按列读取)
+        _log info "正在并发执行健康检测，结果将按完成顺序显示..."
+        while IFS= read -r result_line; do
+            if [[ "$result_line" != result$'\t'* ]]; then
+                echo "$result_line"
                 continue
             fi
-            
-            local upstream_addr
-            upstream_addr=$(echo "$line" | cut -d'=' -f1)
-            
-            local script_path
-            script_path=$(echo "$line" | cut -d'=' -f2-)
-            
-            echo -e "\n${CYAN}正在检测: ${upstream_addr}${RESET}"
-            
-            local host=""
-            local port=""
-            if [[ $upstream_addr =~ ^\[(.+)\]:(.+) ]]; then
-                host=${BASH_REMATCH[1]}
-                port=${BASH_REMATCH[2]}
-            elif [[ $upstream_addr =~ ^([^:]+):([^:]+)$ ]]; then
-                host=${BASH_REMATCH[1]}
-                port=${BASH_REMATCH[2]}
+
+            local _tag upstream_addr probe exit_code verdict detail
+            IFS=$'\t' read -r _tag upstream_addr probe exit_code verdict detail <<< "$result_line"
+            checked_count=$((checked_count + 1))
+
+            if [[ "$verdict" == "failed" ]]; then
+                echo -e "${RED}  [${checked_count}] ${upstream_addr} (${probe}) -> 检测结果: 异常 (退出码: ${exit_code}${detail:+, ${detail}})${RESET}"
+                failed_upstreams["$upstream_addr"]=1
             else
-                host=$upstream_addr
-            fi
-            
-            timeout 10 "$script_path" "$host" "$port"
-            local exit_code=$?
-            
-            if [[ $exit_code -eq 0 ]]; then
-                echo -e "${GREEN}  -> 检测结果: 正常 (退出码: 0)${RESET}"
-                if [[ -f "$STATE_BACKUP_FILE" ]] && grep -qF "\"${upstream_addr}\"" "$STATE_BACKUP_FILE" &>/dev/null; then
+                echo -e "${GREEN}  [${checked_count}] ${upstream_addr} (${probe}) -> 检测结果: 正常 (退出码: 0)${RESET}"
+                if [[ "$verdict" == "recovered" ]]; then
                     recovered_upstreams["$upstream_addr"]=1
                 fi
-            else
-                echo -e "${RED}  -> 检测结果: 异常 (退出码: ${exit_code})${RESET}"
-                failed_upstreams["$upstream_addr"]=1
             fi
-        done <<< "$checks_to_run"
+        done < <(bash "$PYTHON_EXECUTOR_SCRIPT" check_now "$HEALTH_CHECK_CONFIG_FILE" "$STATE_BACKUP_FILE" $line_to_check)
+
+        for addr in "${!failed_upstreams[@]}"; do
+            unset "recovered_upstreams[$addr]"
+        done
 
         echo "-------------------------------------"
         local config_modified=false
+        local batch_args=()
         
         if [ ${#recovered_upstreams[@]} -gt 0 ]; then
             _log succ "检测到已恢复的节点，是否要立即在配置文件中启用它们?"
             read -e -p "请输入 [Y/n] 进行确认: " apply_choice
             if [[ ${apply_choice:-Y} =~ ^[Yy]$ ]]; then
-                _log info "正在应用恢复..."
                 for addr in "${!recovered_upstreams[@]}"; do
-                    modify_upstream_state "$addr" "enable"
+                    batch_args+=(--enable "$addr")
                 done
-                config_modified=true
             else
                 _log info "取消恢复操作。"
             fi
@@ -843,16 +827,21 @@ run_manual_health_check() {
             _log warn "检测到异常上游节点，是否要立即在配置文件中禁用它们?"
             read -e -p "请输入 [Y/n] 进行确认: " apply_choice
             if [[ ${apply_choice:-Y} =~ ^[Yy]$ ]]; then
-                _log info "正在应用禁用..."
                 for addr in "${!failed_upstreams[@]}"; do
-                    modify_upstream_state "$addr" "disable"
+                    batch_args+=(--disable "$addr")
                 done
-                config_modified=true
             else
                 _log info "取消禁用操作。"
             fi
         fi
 
+        if [ ${#batch_args[@]} -gt 0 ]; then
+            _log info "正在应用恢复/禁用..."
+            if apply_upstream_states "${batch_args[@]}"; then
+                config_modified=true
+            fi
+        fi
+
         if [[ "$config_modified" == true ]]; then
             _log info "配置已更改。是否立即重启 Realm 服务以使配置生效?"
             read -e -p "请输入 [Y/n] 进行确认: " restart_choice
@@ -970,29 +959,70 @@ manage_health_checks() {
                 _log info "请为这些上游地址统一配置检测脚本:"
                 echo "  1) ICMP Ping (ping_check.sh) - 检查网络可达性"
                 echo "  2) TCP Ping  (tcp_ping_check.sh) - 检查端口可用性"
+                echo "  3) 内置 TCP 探测 (builtin:tcp) - 守护进程内并发检测端口，无需派生进程"
+                echo "  4) 内置 ICMP 探测 (builtin:icmp) - 守护进程内共享套接字批量 Ping，无需派生进程"
+                echo "  5) 内置 HTTP(S) 探测 (builtin:http / builtin:https) - 检查 HTTP 状态码，复用长连接"
+                echo "  6) 内置 TLS 握手探测 (builtin:tls) - 检查 TLS 握手与证书"
+                echo "  7) 内置 UDP 回显探测 (builtin:udp) - 检查 UDP echo 服务"
                 read -e -p "请选择 [默认: 1]: " script_choice
                 script_choice=${script_choice:-1}
                 
                 local default_script_path=""
+                local script_path=""
                 if [[ "$script_choice" == "1" ]]; then
                     default_script_path="$DEFAULT_PING_SCRIPT_PATH"
                 elif [[ "$script_choice" == "2" ]]; then
                     default_script_path="$DEFAULT_TCP_PING_SCRIPT_PATH"
+                elif [[ "$script_choice" == "3" ]]; then
+                    script_path="builtin:tcp"
+                elif [[ "$script_choice" == "4" ]]; then
+                    script_path="builtin:icmp"
+                elif [[ "$script_choice" == "5" ]]; then
+                    read -e -p "是否使用 HTTPS? [y/N]: " use_https
+                    read -e -p "请输入请求路径 [默认: /]: " http_path
+                    http_path=${http_path:-/}
+                    if [[ "$http_path" != /* ]] || [[ "$http_path" =~ [[:space:]] ]]; then
+                        _log err "无效的路径: '$http_path'。路径必须以 / 开头且不能包含空格。"
+                        sleep 2
+                        continue
+                    fi
+                    if [[ "$use_https" == "y" || "$use_https" == "Y" ]]; then
+                        script_path="builtin:https path=${http_path}"
+                    else
+                        script_path="builtin:http path=${http_path}"
+                    fi
+                elif [[ "$script_choice" == "6" ]]; then
+                    script_path="builtin:tls"
+                elif [[ "$script_choice" == "7" ]]; then
+                    script_path="builtin:udp"
                 else
                     _log err "无效选择。"
                     sleep 2
                     continue
                 fi
                 
-                read -e -p "请输入脚本路径 [默认: $default_script_path]: " script_path
-                script_path=${script_path:-$default_script_path}
+                if [[ -z "$script_path" ]]; then
+                    read -e -p "请输入脚本路径 [默认: $default_script_path]: " script_path
+                    script_path=${script_path:-$default_script_path}
+                fi
                 
-                if [[ ! -f "$script_path" ]] || [[ ! -x "$script_path" ]]; then
+                if [[ "$script_path" != builtin:* ]] && { [[ ! -f "$script_path" ]] || [[ ! -x "$script_path" ]]; }; then
                     _log err "脚本不存在或没有执行权限: $script_path"
                     sleep 2
                     continue
                 fi
                 
+                local check_options=""
+                read -e -p "请输入检测间隔秒数 [留空则跟随全局 Cron 周期]: " check_interval
+                if [[ -n "$check_interval" ]]; then
+                    if ! [[ "$check_interval" =~ ^[1-9][0-9]*$ ]]; then
+                        _log err "无效的间隔: '$check_interval'。请输入正整数秒数。"
+                        sleep 2
+                        continue
+                    fi
+                    check_options=" interval=${check_interval}"
+                fi
+                
                 mkdir -p "$(dirname "$HEALTH_CHECK_CONFIG_FILE")"
                 touch "$HEALTH_CHECK_CONFIG_FILE"
                 
@@ -1003,7 +1033,7 @@ manage_health_checks() {
                     escaped_addr=$(sed 's/[&/\]/\\&/g' <<< "$upstream_addr")
 
                     sed -i "/^${escaped_addr}=/d" "$HEALTH_CHECK_CONFIG_FILE"
-                    echo "${upstream_addr}=${script_path}" >> "$HEALTH_CHECK_CONFIG_FILE"
+                    echo "${upstream_addr}=${script_path}${check_options}" >> "$HEALTH_CHECK_CONFIG_FILE"
                     ((success_count++))
                 done
 
@@ -1154,6 +1184,11 @@ start_or_restart_health_check_daemon() {
 
     detect_config_file
     
+    # 保留用户手动添加的调优项 (如 RESTART_BATCH_WINDOW)，仅重写由脚本管理的键
+    local extra_settings=""
+    if [[ -f "$DAEMON_CONFIG_FILE" ]]; then
+        extra_settings=$(grep -vE '^(HEALTH_CHECK_CRON|REALM_CONFIG_DIR|REALM_CONFIG_FILE|HEALTH_CHECKS_FILE|STATE_BACKUP_FILE|VENV_PYTHON|HEALTH_CHECK_LOG_FILE)=' "$DAEMON_CONFIG_FILE")
+    fi
 
     cat > "$DAEMON_CONFIG_FILE" <<EOF
 HEALTH_CHECK_CRON=${effective_cron}
@@ -1164,9 +1199,13 @@ STATE_BACKUP_FILE=${STATE_BACKUP_FILE}
 VENV_PYTHON=${VENV_PATH}/bin/python3
 HEALTH_CHECK_LOG_FILE=${HEALTH_CHECK_LOG_FILE}
 EOF
+    if [[ -n "$extra_settings" ]]; then
+        echo "$extra_settings" >> "$DAEMON_CONFIG_FILE"
+    fi
     
 
-    if [[ ! -f "$DAEMON_SERVICE_FILE" ]]; then
+    # 旧版单元文件由 systemd 追加写日志，现由守护进程自行写入并轮转日志文件，需重新生成
+    if [[ ! -f "$DAEMON_SERVICE_FILE" ]] || grep -q "^StandardOutput=append:" "$DAEMON_SERVICE_FILE"; then
         _log info "正在创建健康检测服务的 systemd 单元文件: $DAEMON_SERVICE_FILE"
         cat > "$DAEMON_SERVICE_FILE" <<EOF
 [Unit]
@@ -1181,8 +1220,8 @@ ExecStart=${PYTHON_EXECUTOR_SCRIPT} start_daemon
 EnvironmentFile=${DAEMON_CONFIG_FILE}
 Restart=on-failure
 RestartSec=10
-StandardOutput=append:${HEALTH_CHECK_LOG_FILE}
-StandardError=append:${HEALTH_CHECK_LOG_FILE}
+StandardOutput=journal
+StandardError=journal
 
 [Install]
 WantedBy=multi-user.target
@@ -1261,6 +1300,17 @@ status_health_check_daemon() {
 
     systemctl status realm_health_check --no-pager
     echo "---"
+
+    _log info "正在通过控制套接字查询守护进程运行状态..."
+    if ! bash "$PYTHON_EXECUTOR_SCRIPT" daemon_status; then
+        _log warn "无法获取守护进程内部状态 (守护进程可能未运行)。"
+    fi
+    echo "---"
+
+    if [[ -f "$HEALTH_HISTORY_FILE" ]]; then
+        bash "$PYTHON_EXECUTOR_SCRIPT" health_history "$HEALTH_HISTORY_FILE" || _log warn "无法读取检测历史。"
+        echo "---"
+    fi
 }
 
 
@@ -14,6 +14,7 @@ set -e
 SCRIPT_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" &>/dev/null && pwd)
 VENV_PATH="${SCRIPT_DIR}/.venv"
 REQUIREMENTS_FILE="${SCRIPT_DIR}/requirements.txt"
+REQUIREMENTS_STAMP_FILE="${VENV_PATH}/.requirements.stamp"
 MANAGER_SETTINGS_FILE="${SCRIPT_DIR}/.realm_management_script_config.conf"
 
 
@@ -155,6 +156,18 @@ init_and_activate_env() {
     fi
 
 
+    if [ ! -f "$REQUIREMENTS_FILE" ]; then
+        _log err "'requirements.txt' 文件未找到！"
+        exit 1
+    fi
+
+    # requirements.txt 与解释器版本均未变化时跳过 pip，避免每次菜单操作都等待依赖解析
+    local fingerprint
+    fingerprint=$(requirements_fingerprint)
+    if [[ -z "$FORCE_REQUIREMENTS_INSTALL" && -f "$REQUIREMENTS_STAMP_FILE" && "$(cat "$REQUIREMENTS_STAMP_FILE")" == "$fingerprint" ]]; then
+        return 0
+    fi
+
     local active_pip
     active_pip=$(type -p pip)
     if [[ -z "$active_pip" ]]; then
@@ -162,14 +175,61 @@ init_and_activate_env() {
         exit 1
     fi
 
+    "$active_pip" install -q --root-user-action=ignore -r "$REQUIREMENTS_FILE"
+    echo "$fingerprint" > "$REQUIREMENTS_STAMP_FILE"
 
-    if [ -f "$REQUIREMENTS_FILE" ]; then
-        "$active_pip" install -q --root-user-action=ignore -r "$REQUIREMENTS_FILE"
-    else
-        _log err "'requirements.txt' 文件未找到！"
+}
+
+
+requirements_fingerprint() {
+    local python_version
+    python_version=$("$(type -p python)" --version 2>&1)
+    { cat "$REQUIREMENTS_FILE"; echo "$python_version"; } | sha256sum | cut -d' ' -f1
+}
+
+
+startup_run_ms() {
+    local start end
+    start=$(date +%s%N)
+    if ! bash "$0" init_env >&2; then
+        _log err "环境初始化失败，已停止测量启动耗时。"
         exit 1
     fi
+    if ! "$ACTIVE_PYTHON" -c "import sys; sys.path.insert(0, '${SCRIPT_DIR}'); import health_checker_daemon, validator" >&2; then
+        _log err "导入 Python 模块失败，已停止测量启动耗时。"
+        exit 1
+    fi
+    end=$(date +%s%N)
+    echo $(( (end - start) / 1000000 ))
+}
+
 
+measure_startup() {
+    # 冷启动（删除 stamp，强制执行 pip）作为基线，与热启动（跳过 pip）对比；可选第二个参数为热启动平均耗时上限 (ms)
+    local runs="${1:-5}"
+    local budget_ms="$2"
+    local total_ms=0
+    local i cold_ms warm_ms
+
+    if ! [[ "$runs" =~ ^[1-9][0-9]*$ ]]; then
+        _log err "测量次数必须是正整数: '$runs'"
+        exit 1
+    fi
+    rm -f "$REQUIREMENTS_STAMP_FILE"
+    cold_ms=$(startup_run_ms) || exit 1
+    for (( i=0; i<runs; i++ )); do
+        warm_ms=$(startup_run_ms) || exit 1
+        total_ms=$(( total_ms + warm_ms ))
+    done
+    warm_ms=$(( total_ms / runs ))
+
+    _log info "执行器启动耗时 (环境检查 + 导入 Python 模块):"
+    _log info "  冷启动 (无 stamp，执行 pip): ${cold_ms} ms"
+    _log info "  热启动 (跳过 pip): 平均 ${warm_ms} ms (共 ${runs} 次)，节省 $(( cold_ms - warm_ms )) ms"
+    if [[ -n "$budget_ms" ]] && (( warm_ms > budget_ms )); then
+        _log err "热启动平均耗时 ${warm_ms} ms 超过上限 ${budget_ms} ms。"
+        exit 1
+    fi
 }
 
 
@@ -199,8 +259,32 @@ case "$ACTION" in
 
         "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action "$1" --address "$2" --file "$3" --state-file "$4"
         ;;
+    check_now)
+
+        "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action check_now --tsv --checks-file "$1" --state-file "$2" ${3:+--line "$3"}
+        ;;
+    apply_state)
+
+        "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action apply --file "$1" --state-file "$2" "${@:3}"
+        ;;
+    measure_startup)
+
+        measure_startup "$1" "$2"
+        ;;
+    daemon_status)
+
+        "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action status
+        ;;
+    health_history)
+
+        "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action history --history-file "$1" ${2:+--address "$2"}
+        ;;
+    run_probe)
+
+        "$ACTIVE_PYTHON" "$DAEMON_SCRIPT_PATH" --action probe --address "$1" --probe "$2"
+        ;;
     start_daemon)
-        exec "$ACTIVE_PYTHON" -u "$DAEMON_SCRIPT_PATH" --action start_daemon
+        exec "$ACTIVE_PYTHON" -u "$DAEMON_SCRIPT_PATH" --action start_daemon "$@"
         ;;
     *)
         _log err "传递给Python执行器的无效操作: '$ACTION'"
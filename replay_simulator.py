@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""Replays probe results through the daemon's failover decisions, offline and at accelerated time.
+
+The trace is a recorded probe history (the daemon's health_history.bin or a
+CSV of `timestamp,address,ok`) or a synthetic one with random outages. Each
+trace becomes a list of up/down transitions per upstream, held until the next
+one. The simulator runs cycles every --period seconds on a virtual clock. It
+uses the daemon's own decide_upstreams(), RestartCoordinator,
+apply_decisions() and probe backoff against an in-memory ConfigModel, without
+systemctl, files or the network.
+
+Cycles where nothing can change are skipped. A healthy, enabled upstream is
+not probed again until its next transition, and a backed-off one not before
+its backoff expires, so months of trace replay in well under a second. Every
+option takes a comma-separated list, and all combinations are simulated as a
+grid.
+"""
+import sys
+import os
+import io
+import csv
+import json
+import math
+import heapq
+import random
+import bisect
+import struct
+import argparse
+import itertools
+from contextlib import redirect_stdout
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import health_checker_daemon as daemon
+
+class Trace:
+    """Up/down transitions per upstream over [start, end); the first recorded state also covers the time before it."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self._times = {}
+        self._states = {}
+
+    def add_samples(self, address, samples):
+        """Adds time-ordered (timestamp, ok) samples, keeping only the changes of state."""
+        times, states = self._times.setdefault(address, []), self._states.setdefault(address, [])
+        for timestamp, ok in samples:
+            if not states or states[-1] != ok:
+                times.append(timestamp)
+                states.append(ok)
+
+    def addresses(self):
+        return list(self._times)
+
+    def ok(self, address, at):
+        times, states = self._times[address], self._states[address]
+        index = bisect.bisect_right(times, at) - 1
+        return states[max(index, 0)]
+
+    def next_change(self, address, after):
+        times = self._times[address]
+        index = bisect.bisect_right(times, after)
+        return times[index] if index < len(times) else math.inf
+
+    def outages(self, address):
+        """Yields (start, end) of every down interval, clipped to the trace."""
+        times, states = self._times[address], self._states[address]
+        down_since = None
+        for index, (timestamp, ok) in enumerate(zip(times, states)):
+            if not ok and down_since is None:
+                down_since = self.start if index == 0 else timestamp
+            elif ok and down_since is not None:
+                yield down_since, timestamp
+                down_since = None
+        if down_since is not None:
+            yield down_since, self.end
+
+def load_history_trace(path):
+    history = daemon.HistoryRing.open_for_read(path)
+    try:
+        records = {address: history.history(address) for address in history.addresses()}
+    finally:
+        history.close()
+    return build_trace((address, timestamp, status == daemon.HistoryRing.STATUS_OK)
+                       for address, entries in records.items() for timestamp, status, _ in entries)
+
+def load_csv_trace(path):
+    def rows():
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#') or row[0] == 'timestamp':
+                    continue
+                yield row[1].strip(), float(row[0]), row[2].strip().lower() in ('1', 'ok', 'true', 'up')
+    return build_trace(rows())
+
+def build_trace(rows):
+    by_address = {}
+    for address, timestamp, ok in rows:
+        by_address.setdefault(address, []).append((timestamp, ok))
+    if not by_address:
+        raise ValueError("trace is empty")
+    for samples in by_address.values():
+        samples.sort()
+    trace = Trace(min(samples[0][0] for samples in by_address.values()),
+                  max(samples[-1][0] for samples in by_address.values()))
+    for address, samples in by_address.items():
+        trace.add_samples(address, samples)
+    return trace
+
+def synthetic_trace(addresses, days, mtbf_hours, mttr_minutes, blip_ratio, seed):
+    """Alternating up/down periods per upstream with exponential lengths.
+
+    A `blip_ratio` share of outages are short blips of a few seconds to a
+    minute, and the rest last `mttr_minutes` on average.
+    """
+    rng = random.Random(seed)
+    end = days * 86400.0
+    trace = Trace(0.0, end)
+    for address in addresses:
+        samples, now = [(0.0, True)], 0.0
+        while True:
+            now += rng.expovariate(1 / (mtbf_hours * 3600))
+            if now >= end:
+                break
+            samples.append((now, False))
+            mean_down = 30 if rng.random() < blip_ratio else mttr_minutes * 60
+            now += max(1.0, rng.expovariate(1 / mean_down))
+            samples.append((now, True))
+        trace.add_samples(address, samples)
+    return trace
+
+def synthetic_config(addresses, remotes_per_endpoint):
+    """One endpoint per `remotes_per_endpoint` addresses, in trace order."""
+    endpoints = []
+    for index in range(0, len(addresses), remotes_per_endpoint):
+        group = addresses[index:index + remotes_per_endpoint]
+        endpoint = OrderedDict([('listen', f"0.0.0.0:{10000 + len(endpoints)}"), ('remote', group[0])])
+        if len(group) > 1:
+            endpoint['extra_remotes'] = group[1:]
+        endpoints.append(endpoint)
+    return OrderedDict([('endpoints', endpoints)])
+
+class ReplaySimulator:
+    """Drives the decision core over a trace on a virtual clock and records what it changed."""
+
+    def __init__(self, config_data, trace, period, policy, batch_window, min_interval, burst):
+        self.trace = trace
+        self.period = period
+        self.policy = policy
+        self.model = daemon.ConfigModel(json.loads(json.dumps(config_data), object_pairs_hook=OrderedDict))
+        self.state_data = OrderedDict()
+        self.health = {}
+        self.now = trace.start
+        self.coordinator = daemon.RestartCoordinator(batch_window, min_interval, burst, clock=lambda: self.now)
+        self.events = []
+        self.removed_since = {}
+        self.removed_seconds = 0.0
+        self.endpoints_removed = 0
+        self.cycles = 0
+        self.probes = 0
+
+    def _next_cycle(self, after):
+        if after == math.inf:
+            return after
+        return self.trace.start + math.ceil((after - self.trace.start) / self.period - 1e-9) * self.period
+
+    def _apply(self, upstreams_to_enable, upstreams_to_disable, weight_changes):
+        listens_before = self.model.listen_addresses()
+        changed, _ = daemon.apply_decisions(self.model, self.state_data, upstreams_to_enable, upstreams_to_disable)
+        if not changed:
+            return False
+        self.events.extend((self.now, 'enable', address) for address in upstreams_to_enable)
+        self.events.extend((self.now, 'disable', address) for address in upstreams_to_disable)
+        listens_after = self.model.listen_addresses()
+        for listen in listens_before - listens_after:
+            self.removed_since[listen] = self.now
+            self.endpoints_removed += 1
+        for listen in listens_after - listens_before:
+            self.removed_seconds += self.now - self.removed_since.pop(listen, self.now)
+        return True
+
+    def _due_after(self, address, ok):
+        """Cycle time at which `address` next needs probing after a probe at self.now."""
+        upstream = self.health[address]
+        if address in self.state_data:
+            backoff = daemon.probe_backoff_seconds(upstream.failures, self.period, self.policy)
+            if backoff:
+                return self._next_cycle(self.now + backoff)
+        pending = address in self.coordinator.pending_enable or address in self.coordinator.pending_disable
+        if ok and not pending and address not in self.state_data and upstream.successes >= self.policy.successes_to_enable:
+            return self._next_cycle(max(self.now + self.period, self.trace.next_change(address, self.now)))
+        return self.now + self.period
+
+    def run(self):
+        traced = set(self.trace.addresses())
+        due = [(self.trace.start, address) for address in sorted(self.model.active_upstreams()) if address in traced]
+        heapq.heapify(due)
+        while due:
+            wait = self.coordinator.seconds_until_ready()
+            if wait is not None and self.now + wait < due[0][0] and self.now + wait < self.trace.end:
+                self.now += wait
+                self.coordinator.flush(self._apply)
+                continue
+            if due[0][0] >= self.trace.end:
+                break
+            self.now = due[0][0]
+            results = []
+            while due and due[0][0] <= self.now:
+                address = heapq.heappop(due)[1]
+                results.append({'address': address, 'exit_code': 0 if self.trace.ok(address, self.now) else 1})
+            self.cycles += 1
+            self.probes += len(results)
+            decisions = daemon.decide_upstreams(results, self.health, self.model, self.state_data, self.now, self.policy)
+            self.coordinator.submit(*decisions[:5])
+            if self.coordinator.seconds_until_ready() == 0:
+                self.coordinator.flush(self._apply)
+            for result in results:
+                heapq.heappush(due, (self._due_after(result['address'], result['exit_code'] == 0), result['address']))
+        for listen, since in self.removed_since.items():
+            self.removed_seconds += self.trace.end - since
+        return self.report()
+
+    def report(self):
+        changes = {}
+        for timestamp, action, address in self.events:
+            changes.setdefault(address, []).append((timestamp, action))
+        time_to_disable, time_to_recover = [], []
+        exposure, undetected, stale_disables = 0.0, 0, 0
+        for address in self.trace.addresses():
+            events = changes.get(address, [])
+            event_times = [t for t, _ in events]
+            stale_disables += sum(1 for t, action in events if action == 'disable' and self.trace.ok(address, t))
+            outages = list(self.trace.outages(address))
+            for index, (start, end) in enumerate(outages):
+                before = bisect.bisect_left(event_times, start)
+                if not before or events[before - 1][1] != 'disable':
+                    disabled = next((t for t, action in events[before:] if action == 'disable' and t < end), None)
+                    if disabled is None:
+                        undetected += 1
+                        exposure += end - start
+                        continue
+                    time_to_disable.append(disabled - start)
+                    exposure += disabled - start
+                next_start = outages[index + 1][0] if index + 1 < len(outages) else self.trace.end
+                enabled = next((t for t, action in events if action == 'enable' and end <= t < next_start), None)
+                if enabled is not None:
+                    time_to_recover.append(enabled - end)
+        return OrderedDict([
+            ('cycles', self.cycles), ('probes', self.probes),
+            ('restarts', self.coordinator.restarts), ('restarts_avoided', self.coordinator.restarts_avoided),
+            ('disables', sum(1 for _, action, _ in self.events if action == 'disable')),
+            ('stale_disables', stale_disables), ('undetected_outages', undetected),
+            ('time_to_disable', summarize(time_to_disable)), ('time_to_recover', summarize(time_to_recover)),
+            ('failing_in_config_seconds', exposure),
+            ('endpoints_removed', self.endpoints_removed), ('endpoint_removed_seconds', self.removed_seconds),
+        ])
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return OrderedDict([('count', len(values)), ('mean', sum(values) / len(values)),
+                        ('p50', values[len(values) // 2]), ('p95', values[min(len(values) - 1, int(0.95 * len(values)))]),
+                        ('max', values[-1])])
+
+def parse_grid(text, kind):
+    return [kind(value) for value in str(text).split(",") if value.strip()]
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds:.0f}s"
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放探测结果，以加速时间模拟守护进程的故障切换决策，并可对参数网格进行扫描。")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--history", metavar="FILE", help="回放守护进程记录的检测历史文件 (health_history.bin)。")
+    source.add_argument("--trace", metavar="FILE", help="回放 CSV 轨迹，每行 'timestamp,address,ok'。")
+    parser.add_argument("--config", help="Realm 配置文件；未指定时按 --remotes 将轨迹中的地址分组生成。")
+    parser.add_argument("--remotes", type=int, default=2, help="生成配置时每个 endpoint 的上游数量 (默认 2)。")
+    parser.add_argument("--upstreams", type=int, default=50, help="合成轨迹的上游数量 (默认 50)。")
+    parser.add_argument("--days", type=float, default=90, help="合成轨迹的天数 (默认 90)。")
+    parser.add_argument("--mtbf-hours", type=float, default=72, help="合成轨迹中两次故障的平均间隔小时数 (默认 72)。")
+    parser.add_argument("--mttr-minutes", type=float, default=15, help="合成轨迹中非瞬断故障的平均持续分钟数 (默认 15)。")
+    parser.add_argument("--blip-ratio", type=float, default=0.5, help="合成轨迹中瞬断 (约 30 秒) 所占比例 (默认 0.5)。")
+    parser.add_argument("--seed", type=int, default=1, help="合成轨迹的随机种子。")
+    parser.add_argument("--period", default=None, help="检测周期秒数，默认取 HEALTH_CHECK_CRON 的周期。")
+    parser.add_argument("--failures", default=str(daemon.FAILURES_TO_DISABLE), help="FAILURES_TO_DISABLE 取值。")
+    parser.add_argument("--successes", default=str(daemon.SUCCESSES_TO_ENABLE), help="SUCCESSES_TO_ENABLE 取值。")
+    parser.add_argument("--flap-suppress", default=f"{daemon.FLAP_SUPPRESS_LIMIT:g}", help="FLAP_SUPPRESS_LIMIT 取值。")
+    parser.add_argument("--batch-window", default=f"{daemon.RESTART_BATCH_WINDOW:g}", help="RESTART_BATCH_WINDOW 取值。")
+    parser.add_argument("--min-interval", default=f"{daemon.RESTART_MIN_INTERVAL:g}", help="RESTART_MIN_INTERVAL 取值。")
+    parser.add_argument("--burst", default=str(daemon.RESTART_BURST), help="RESTART_BURST 取值。")
+    parser.add_argument("--json", action="store_true", help="以 JSON 行输出每组参数的结果。")
+    args = parser.parse_args()
+
+    try:
+        if args.history:
+            trace = load_history_trace(args.history)
+        elif args.trace:
+            trace = load_csv_trace(args.trace)
+        else:
+            addresses = [f"198.18.{i // 250}.{i % 250 + 1}:443" for i in range(args.upstreams)]
+            trace = synthetic_trace(addresses, args.days, args.mtbf_hours, args.mttr_minutes, args.blip_ratio, args.seed)
+        if args.config:
+            config_data = daemon.parse_toml(args.config)
+            if not config_data:
+                raise ValueError(f"无法解析配置文件 '{args.config}'")
+        else:
+            config_data = synthetic_config(sorted(trace.addresses()), max(1, args.remotes))
+        periods = parse_grid(args.period, float) if args.period else [daemon.cron_period_seconds(daemon.HEALTH_CHECK_CRON)]
+        grid = list(itertools.product(periods, parse_grid(args.failures, int), parse_grid(args.successes, int),
+                                      parse_grid(args.flap_suppress, float), parse_grid(args.batch_window, float),
+                                      parse_grid(args.min_interval, float), parse_grid(args.burst, int)))
+    except (OSError, ValueError, struct.error) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    days = (trace.end - trace.start) / 86400
+    print(f"轨迹: {len(trace.addresses())} 个上游, {days:.1f} 天, {sum(1 for a in trace.addresses() for _ in trace.outages(a))} 次故障; "
+          f"配置: {len(config_data.get('endpoints', []))} 个 endpoint。", file=sys.stderr)
+    if not args.json:
+        print(f"{'period':>7}{'fall':>5}{'rise':>5}{'supp':>6}{'batch':>6}{'minint':>7}{'burst':>6}"
+              f"{'restarts':>9}{'disables':>9}{'stale':>6}{'missed':>7}{'ttd p50':>9}{'ttd p95':>9}"
+              f"{'ttr p50':>9}{'ttr p95':>9}{'failing':>9}{'ep lost':>8}{'ep down':>9}")
+    for period, failures, successes, suppress, batch_window, min_interval, burst in grid:
+        policy = daemon.DEFAULT_POLICY._replace(failures_to_disable=max(1, failures), successes_to_enable=max(1, successes),
+                                                flap_suppress_limit=suppress)
+        simulator = ReplaySimulator(config_data, trace, period, policy, batch_window, min_interval, burst)
+        with redirect_stdout(io.StringIO()):
+            report = simulator.run()
+        params = OrderedDict([('period', period), ('failures_to_disable', failures), ('successes_to_enable', successes),
+                              ('flap_suppress_limit', suppress), ('batch_window', batch_window),
+                              ('min_interval', min_interval), ('burst', burst)])
+        if args.json:
+            print(json.dumps(OrderedDict([('params', params), ('report', report)]), ensure_ascii=False), flush=True)
+            continue
+        ttd, ttr = report['time_to_disable'] or {}, report['time_to_recover'] or {}
+        print(f"{period:>7g}{failures:>5}{successes:>5}{suppress:>6g}{batch_window:>6g}{min_interval:>7g}{burst:>6}"
+              f"{report['restarts']:>9}{report['disables']:>9}{report['stale_disables']:>6}{report['undetected_outages']:>7}"
+              f"{format_duration(ttd.get('p50')):>9}{format_duration(ttd.get('p95')):>9}"
+              f"{format_duration(ttr.get('p50')):>9}{format_duration(ttr.get('p95')):>9}"
+              f"{format_duration(report['failing_in_config_seconds']):>9}{report['endpoints_removed']:>8}"
+              f"{format_duration(report['endpoint_removed_seconds']):>9}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# The daemon reads its file locations from the environment at import time, so
+# point them at a scratch directory before any test module imports it.
+_WORKDIR = tempfile.mkdtemp(prefix="realm_health_tests_")
+for _name, _file in (("REALM_CONFIG_FILE", "config.toml"),
+                     ("HEALTH_CHECKS_FILE", "health_checks.conf"),
+                     ("STATE_BACKUP_FILE", "state.backup.json"),
+                     ("HEALTH_STATE_FILE", "health_state.json"),
+                     ("HEALTH_HISTORY_FILE", "health_history.bin"),
+                     ("CONTROL_SOCKET_PATH", "control.sock")):
+    os.environ.setdefault(_name, os.path.join(_WORKDIR, _file))
+os.environ.setdefault("HEALTH_CHECK_LOG_FILE", "-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "health_checker_daemon.py")
+
+class CheckNowOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.checks = os.path.join(self.workdir, "health_checks.conf")
+        self.state = os.path.join(self.workdir, "state.backup.json")
+        with open(self.checks, 'w', encoding='utf-8') as f:
+            f.write("bad line\n"
+                    "127.0.0.1:9=/bin/true\n"
+                    "127.0.0.1:9=/bin/true interval=600\n"
+                    "127.0.0.2:9=/bin/false\n")
+        with open(self.state, 'w', encoding='utf-8') as f:
+            f.write("{}")
+        self.env = dict(os.environ, CONTROL_SOCKET_PATH=os.path.join(self.workdir, "control.sock"),
+                        HEALTH_CHECK_LOG_FILE="-")
+
+    def check_now(self, *extra):
+        return subprocess.run([sys.executable, SCRIPT, "--action", "check_now", "--checks-file", self.checks,
+                               "--state-file", self.state] + list(extra),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                              env=self.env, timeout=60)
+
+    def test_stdout_is_json_lines_only(self):
+        process = self.check_now()
+        self.assertEqual(process.returncode, 0, process.stderr)
+        messages = [json.loads(line) for line in process.stdout.splitlines()]
+        self.assertEqual(messages[-1]['done'], True)
+        self.assertEqual(messages[-1]['checked'], 3)
+        self.assertEqual(messages[-1]['failed'], ["127.0.0.2:9"])
+        self.assertEqual(sorted((m['address'], m['verdict']) for m in messages[:-1]),
+                         [("127.0.0.1:9", "healthy"), ("127.0.0.1:9", "healthy"), ("127.0.0.2:9", "failed")])
+        self.assertIn("Ignoring malformed health check line", process.stderr)
+
+    def test_tsv_rows_only(self):
+        process = self.check_now("--tsv")
+        self.assertEqual(process.returncode, 0, process.stderr)
+        rows = [line.split("\t") for line in process.stdout.splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row[0] == "result" and len(row) == 6 for row in rows))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import health_checker_daemon as daemon
+
+def endpoint(listen, remotes, weights=None):
+    block = OrderedDict([("listen", listen), ("remote", remotes[0])])
+    if len(remotes) > 1:
+        block["extra_remotes"] = list(remotes[1:])
+    if weights:
+        block["balance"] = "roundrobin: {}".format(", ".join(str(w) for w in weights))
+    return block
+
+def sample_config():
+    return OrderedDict([
+        ("log", OrderedDict([("level", "warn")])),
+        ("endpoints", [
+            endpoint("0.0.0.0:1001", ["10.0.0.1:80"]),
+            endpoint("0.0.0.0:1002", ["10.0.0.1:80", "10.0.0.2:80", "10.0.0.3:80"], [3, 2, 1]),
+            endpoint("0.0.0.0:1003", ["10.0.0.2:80", "10.0.0.1:80"]),
+            endpoint("0.0.0.0:1004", ["10.0.0.4:80", "10.0.0.5:80"], [1, 1, 1]),
+            endpoint("0.0.0.0:1005", ["10.0.0.5:80", "10.0.0.4:80"], [5, 1]),
+        ]),
+    ])
+
+def as_json(data):
+    return json.dumps(data, sort_keys=False)
+
+def blocks(model):
+    return OrderedDict((ep["listen"], (daemon.ConfigModel.remotes_of(ep), ep.get("balance"))) for ep in model.endpoints())
+
+class ConfigModelRoundTripTest(unittest.TestCase):
+    def test_disable_rewrites_remotes_and_weights(self):
+        model, state_data = daemon.ConfigModel(sample_config()), {}
+        self.assertTrue(model.disable("10.0.0.1:80", state_data))
+        self.assertEqual(blocks(model), OrderedDict([
+            ("0.0.0.0:1002", (["10.0.0.2:80", "10.0.0.3:80"], "roundrobin: 2, 1")),
+            ("0.0.0.0:1003", (["10.0.0.2:80"], None)),
+            ("0.0.0.0:1004", (["10.0.0.4:80", "10.0.0.5:80"], "roundrobin: 1, 1, 1")),
+            ("0.0.0.0:1005", (["10.0.0.5:80", "10.0.0.4:80"], "roundrobin: 5, 1")),
+        ]))
+        self.assertEqual(sorted(item["listen"] for item in state_data["10.0.0.1:80"]),
+                         ["0.0.0.0:1001", "0.0.0.0:1002", "0.0.0.0:1003"])
+        self.assertEqual(model.endpoints_for("10.0.0.1:80"), [])
+
+        self.assertTrue(model.disable("10.0.0.2:80", state_data))
+        self.assertEqual(list(blocks(model)), ["0.0.0.0:1002", "0.0.0.0:1004", "0.0.0.0:1005"])
+        self.assertEqual(blocks(model)["0.0.0.0:1002"], (["10.0.0.3:80"], None))
+
+    def test_enable_restores_each_block_once(self):
+        model, state_data = daemon.ConfigModel(sample_config()), {}
+        model.disable("10.0.0.1:80", state_data)
+        model.disable("10.0.0.2:80", state_data)
+        self.assertTrue(model.enable("10.0.0.2:80", state_data))
+        self.assertTrue(model.enable("10.0.0.1:80", state_data))
+        self.assertEqual(state_data, {})
+        restored = sorted(model.endpoints(), key=lambda ep: ep["listen"])
+        self.assertEqual(as_json(restored), as_json(sample_config()["endpoints"]))
+        self.assertEqual([ep["listen"] for ep in model.endpoints_for("10.0.0.3:80")], ["0.0.0.0:1002"])
+
+    def test_batch_modification_round_trips_through_the_files(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        config_file, state_file = os.path.join(workdir, "config.toml"), os.path.join(workdir, "state.json")
+        with open(config_file, "w", encoding="utf-8") as f:
+            f.write(daemon.serialize_to_toml(sample_config()))
+        with open(state_file, "w", encoding="utf-8") as f:
+            f.write("{}")
+
+        summary = daemon.perform_batch_modification(config_file, [("disable", "10.0.0.1:80"), ("disable", "192.0.2.1:80")], state_file)
+        self.assertEqual(summary, [("disable", "10.0.0.1:80", True), ("disable", "192.0.2.1:80", False)])
+        self.assertNotIn("10.0.0.1:80", daemon.load_config_model(config_file).active_upstreams())
+
+        daemon.perform_batch_modification(config_file, [("enable", "10.0.0.1:80")], state_file)
+        self.assertEqual(daemon.load_json_file(state_file), {})
+        restored = sorted(daemon.load_config_model(config_file).endpoints(), key=lambda ep: ep["listen"])
+        self.assertEqual(as_json(restored), as_json(sample_config()["endpoints"]))
+
+    def test_disable_then_enable_restores_the_endpoints(self):
+        original = sample_config()
+        model, state_data = daemon.ConfigModel(copy.deepcopy(original)), {}
+        self.assertTrue(model.disable("10.0.0.1:80", state_data))
+        self.assertNotIn("10.0.0.1:80", model.active_upstreams())
+        self.assertNotIn("0.0.0.0:1001", model.listen_addresses())
+        self.assertEqual(model.endpoints_for("10.0.0.2:80")[0]["balance"], "roundrobin: 2, 1")
+
+        self.assertTrue(model.enable("10.0.0.1:80", state_data))
+        self.assertEqual(state_data, {})
+        restored = sorted(model.endpoints(), key=lambda ep: ep["listen"])
+        self.assertEqual(as_json(restored), as_json(original["endpoints"]))
+        self.assertEqual(model.active_upstreams(), {"10.0.0.1:80", "10.0.0.2:80", "10.0.0.3:80",
+                                                    "10.0.0.4:80", "10.0.0.5:80"})
+
+    def test_mismatched_weights_are_left_alone(self):
+        model, state_data = daemon.ConfigModel(sample_config()), {}
+        model.disable("10.0.0.4:80", state_data)
+        block = [ep for ep in model.endpoints() if ep["listen"] == "0.0.0.0:1004"][0]
+        self.assertEqual(block["remote"], "10.0.0.4:80")
+        self.assertEqual([ep["listen"] for ep in model.endpoints_for("10.0.0.4:80")], ["0.0.0.0:1004"])
+
+    def test_unknown_addresses_change_nothing(self):
+        model, state_data = daemon.ConfigModel(sample_config()), {}
+        self.assertFalse(model.enable("10.0.0.1:80", state_data))
+        self.assertFalse(model.disable("192.0.2.1:80", state_data))
+        self.assertEqual(as_json(model.to_data()), as_json(sample_config()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import health_checker_daemon as daemon
+
+class ControlSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, "control.sock")
+        patcher = mock.patch.object(daemon, 'CONTROL_SOCKET_PATH', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_server(self):
+        async def run():
+            server = await daemon.start_control_server(ctx=None)
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            return server is not None
+        return daemon.run_async(run())
+
+    def test_new_socket_is_private_from_the_start(self):
+        seen = []
+        original = daemon.asyncio.start_unix_server
+
+        async def recording_start(*args, **kwargs):
+            server = await original(*args, **kwargs)
+            seen.append(stat.S_IMODE(os.stat(self.path).st_mode))
+            return server
+
+        with mock.patch.object(daemon.asyncio, 'start_unix_server', recording_start):
+            self.assertTrue(self.start_server())
+        self.assertEqual(seen, [0o600])
+
+    def test_stale_socket_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.assertTrue(self.start_server())
+
+    def test_live_socket_of_another_daemon_is_left_alone(self):
+        live = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        live.bind(self.path)
+        live.listen(1)
+        self.addCleanup(live.close)
+        inode = os.stat(self.path).st_ino
+
+        self.assertFalse(self.start_server())
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.path)
+
+    def test_regular_file_is_not_removed(self):
+        with open(self.path, 'w') as f:
+            f.write("not a socket")
+        self.assertFalse(self.start_server())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "not a socket")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from collections import OrderedDict
+
+import health_checker_daemon as daemon
+
+POLICY = daemon.DecisionPolicy(failures_to_disable=2, successes_to_enable=2, flap_half_life=900,
+                               flap_suppress_limit=1500, flap_reuse_limit=750, probe_backoff_max=3600)
+
+def config():
+    return OrderedDict([("endpoints", [
+        OrderedDict([("listen", "0.0.0.0:1001"), ("remote", "10.0.0.1:80")]),
+        OrderedDict([("listen", "0.0.0.0:1002"), ("remote", "10.0.0.2:80"), ("extra_remotes", ["10.0.0.3:80"])]),
+    ])])
+
+def result(address, exit_code):
+    return {'address': address, 'exit_code': exit_code}
+
+class DecideUpstreamsTest(unittest.TestCase):
+    def setUp(self):
+        self.model = daemon.ConfigModel(config())
+        self.state_data = {}
+        self.health = {}
+        self.now = 10000.0
+
+    def decide(self, *check_results):
+        self.now += 60
+        return daemon.decide_upstreams(list(check_results), self.health, self.model, self.state_data, self.now, POLICY)
+
+    def disable(self, address):
+        self.model.disable(address, self.state_data)
+
+    def test_disables_after_consecutive_failures(self):
+        first = self.decide(result("10.0.0.2:80", 1), result("10.0.0.3:80", 0))
+        self.assertEqual(first.disable, set())
+        self.assertEqual(first.unhealthy, {"10.0.0.2:80"})
+        self.assertEqual(first.healthy, {"10.0.0.3:80"})
+
+        second = self.decide(result("10.0.0.2:80", 1))
+        self.assertEqual(second.disable, {"10.0.0.2:80"})
+        self.assertEqual(second.enable, set())
+
+    def test_a_success_resets_the_failure_count(self):
+        self.decide(result("10.0.0.2:80", 1))
+        self.decide(result("10.0.0.2:80", 0))
+        self.assertEqual(self.decide(result("10.0.0.2:80", 1)).disable, set())
+
+    def test_unknown_and_already_disabled_upstreams_are_not_disabled(self):
+        self.disable("10.0.0.2:80")
+        for _ in range(3):
+            decisions = self.decide(result("10.0.0.2:80", 1), result("192.0.2.1:80", 1))
+        self.assertEqual(decisions.disable, set())
+        self.assertEqual(self.health["192.0.2.1:80"].failures, 3)
+
+    def test_enables_after_consecutive_successes(self):
+        self.decide(result("10.0.0.2:80", 1))
+        self.decide(result("10.0.0.2:80", 1))
+        self.disable("10.0.0.2:80")
+
+        first = self.decide(result("10.0.0.2:80", 0))
+        self.assertEqual(first.enable, set())
+        self.assertEqual(first.recovered, ["10.0.0.2:80"])
+        second = self.decide(result("10.0.0.2:80", 0))
+        self.assertEqual(second.enable, {"10.0.0.2:80"})
+        self.assertEqual(second.recovered, [])
+        self.assertFalse(second.urgent)
+
+    def test_restoring_an_emptied_endpoint_is_urgent(self):
+        self.decide(result("10.0.0.1:80", 1))
+        self.decide(result("10.0.0.1:80", 1))
+        self.disable("10.0.0.1:80")
+        self.assertNotIn("0.0.0.0:1001", self.model.listen_addresses())
+
+        self.decide(result("10.0.0.1:80", 0))
+        decisions = self.decide(result("10.0.0.1:80", 0))
+        self.assertEqual(decisions.enable, {"10.0.0.1:80"})
+        self.assertTrue(decisions.urgent)
+
+    def test_the_last_result_for_an_address_wins(self):
+        decisions = self.decide(result("10.0.0.2:80", 1), result("10.0.0.2:80", 0))
+        self.assertEqual(decisions.healthy, {"10.0.0.2:80"})
+        self.assertEqual(decisions.unhealthy, set())
+
+    def test_flapping_upstream_is_suppressed_until_its_penalty_decays(self):
+        address = "10.0.0.2:80"
+        for _ in range(2):
+            self.decide(result(address, 1))
+            self.decide(result(address, 1))
+            self.disable(address)
+            self.decide(result(address, 0))
+            decisions = self.decide(result(address, 0))
+            if decisions.enable:
+                self.model.enable(address, self.state_data)
+        self.assertEqual(decisions.enable, set())
+        self.assertIn(address, decisions.suppressed)
+        self.assertGreaterEqual(decisions.suppressed[address], POLICY.flap_reuse_limit)
+
+        self.now += 2 * POLICY.flap_half_life
+        decisions = self.decide(result(address, 0))
+        self.assertEqual(decisions.enable, {address})
+        self.assertEqual(decisions.suppressed, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import socket
+import struct
+import unittest
+from unittest import mock
+
+import health_checker_daemon as daemon
+
+def dns_response(query, answers, flags=0x8180):
+    """A reply to `query` carrying (type, rdata, ttl) answers that point back at the question name."""
+    body = struct.pack('!HHHHHH', struct.unpack('!H', query[:2])[0], flags, 1, len(answers), 0, 0) + query[12:]
+    for record_type, rdata, ttl in answers:
+        body += struct.pack('!HHHIH', 0xC00C, record_type, 1, ttl, len(rdata)) + rdata
+    return body
+
+class DnsMessageTest(unittest.TestCase):
+    def test_query_encodes_the_name_and_type(self):
+        query = daemon.build_dns_query(0x1234, "probe.example.com.", daemon.DNS_TYPE_AAAA)
+        self.assertEqual(query[:12], struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0))
+        self.assertEqual(query[12:], b'\x05probe\x07example\x03com\x00' + struct.pack('!HH', daemon.DNS_TYPE_AAAA, 1))
+
+    def test_response_answers_and_ttls(self):
+        query = daemon.build_dns_query(7, "probe.example.com", daemon.DNS_TYPE_A)
+        response = dns_response(query, [
+            (daemon.DNS_TYPE_A, socket.inet_aton("192.0.2.10"), 300),
+            (5, b'\x03foo\x00', 60),
+            (daemon.DNS_TYPE_AAAA, socket.inet_pton(socket.AF_INET6, "2001:db8::10"), 120),
+        ])
+        self.assertEqual(daemon.parse_dns_response(response),
+                         (7, 0, False, [("192.0.2.10", 300), ("2001:db8::10", 120)]))
+
+    def test_response_flags(self):
+        query = daemon.build_dns_query(9, "missing.example.com", daemon.DNS_TYPE_A)
+        self.assertEqual(daemon.parse_dns_response(dns_response(query, [], flags=0x8183)), (9, 3, False, []))
+        self.assertEqual(daemon.parse_dns_response(dns_response(query, [], flags=0x8380))[2], True)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class DnsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = daemon.DnsCache(min_ttl=30, max_ttl=600, clock=self.clock)
+        self.answers = {}
+        self.lookups = []
+
+        async def resolve(client, host):
+            self.lookups.append(host)
+            return self.answers.get(host, (None, None))
+        patchers = [mock.patch.object(self.cache, '_resolve', resolve),
+                    mock.patch.object(daemon, 'read_nameservers', return_value=[])]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def refresh(self, *hosts):
+        daemon.run_async(self.cache.refresh(hosts))
+
+    def test_answers_are_cached_for_their_clamped_ttl(self):
+        self.answers = {"short.example": (["192.0.2.1"], 5), "long.example": (["192.0.2.2", "192.0.2.3"], 86400)}
+        self.refresh("short.example", "long.example", "192.0.2.9")
+        self.assertEqual(self.cache.lookup("long.example"), "192.0.2.2")
+        self.assertEqual(self.cache.lookup("192.0.2.9"), "192.0.2.9")
+        self.assertEqual(self.cache.status()["short.example"]["expires_in"], 30)
+        self.assertEqual(self.cache.status()["long.example"]["expires_in"], 600)
+
+        self.clock.now += 29
+        self.refresh("short.example", "long.example")
+        self.assertEqual(self.lookups, ["long.example", "short.example"])
+        self.clock.now += 1
+        self.refresh("short.example", "long.example")
+        self.assertEqual(self.lookups, ["long.example", "short.example", "short.example"])
+
+    def test_failed_lookup_keeps_the_previous_answer(self):
+        self.answers = {"flaky.example": (["192.0.2.1"], 300)}
+        self.refresh("flaky.example")
+        self.answers = {}
+        self.clock.now += 300
+        self.refresh("flaky.example")
+        self.assertEqual(self.cache.lookup("flaky.example"), "192.0.2.1")
+        self.assertEqual(self.cache.status()["flaky.example"]["expires_in"], 30)
+
+    def test_unresolved_and_retired_hosts_fall_back_to_the_name(self):
+        self.answers = {"kept.example": (["192.0.2.1"], 300), "dropped.example": (["192.0.2.2"], 300)}
+        self.refresh("kept.example", "dropped.example", "unknown.example")
+        self.assertEqual(self.cache.lookup("unknown.example"), "unknown.example")
+        self.cache.retain({"kept.example"})
+        self.assertEqual(self.cache.lookup("dropped.example"), "dropped.example")
+        self.assertEqual(sorted(self.cache.status()), ["kept.example"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import health_checker_daemon as daemon
+
+HistoryRing = daemon.HistoryRing
+
+class HistoryRingTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "history.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_wraps_around_keeping_the_newest_entries(self):
+        ring = HistoryRing.open_for_write(self.path, slots=4, entries=5)
+        for i in range(12):
+            status = HistoryRing.STATUS_FAILED if i % 3 == 0 else HistoryRing.STATUS_OK
+            ring.record("10.0.0.1:80", 1000 + i, status, None if status else 0.0123)
+        records = ring.history("10.0.0.1:80")
+        ring.close()
+
+        self.assertEqual([ts for ts, _, _ in records], [1007, 1008, 1009, 1010, 1011])
+        self.assertEqual(records[2], (1009, HistoryRing.STATUS_FAILED, None))
+        self.assertEqual(records[0][1], HistoryRing.STATUS_OK)
+        self.assertAlmostEqual(records[0][2], 0.0123)
+
+    def test_reopen_reads_back_what_was_written(self):
+        ring = HistoryRing.open_for_write(self.path, slots=4, entries=3)
+        for i in range(4):
+            ring.record("10.0.0.1:80", 2000 + i, HistoryRing.STATUS_OK, 0.001)
+        ring.record("[2001:db8::1]:443", 2010, HistoryRing.STATUS_TIMEOUT, None)
+        ring.close(flush=True)
+
+        reader = HistoryRing.open_for_read(self.path)
+        self.assertEqual(reader.addresses(), ["10.0.0.1:80", "[2001:db8::1]:443"])
+        self.assertEqual([ts for ts, _, _ in reader.history("10.0.0.1:80")], [2001, 2002, 2003])
+        self.assertEqual(reader.history("[2001:db8::1]:443"), [(2010, HistoryRing.STATUS_TIMEOUT, None)])
+        reader.close()
+
+        writer = HistoryRing.open_for_write(self.path, slots=4, entries=3)
+        writer.record("10.0.0.1:80", 2004, HistoryRing.STATUS_FAILED, None)
+        self.assertEqual([ts for ts, _, _ in writer.history("10.0.0.1:80")], [2002, 2003, 2004])
+        writer.close()
+
+    def test_full_ring_recycles_the_stalest_slot(self):
+        ring = HistoryRing.open_for_write(self.path, slots=2, entries=4)
+        ring.record("a:1", 100, HistoryRing.STATUS_OK, 0.001)
+        ring.record("b:1", 200, HistoryRing.STATUS_OK, 0.001)
+        ring.record("a:1", 300, HistoryRing.STATUS_OK, 0.001)
+        ring.record("c:1", 400, HistoryRing.STATUS_OK, 0.001)
+        self.assertEqual(ring.addresses(), ["a:1", "c:1"])
+        self.assertEqual(ring.history("b:1"), [])
+        self.assertEqual(ring.history("c:1"), [(400, HistoryRing.STATUS_OK, 0.001)])
+        ring.close()
+
+    def test_other_layout_starts_a_new_history(self):
+        ring = HistoryRing.open_for_write(self.path, slots=4, entries=3)
+        ring.record("10.0.0.1:80", 3000, HistoryRing.STATUS_OK, 0.001)
+        ring.close(flush=True)
+
+        ring = HistoryRing.open_for_write(self.path, slots=8, entries=3)
+        self.assertEqual(ring.addresses(), [])
+        ring.close()
+        self.assertEqual(os.path.getsize(self.path), HistoryRing.file_size(8, 3))
+
+    def test_open_for_read_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a history file')
+        with self.assertRaises(ValueError):
+            HistoryRing.open_for_read(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import socket
+import unittest
+
+import health_checker_daemon as daemon
+
+SECRET = "shared-secret"
+
+def ipv6_loopback_available():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(("::1", 0))
+        return True
+    except OSError:
+        return False
+
+def host_port(host, port):
+    return f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+
+class PeerMeshLoopbackTest(unittest.TestCase):
+    """Two meshes on the loopback interface, each listing the other as its peer."""
+
+    def mesh(self, node_id, listen="127.0.0.1:0", secret=SECRET):
+        return daemon.PeerMesh(node_id, [], secret, quorum=2, ttl=60, listen=listen)
+
+    def run_pair(self, scenario, host="127.0.0.1", receiver_secret=SECRET):
+        async def run():
+            sender = self.mesh("a", host_port(host, 0))
+            receiver = self.mesh("b", host_port(host, 0), receiver_secret)
+            await sender.start()
+            await receiver.start()
+            sender.peers = [host_port(host, receiver.sockname()[1])]
+            try:
+                return await scenario(sender, receiver, receiver.sockname())
+            finally:
+                sender.close()
+                receiver.close()
+        return daemon.run_async(run())
+
+    @staticmethod
+    async def settle():
+        await asyncio.sleep(0.05)
+
+    def test_broadcast_verdicts_count_towards_the_quorum(self):
+        async def scenario(sender, receiver, _):
+            failing = daemon.FAILURES_TO_DISABLE
+            await sender.broadcast({"10.0.0.1:80": failing, "10.0.0.2:80": 0})
+            await self.settle()
+            return receiver.down_votes("10.0.0.1:80"), receiver.down_votes("10.0.0.2:80"), \
+                receiver.filter_disable({"10.0.0.1:80", "10.0.0.3:80"}), receiver.status()["a"]["down"]
+
+        votes_down, votes_up, (allowed, held), reported = self.run_pair(scenario)
+        self.assertEqual((votes_down, votes_up), (1, 0))
+        self.assertEqual(allowed, {"10.0.0.1:80"})
+        self.assertEqual(held, {"10.0.0.3:80"})
+        self.assertEqual(reported, ["10.0.0.1:80"])
+
+    def test_chunks_of_one_round_are_merged(self):
+        addresses = [f"10.1.{i // 250}.{i % 250}:80" for i in range(daemon.PEER_ADDRESSES_PER_DATAGRAM * 2 + 5)]
+
+        async def scenario(sender, receiver, _):
+            await sender.broadcast({address: daemon.FAILURES_TO_DISABLE for address in addresses})
+            await self.settle()
+            return receiver.status()["a"]["down"]
+
+        self.assertEqual(self.run_pair(scenario), sorted(addresses))
+
+    def test_tampered_and_foreign_datagrams_are_rejected(self):
+        async def scenario(sender, receiver, receiver_addr):
+            datagram = sender.encode({"10.0.0.1:80"}, set(), int(daemon.time.time() * 1000))[0]
+            tampered = datagram[:-3] + b'9' + datagram[-2:]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(tampered, receiver_addr)
+                sock.sendto(b'short', receiver_addr)
+            await self.settle()
+            return receiver.rejected, receiver.status()
+
+        self.assertEqual(self.run_pair(scenario), (2, {}))
+        foreign = self.run_pair(lambda sender, receiver, _: self._broadcast_and_report(sender, receiver),
+                                receiver_secret="other-secret")
+        self.assertEqual(foreign, (1, {}))
+
+    async def _broadcast_and_report(self, sender, receiver):
+        await sender.broadcast({"10.0.0.1:80": daemon.FAILURES_TO_DISABLE})
+        await self.settle()
+        return receiver.rejected, receiver.status()
+
+    def test_replayed_and_stale_rounds_are_ignored(self):
+        async def scenario(sender, receiver, receiver_addr):
+            now_ms = int(daemon.time.time() * 1000)
+            older = sender.encode({"10.0.0.1:80"}, set(), now_ms - 1000)[0]
+            newer = sender.encode(set(), {"10.0.0.1:80"}, now_ms)[0]
+            stale = sender.encode({"10.0.0.9:80"}, set(), now_ms - 120 * 1000)[0]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(newer, receiver_addr)
+                await self.settle()
+                sock.sendto(older, receiver_addr)
+                sock.sendto(stale, receiver_addr)
+                await self.settle()
+            return receiver.down_votes("10.0.0.1:80"), receiver.down_votes("10.0.0.9:80"), receiver.rejected
+
+        self.assertEqual(self.run_pair(scenario), (0, 0, 0))
+
+    @unittest.skipUnless(ipv6_loopback_available(), "IPv6 loopback is not available")
+    def test_ipv6_peers(self):
+        async def scenario(sender, receiver, _):
+            await sender.broadcast({"10.0.0.1:80": daemon.FAILURES_TO_DISABLE})
+            await self.settle()
+            return receiver.down_votes("10.0.0.1:80")
+
+        self.assertEqual(self.run_pair(scenario, host="::1"), 1)
+
+    @unittest.skipUnless(ipv6_loopback_available(), "IPv6 loopback is not available")
+    def test_ipv6_peer_from_an_ipv4_listener(self):
+        async def run():
+            sender, receiver = self.mesh("a"), self.mesh("b", "[::1]:0")
+            await sender.start()
+            await receiver.start()
+            sender.peers = [f"[::1]:{receiver.sockname()[1]}"]
+            try:
+                await sender.broadcast({"10.0.0.1:80": daemon.FAILURES_TO_DISABLE})
+                await self.settle()
+                return receiver.down_votes("10.0.0.1:80")
+            finally:
+                sender.close()
+                receiver.close()
+
+        self.assertEqual(daemon.run_async(run()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
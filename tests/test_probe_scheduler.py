@@ -0,0 +1,35 @@
+import unittest
+
+import health_checker_daemon as daemon
+
+def tasks(*lines):
+    return tuple(daemon.parse_health_check_line(line, 60, 5) for line in lines)
+
+class ProbeSchedulerTest(unittest.TestCase):
+    def test_lines_differing_only_in_options_are_scheduled_separately(self):
+        table = tasks("h.example:443=builtin:https path=/a", "h.example:443=builtin:https path=/b")
+        self.assertNotEqual(table[0].options, table[1].options)
+        scheduler = daemon.ProbeScheduler(0)
+        self.assertEqual(scheduler.sync(table, 0.0, stagger=False), 2)
+        self.assertEqual(len(scheduler), 2)
+        due = [task for _, task in scheduler.pop_due(0.0, 60.0)]
+        self.assertEqual(sorted(task.options for task in due), sorted(task.options for task in table))
+
+    def test_every_line_comes_up_once_per_interval(self):
+        table = tasks("10.0.0.1:80=builtin:tcp", "10.0.0.2:80=builtin:tcp interval=120")
+        scheduler = daemon.ProbeScheduler(0)
+        scheduler.sync(table, 0.0, stagger=False)
+        due = [sorted(task.address for _, task in scheduler.pop_due(start, start + 60)) for start in (0, 60, 120)]
+        self.assertEqual(due, [["10.0.0.1:80", "10.0.0.2:80"], ["10.0.0.1:80"], ["10.0.0.1:80", "10.0.0.2:80"]])
+
+    def test_backoff_applies_to_every_line_of_an_address(self):
+        table = tasks("h.example:443=builtin:https path=/a", "h.example:443=builtin:https path=/b")
+        scheduler = daemon.ProbeScheduler(0)
+        scheduler.sync(table, 0.0, stagger=False)
+        scheduler.pop_due(0, 60)
+        scheduler.set_backoff("h.example:443", 600, 0)
+        scheduler.set_backoff("h.example:443", 0, 30)
+        self.assertEqual(len(scheduler.pop_due(30, 31)), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+
+import health_checker_daemon as daemon
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class RecordingApply:
+    def __init__(self, changed=True):
+        self.changed = changed
+        self.calls = []
+
+    def __call__(self, enable, disable, weights):
+        self.calls.append((set(enable), set(disable), dict(weights)))
+        return self.changed
+
+class RestartCoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.coordinator = daemon.RestartCoordinator(0, 60, 1, clock=self.clock, retry_seconds=30)
+
+    def test_failed_restart_is_retried_without_reapplying(self):
+        apply_changes, restarts = RecordingApply(), [False, True]
+        self.coordinator.submit(set(), {"10.0.0.1:80"})
+        self.assertFalse(self.coordinator.flush(apply_changes, lambda: restarts.pop(0)))
+        self.assertTrue(self.coordinator.restart_due)
+        self.assertEqual(self.coordinator.restarts, 0)
+        self.assertEqual(self.coordinator.seconds_until_ready(), 30)
+
+        self.clock.now += 10
+        self.assertFalse(self.coordinator.flush(apply_changes, lambda: restarts.pop(0)))
+        self.clock.now += 20
+        self.assertTrue(self.coordinator.flush(apply_changes, lambda: restarts.pop(0)))
+        self.assertEqual(len(apply_changes.calls), 1)
+        self.assertFalse(self.coordinator.restart_due)
+        self.assertEqual(self.coordinator.restarts, 1)
+        self.assertIsNone(self.coordinator.seconds_until_ready())
+
+    def test_failed_restart_gives_its_token_back(self):
+        self.coordinator.submit(set(), {"10.0.0.1:80"})
+        self.coordinator.flush(RecordingApply(), lambda: False)
+        self.clock.now += 30
+        self.assertEqual(self.coordinator.seconds_until_ready(), 0)
+
+    def test_new_decisions_join_the_retried_restart(self):
+        apply_changes = RecordingApply()
+        self.coordinator.submit(set(), {"10.0.0.1:80"})
+        self.coordinator.flush(apply_changes, lambda: False)
+        self.coordinator.submit(set(), {"10.0.0.2:80"})
+        self.clock.now += 30
+        self.assertTrue(self.coordinator.flush(apply_changes, lambda: True))
+        self.assertEqual([disable for _, disable, _ in apply_changes.calls], [{"10.0.0.1:80"}, {"10.0.0.2:80"}])
+        self.assertEqual(self.coordinator.restarts, 1)
+        self.assertEqual(self.coordinator.restarts_avoided, 1)
+
+    def test_avoided_restarts_are_exported_on_flush(self):
+        def exported():
+            return daemon.METRICS._values['realm_health_restarts_avoided_total'].get((), 0)
+
+        before = exported()
+        self.coordinator.submit(set(), {"10.0.0.1:80"})
+        self.coordinator.submit(set(), {"10.0.0.2:80"})
+        self.coordinator.submit(set(), {"10.0.0.3:80"})
+        self.assertTrue(self.coordinator.flush(RecordingApply(), lambda: True))
+        self.assertEqual(exported() - before, 2)
+
+        self.coordinator.submit(set(), {"10.0.0.4:80"})
+        self.coordinator.submit(set(), set(), healthy={"10.0.0.4:80"})
+        self.assertFalse(self.coordinator.has_pending())
+        self.assertEqual(exported() - before, 3)
+        self.assertEqual(self.coordinator.restarts_avoided, 3)
+
+    def test_unchanged_config_does_not_restart(self):
+        restarted = []
+        self.coordinator.submit(set(), {"10.0.0.1:80"})
+        self.assertFalse(self.coordinator.flush(RecordingApply(changed=False), lambda: restarted.append(1) or True))
+        self.assertEqual(restarted, [])
+        self.assertIsNone(self.coordinator.seconds_until_ready())
+
+class RestartRealmTest(unittest.TestCase):
+    def restart_with(self, command, timeout=daemon.REALM_RESTART_TIMEOUT):
+        with mock.patch.object(daemon, 'REALM_RESTART_COMMAND', command), \
+                mock.patch.object(daemon, 'REALM_RESTART_TIMEOUT', timeout):
+            return daemon.restart_realm()
+
+    def test_success(self):
+        self.assertTrue(self.restart_with(["true"]))
+
+    def test_failures(self):
+        self.assertFalse(self.restart_with(["false"]))
+        self.assertFalse(self.restart_with(["/nonexistent/restart-realm"]))
+        self.assertFalse(self.restart_with(["sleep", "5"], timeout=0.2))
+
+if __name__ == "__main__":
+    unittest.main()
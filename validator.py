@@ -6,6 +6,7 @@ import argparse
 import os
 from collections import OrderedDict
 import difflib
+from collections import namedtuple
 
 KEY_TYPES = {
     'level': 'string', 'output': 'string',
@@ -41,6 +42,18 @@ KNOWN_KEYS_IN_SECTION = {
     ]
 }
 
+KNOWN_SECTION_SET = frozenset(KNOWN_SECTIONS)
+KNOWN_NORMAL_SECTION_SET = frozenset(KNOWN_NORMAL_SECTIONS)
+KNOWN_KEY_SETS = {section: frozenset(keys) for section, keys in KNOWN_KEYS_IN_SECTION.items()}
+
+ARRAY_SECTION_PATTERN = re.compile(r'^\[\[\s*([^\[\]]+)\s*\]\]$')
+NORMAL_SECTION_PATTERN = re.compile(r'^\[\s*([^\[\]]+)\s*\]$')
+KEY_VALUE_PATTERN = re.compile(r'^\s*([\w\.]+)\s*=\s*(.*)')
+ARRAY_ITEM_PATTERN = re.compile(r'"([^"]+)"')
+
+ValidationIssue = namedtuple('ValidationIssue', ['location', 'message'])
+ValidationResult = namedtuple('ValidationResult', ['is_valid', 'errors', 'data'])
+
 def log_error(message, indent=5):
     """打印标准格式的错误信息到 stderr"""
     print(f"{' ' * indent}\033[0;31m[错误] {message}\033[0m", file=sys.stderr, flush=True)
@@ -67,6 +80,12 @@ def _correct_key(key, valid_keys, context_msg):
         log_error(f"    -> 此处有效的配置项为: {valid_keys}")
     return None
 
+def _resolve_key(key, section_name, context_msg):
+    """先用预计算的键集合快速判断，未命中时再走自动校正逻辑。"""
+    if key in KNOWN_KEY_SETS.get(section_name, ()):
+        return key
+    return _correct_key(key, KNOWN_KEYS_IN_SECTION.get(section_name, []), context_msg)
+
 def parse_and_validate_value(value_str, expected_type, context_msg):
     """
     根据期望的类型解析和校验值。
@@ -87,7 +106,7 @@ def parse_and_validate_value(value_str, expected_type, context_msg):
 
     if expected_type == 'array':
         if value_str.startswith('[') and value_str.endswith(']'):
-            return [v.strip().strip('"') for v in re.findall(r'"([^"]+)"', value_str)]
+            return [v.strip().strip('"') for v in ARRAY_ITEM_PATTERN.findall(value_str)]
         log_error(f"类型错误 {context_msg}: 值 '{value_str}' 不是一个有效的数组格式 (应为 [\"a\", \"b\"])。")
         return None
 
@@ -107,7 +126,7 @@ def correct_json_data(data):
     corrected_data = OrderedDict()
     for section_name, section_value in data.items():
         corrected_section_name = section_name
-        if section_name not in KNOWN_SECTIONS:
+        if section_name not in KNOWN_SECTION_SET:
             matches = difflib.get_close_matches(section_name, KNOWN_SECTIONS, n=1, cutoff=0.6)
             if len(matches) == 1:
                 corrected_section_name = matches[0]
@@ -125,9 +144,8 @@ def correct_json_data(data):
                 log_error(f"节 '{section_name}' 的值应为一个对象, 但实际为 {type(section_value).__name__}。"); return None
             
             corrected_section_dict = OrderedDict()
-            valid_keys = KNOWN_KEYS_IN_SECTION[section_name]
             for key, value in section_value.items():
-                corrected_key = _correct_key(key, valid_keys, context_msg)
+                corrected_key = _resolve_key(key, section_name, context_msg)
                 if corrected_key is None: return None
                 expected_type = KEY_TYPES.get(corrected_key)
                 if expected_type == 'uint' and isinstance(value, int) and value >= 0:
@@ -148,12 +166,11 @@ def correct_json_data(data):
                 log_error(f"节 '{section_name}' 的值应为一个数组, 但实际为 {type(section_value).__name__}。"); return None
 
             corrected_list = []
-            valid_keys = KNOWN_KEYS_IN_SECTION[section_name]
             for i, item_dict in enumerate(section_value, 1):
                 corrected_item_dict = OrderedDict()
                 item_context_msg = f"在第 {i} 个 '{section_name}' 项目中, "
                 for key, value in item_dict.items():
-                    corrected_key = _correct_key(key, valid_keys, item_context_msg)
+                    corrected_key = _resolve_key(key, section_name, item_context_msg)
                     if corrected_key is None: return None
                     expected_type = KEY_TYPES.get(corrected_key)
                     corrected_item_dict[corrected_key] = value
@@ -172,8 +189,8 @@ def parse_toml(lines):
         original_line = line.strip()
         if not original_line or original_line.startswith('#'): continue
 
-        array_match = re.match(r'^\[\[\s*([^\[\]]+)\s*\]\]$', original_line)
-        normal_match = re.match(r'^\[\s*([^\[\]]+)\s*\]$', original_line)
+        array_match = ARRAY_SECTION_PATTERN.match(original_line)
+        normal_match = NORMAL_SECTION_PATTERN.match(original_line) if not array_match else None
         
         if array_match:
             section_name = array_match.group(1).strip()
@@ -206,12 +223,11 @@ def parse_toml(lines):
             current_section_name = section_name
             
         elif current_section_dict is not None and '=' in original_line:
-            kv_match = re.match(r'^\s*([\w\.]+)\s*=\s*(.*)', original_line)
+            kv_match = KEY_VALUE_PATTERN.match(original_line)
             if kv_match:
                 key, value_str = kv_match.groups()
-                valid_keys = KNOWN_KEYS_IN_SECTION.get(current_section_name, [])
                 context_msg = f"在节 '[{current_section_name}]' 中, "
-                key = _correct_key(key, valid_keys, context_msg)
+                key = _resolve_key(key, current_section_name, context_msg)
                 if key is None: return None
                 
                 value_str_no_comment = value_str.split('#', 1)[0].strip()
@@ -267,6 +283,74 @@ def serialize_to_toml(data):
     return "\n".join(output_lines)
 
 
+def _value_matches_type(value, expected_type):
+    if expected_type == 'bool':
+        return isinstance(value, bool)
+    if expected_type == 'uint':
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+    if expected_type == 'string':
+        return isinstance(value, str)
+    if expected_type == 'array':
+        return isinstance(value, list) and all(isinstance(v, str) for v in value)
+    if expected_type == 'object':
+        return isinstance(value, dict)
+    return False
+
+def _check_section_keys(section_name, section_value, location, errors):
+    valid_keys = KNOWN_KEY_SETS[section_name]
+    for key, value in section_value.items():
+        if key not in valid_keys:
+            errors.append(ValidationIssue(f"{location}.{key}", f"在 {location} 中, 无法识别的配置项 '{key}'。"))
+        elif not _value_matches_type(value, KEY_TYPES[key]):
+            errors.append(ValidationIssue(f"{location}.{key}", f"类型错误 在 {location} 中: 配置项 '{key}' 的值 '{value}' 类型不正确，应为 {KEY_TYPES[key]}。"))
+
+def validate_data(data):
+    """
+    校验内存中已解析的配置对象，不读写任何文件。
+    返回 ValidationResult(is_valid, errors, data)，其中 errors 为 ValidationIssue 列表。
+    """
+    errors = []
+    if not isinstance(data, dict):
+        errors.append(ValidationIssue("", "配置内容应为一个对象。"))
+        return ValidationResult(False, errors, data)
+
+    for section_name, section_value in data.items():
+        if section_name not in KNOWN_SECTION_SET:
+            errors.append(ValidationIssue(section_name, f"无法识别的顶层配置节 '{section_name}'。"))
+        elif section_name in KNOWN_NORMAL_SECTION_SET:
+            if isinstance(section_value, dict):
+                _check_section_keys(section_name, section_value, section_name, errors)
+            else:
+                errors.append(ValidationIssue(section_name, f"节 '{section_name}' 的值应为一个对象, 但实际为 {type(section_value).__name__}。"))
+
+    endpoints = data.get('endpoints', [])
+    if not isinstance(endpoints, list):
+        errors.append(ValidationIssue("endpoints", f"节 'endpoints' 的值应为一个数组, 但实际为 {type(endpoints).__name__}。"))
+        endpoints = []
+    if not endpoints:
+        errors.append(ValidationIssue("endpoints", "配置文件中必须至少包含一个 'endpoints' 配置块。"))
+
+    seen_listen_ports = set()
+    for i, endpoint in enumerate(endpoints, 1):
+        location = f"endpoints[{i}]"
+        if not isinstance(endpoint, dict):
+            errors.append(ValidationIssue(location, f"第 {i} 个 endpoint 项目应为一个对象，但格式不正确。")); continue
+        _check_section_keys('endpoints', endpoint, location, errors)
+        if not endpoint.get('listen'):
+            errors.append(ValidationIssue(f"{location}.listen", f"第 {i} 个 endpoint 缺少 'listen' 字段。"))
+        if not endpoint.get('remote'):
+            errors.append(ValidationIssue(f"{location}.remote", f"第 {i} 个 endpoint 缺少 'remote' 字段。"))
+
+        listen_addr = endpoint.get('listen')
+        if listen_addr:
+            if listen_addr in seen_listen_ports:
+                errors.append(ValidationIssue(f"{location}.listen", f"第 {i} 个 endpoint 的 listen 地址 '{listen_addr}' 与之前的配置重复。"))
+            else:
+                seen_listen_ports.add(listen_addr)
+
+    return ValidationResult(not errors, errors, data)
+
+
 def validate_config(file_path):
     """主校验函数，现在返回一个元组 (is_valid, corrected_data)。"""
     log_info(f"开始检查配置文件: {file_path}")
@@ -289,28 +373,10 @@ def validate_config(file_path):
     except Exception as e:
         log_error(f"文件读取或解析失败: {e}"); return False, None
 
-    is_struct_valid = True
-    endpoints = data.get('endpoints', [])
-    if not endpoints:
-        log_error("配置文件中必须至少包含一个 'endpoints' 配置块。"); is_struct_valid = False
-
-    seen_listen_ports = set()
-    for i, endpoint in enumerate(endpoints, 1):
-        if not isinstance(endpoint, dict):
-            log_error(f"第 {i} 个 endpoint 项目应为一个对象，但格式不正确。"); is_struct_valid = False; continue
-        if not endpoint.get('listen'):
-            log_error(f"第 {i} 个 endpoint 缺少 'listen' 字段。"); is_struct_valid = False
-        if not endpoint.get('remote'):
-            log_error(f"第 {i} 个 endpoint 缺少 'remote' 字段。"); is_struct_valid = False
-
-        listen_addr = endpoint.get('listen')
-        if listen_addr:
-            if listen_addr in seen_listen_ports:
-                log_error(f"第 {i} 个 endpoint 的 listen 地址 '{listen_addr}' 与之前的配置重复。"); is_struct_valid = False
-            else:
-                seen_listen_ports.add(listen_addr)
-    
-    return is_struct_valid, data
+    result = validate_data(data)
+    for issue in result.errors:
+        log_error(issue.message)
+    return result.is_valid, data
 
 
 def main():